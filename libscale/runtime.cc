@@ -58,3 +58,107 @@ void f_std_print(std::string value) {
 void f_std_abort() {
   abort();
 }
+
+// The arena used by generated code compiled with "--memory arena".
+// Ref structs are bump allocated from large chunks and are never freed individually.
+// Instead the whole region is reset, running the destructors of the objects that need them.
+// Generated code resets the region after each test.
+// Anything else, such as what the entrypoint allocates, lives until the program exits,
+// when the region is reset by an atexit handler.
+
+void scale_arena_reset();
+
+namespace {
+
+const size_t kArenaChunkSize = 1 << 20;
+
+struct ArenaChunk {
+  ArenaChunk* next;
+  size_t size;
+};
+
+struct ArenaFinalizer {
+  void (*destroy)(void*);
+  void* object;
+};
+
+struct Arena {
+  ArenaChunk* chunks = nullptr;
+  uintptr_t current = 0;
+  uintptr_t limit = 0;
+  ArenaFinalizer* finalizers = nullptr;
+  size_t finalizer_count = 0;
+  size_t finalizer_capacity = 0;
+  bool reset_at_exit = false;
+};
+
+Arena arena;
+
+void* arena_chunk(size_t size, size_t align) {
+  // Large objects get a chunk of their own, so the current chunk is not wasted.
+  size_t needed = sizeof(ArenaChunk) + size + align;
+  size_t chunk_size = needed > kArenaChunkSize ? needed : kArenaChunkSize;
+  ArenaChunk* chunk = static_cast<ArenaChunk*>(malloc(chunk_size));
+  if (chunk == nullptr) {
+    abort();
+  }
+  if (!arena.reset_at_exit) {
+    atexit(scale_arena_reset);
+    arena.reset_at_exit = true;
+  }
+  chunk->next = arena.chunks;
+  chunk->size = chunk_size;
+  arena.chunks = chunk;
+
+  uintptr_t begin = reinterpret_cast<uintptr_t>(chunk + 1);
+  uintptr_t end = reinterpret_cast<uintptr_t>(chunk) + chunk_size;
+  uintptr_t p = (begin + align - 1) & ~(uintptr_t)(align - 1);
+  if (needed <= kArenaChunkSize) {
+    arena.current = p + size;
+    arena.limit = end;
+  }
+  return reinterpret_cast<void*>(p);
+}
+
+}
+
+void* scale_arena_alloc(size_t size, size_t align) {
+  uintptr_t p = (arena.current + align - 1) & ~(uintptr_t)(align - 1);
+  if (arena.chunks == nullptr || p + size > arena.limit) {
+    return arena_chunk(size, align);
+  }
+  arena.current = p + size;
+  return reinterpret_cast<void*>(p);
+}
+
+void scale_arena_finalize(void (*destroy)(void*), void* object) {
+  if (arena.finalizer_count == arena.finalizer_capacity) {
+    size_t capacity = arena.finalizer_capacity ? arena.finalizer_capacity * 2 : 256;
+    void* finalizers = realloc(arena.finalizers, capacity * sizeof(ArenaFinalizer));
+    if (finalizers == nullptr) {
+      abort();
+    }
+    arena.finalizers = static_cast<ArenaFinalizer*>(finalizers);
+    arena.finalizer_capacity = capacity;
+  }
+  arena.finalizers[arena.finalizer_count++] = ArenaFinalizer{destroy, object};
+}
+
+void scale_arena_reset() {
+  // Destroy in reverse order of construction.
+  while (arena.finalizer_count > 0) {
+    ArenaFinalizer& f = arena.finalizers[--arena.finalizer_count];
+    f.destroy(f.object);
+  }
+  free(arena.finalizers);
+  arena.finalizers = nullptr;
+  arena.finalizer_capacity = 0;
+
+  while (arena.chunks != nullptr) {
+    ArenaChunk* next = arena.chunks->next;
+    free(arena.chunks);
+    arena.chunks = next;
+  }
+  arena.current = 0;
+  arena.limit = 0;
+}
@@ -1,5 +1,5 @@
-import inspect
 import re
+import sys
 
 ident = re.compile(r'\w+')
 dotted_name = re.compile(r'\w+(?:\.\w+)*')
@@ -153,6 +153,7 @@ class SchemaParser(object):
 python_types = {
     'string': 'str',
     'rune': 'str',
+    'location': 'int',
 }
 
 
@@ -165,7 +166,7 @@ def zero_value(f):
             return repr('\0')
         elif t.name == 'bool':
             return repr(False)
-        elif t.name == 'int':
+        elif t.name in ('int', 'location'):
             return repr(0)
         else:
             return repr(None)
@@ -211,12 +212,15 @@ class TreeMeta(type):
         assert '__schema__' in dct, dct
 
         # Grab the globals used while defining the class.
-        cls_globals = inspect.stack()[1][0].f_globals
+        cls_globals = sys._getframe(1).f_globals
 
         p = SchemaParser()
         fields = p.parse(dct['__schema__'])
 
         dct['__slots__'] = [f.name for f in fields]
+        dct['__fields__'] = fields
+        # The fields passed to the constructor, in order.
+        dct['__init_slots__'] = [f.name for f in fields if init_with_arg(f)]
 
         src = ''
         if '__init__' not in dct:
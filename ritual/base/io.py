@@ -1,3 +1,7 @@
+import hashlib
+import os
+
+
 class Block(object):
     def __init__(self, out, if_empty=None):
         assert isinstance(out, TabbedWriter), out
@@ -52,3 +56,73 @@ class TabbedWriter(object):
                 self.pos += 1
             self.out.write('\n')
         return self
+
+
+# Writes text to a temporary file, hashing it as it goes, and replaces "path" when closed.
+# If "path" already has the same contents it is left untouched, so its modification time
+# only changes when the output does.
+class AtomicFileWriter(object):
+    def __init__(self, path, chunk_size=1 << 16):
+        self.path = path
+        self.temp = '%s.%d.tmp' % (path, os.getpid())
+        self.chunk_size = chunk_size
+        self.f = open(self.temp, 'wb')
+        self.hash = hashlib.sha256()
+        self.pending = []
+        self.pending_size = 0
+        self.size = 0
+        self.changed = None
+
+    def write(self, text):
+        self.pending.append(text)
+        self.pending_size += len(text)
+        if self.pending_size >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            data = ''.join(self.pending).encode('utf-8')
+            self.pending = []
+            self.pending_size = 0
+            self.hash.update(data)
+            self.f.write(data)
+            self.size += len(data)
+
+    def close(self):
+        self.flush()
+        self.f.close()
+        self.changed = not same_contents(self.path, self.size, self.hash.digest())
+        if self.changed:
+            os.replace(self.temp, self.path)
+        else:
+            os.remove(self.temp)
+        return self.changed
+
+    def discard(self):
+        self.f.close()
+        os.remove(self.temp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+def same_contents(path, size, digest, chunk_size=1 << 16):
+    try:
+        if os.path.getsize(path) != size:
+            return False
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                h.update(data)
+    except OSError:
+        return False
+    return h.digest() == digest
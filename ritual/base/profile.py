@@ -0,0 +1,159 @@
+import json
+import os
+import time
+
+
+class Phase(object):
+    __slots__ = ['name', 'module', 'start', 'wall', 'cpu', 'counters']
+
+    def __init__(self, name, module, start):
+        self.name = name
+        self.module = module
+        self.start = start
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.counters = {}
+
+
+class PhaseScope(object):
+    __slots__ = ['profile', 'phase', 'cpu']
+
+    def __init__(self, profile, phase):
+        self.profile = profile
+        self.phase = phase
+
+    def __enter__(self):
+        self.profile.stack.append(self.phase)
+        self.cpu = time.process_time()
+        self.phase.start = time.perf_counter()
+        return self.phase
+
+    def __exit__(self, type, value, traceback):
+        phase = self.phase
+        phase.wall = time.perf_counter() - phase.start
+        phase.cpu = time.process_time() - self.cpu
+        old = self.profile.stack.pop()
+        assert old is phase, old
+        self.profile.phases.append(phase)
+
+
+# Records how long each phase of a compilation takes, and counts what it did.
+# Phases nest, and may be attributed to a module.
+# Counters are attributed to the innermost phase and totalled for the whole profile.
+class Profile(object):
+    enabled = True
+
+    def __init__(self):
+        self.phases = []
+        self.stack = []
+        self.counters = {}
+
+    def phase(self, name, module=None):
+        return PhaseScope(self, Phase(name, module, 0.0))
+
+    # Record a phase that was timed elsewhere, such as before the profile was created.
+    def record(self, name, start, wall, cpu, module=None):
+        phase = Phase(name, module, start)
+        phase.wall = wall
+        phase.cpu = cpu
+        self.phases.append(phase)
+
+    def count(self, name, amount=1):
+        if self.stack:
+            counters = self.stack[-1].counters
+            counters[name] = counters.get(name, 0) + amount
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def to_json(self):
+        origin = min([phase.start for phase in self.phases]) if self.phases else 0.0
+        phases = []
+        for phase in sorted(self.phases, key=lambda phase: phase.start):
+            phases.append({
+                'name': phase.name,
+                'module': phase.module,
+                'start': phase.start - origin,
+                'wall': phase.wall,
+                'cpu': phase.cpu,
+                'counters': phase.counters,
+            })
+        return {'phases': phases, 'counters': self.counters}
+
+    # The Chrome trace event format, viewable in chrome://tracing or Perfetto.
+    def to_trace(self):
+        origin = min([phase.start for phase in self.phases]) if self.phases else 0.0
+        pid = os.getpid()
+        events = []
+        for phase in sorted(self.phases, key=lambda phase: phase.start):
+            args = dict(phase.counters)
+            args['cpu_ms'] = phase.cpu * 1e3
+            events.append({
+                'name': phase.name if phase.module is None else '%s %s' % (phase.name, phase.module),
+                'cat': 'module' if phase.module is not None else 'phase',
+                'ph': 'X',
+                'ts': (phase.start - origin) * 1e6,
+                'dur': phase.wall * 1e6,
+                'pid': pid,
+                'tid': 0,
+                'args': args,
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self, path, kind='json'):
+        if kind == 'trace':
+            data = self.to_trace()
+        else:
+            data = self.to_json()
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+            f.write('\n')
+
+
+class NullScope(object):
+    __slots__ = []
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+
+NULL_SCOPE = NullScope()
+
+
+# Stands in for a Profile when profiling is disabled, so instrumented code does not need to check.
+class NullProfile(object):
+    enabled = False
+
+    def phase(self, name, module=None):
+        return NULL_SCOPE
+
+    def record(self, name, start, wall, cpu, module=None):
+        pass
+
+    def count(self, name, amount=1):
+        pass
+
+
+NULL_PROFILE = NullProfile()
+
+
+# The number of trees reachable from "value", not counting backedges.
+def count_trees(value):
+    count = 0
+    pending = [value]
+    visited = set()
+    while pending:
+        value = pending.pop()
+        if isinstance(value, list):
+            pending.extend(value)
+            continue
+        fields = getattr(type(value), '__fields__', None)
+        if fields is None or id(value) in visited:
+            continue
+        visited.add(id(value))
+        count += 1
+        for f in fields:
+            if 'backedge' not in f.attrs:
+                pending.append(getattr(value, f.name))
+    return count
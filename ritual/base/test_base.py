@@ -1,4 +1,8 @@
 from ritual import base
+from ritual.base import io
+from ritual.base import profile
+import os
+import tempfile
 import unittest
 
 class Foo(object, metaclass=base.TreeMeta):
@@ -27,3 +31,68 @@ class TestSimpleParser(unittest.TestCase):
         self.assertEqual(Bar(0, Foo(1, 'a', 'b')), Bar(0, Foo(2, 'a', 'b')))
         self.assertNotEqual(Bar(0, Foo(1, 'a', 'b')), Bar(1, Foo(1, 'a', 'b')))
         self.assertNotEqual(Bar(0, Foo(1, 'a', 'b')), Bar(0, Foo(1, 'b', 'b')))
+
+
+class TestProfile(unittest.TestCase):
+    def test_phases(self):
+        p = profile.Profile()
+        with p.phase('parse'):
+            with p.phase('parse', 'foo'):
+                p.count('nodes', 3)
+            p.count('nodes')
+        p.record('grammar', 0.0, 1.0, 0.5)
+
+        self.assertEqual(p.counters, {'nodes': 4})
+        data = p.to_json()
+        self.assertEqual([(phase['name'], phase['module'], phase['counters']) for phase in data['phases']], [
+            ('grammar', None, {}),
+            ('parse', None, {'nodes': 1}),
+            ('parse', 'foo', {'nodes': 3}),
+        ])
+
+        events = p.to_trace()['traceEvents']
+        self.assertEqual([event['name'] for event in events], ['grammar', 'parse', 'parse foo'])
+        self.assertEqual(events[0]['dur'], 1e6)
+        outer, inner = events[1:]
+        self.assertLessEqual(outer['ts'], inner['ts'])
+        self.assertGreaterEqual(outer['ts'] + outer['dur'], inner['ts'] + inner['dur'])
+
+    def test_null_profile(self):
+        p = profile.NULL_PROFILE
+        with p.phase('parse') as phase:
+            p.count('nodes')
+        self.assertIsNone(phase)
+        self.assertFalse(p.enabled)
+
+    def test_count_trees(self):
+        self.assertEqual(profile.count_trees(Bar(0, Foo(1, 'a', 'b'))), 2)
+        self.assertEqual(profile.count_trees([Foo(1, 'a', 'b'), Foo(2, 'a', 'b')]), 2)
+
+
+class TestAtomicFileWriter(unittest.TestCase):
+    def test_replace_if_changed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'out.txt')
+
+            def write(*parts):
+                with io.AtomicFileWriter(path, chunk_size=4) as out:
+                    for part in parts:
+                        out.write(part)
+                self.assertEqual(os.listdir(directory), ['out.txt'])
+                return out.changed
+
+            self.assertTrue(write('hello ', 'world\n', '\u0482'))
+            with open(path, encoding='utf-8') as f:
+                self.assertEqual(f.read(), 'hello world\n\u0482')
+            os.utime(path, (0, 0))
+            self.assertFalse(write('hello world\n', '\u0482'))
+            self.assertEqual(os.path.getmtime(path), 0)
+            self.assertTrue(write('hello world\n', '\u0483'))
+
+            with self.assertRaises(ValueError):
+                with io.AtomicFileWriter(path) as out:
+                    out.write('partial')
+                    raise ValueError()
+            self.assertEqual(os.listdir(directory), ['out.txt'])
+            with open(path, encoding='utf-8') as f:
+                self.assertEqual(f.read(), 'hello world\n\u0483')
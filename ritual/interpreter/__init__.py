@@ -1,4 +1,11 @@
+import bisect
+import copy
+import re
+import sys
+import time
+
 from ritual import base
+from . import chunked
 from . import location
 
 
@@ -8,6 +15,17 @@ def register(cls):
     return cls
 
 
+# Marks a local slot that has not been assigned yet.
+class Unbound(object):
+    __slots__ = []
+
+    def __repr__(self):
+        return '<unbound>'
+
+
+UNBOUND = Unbound()
+
+
 class Matcher(object):
     __slots__ = []
     def match(self, parser):
@@ -66,11 +84,78 @@ class Choice(Matcher, metaclass=base.TreeMeta):
         return Choice(self.children + others)
 
 
+def switch_plan(node, matchers, o):
+    # The alternatives to try for code point o (None at the end of the
+    # stream), each preceded by the name a skipped alternative would have
+    # recorded when it failed.
+    steps = []
+    skipped = None
+    for name, prefix, m in zip(node.names, node.prefixes, matchers):
+        if prefix is None or o is not None and prefix.classifier.contains(chr(o)):
+            steps.append((skipped, m))
+            skipped = None
+        elif skipped is None:
+            skipped = name
+    return tuple(steps), skipped
+
+
+def build_switch(node, matchers):
+    points = set([0])
+    for prefix in node.prefixes:
+        if prefix is not None:
+            for lower, upper in prefix.classifier.intervals():
+                points.add(lower)
+                points.add(upper + 1)
+    bounds = sorted([point for point in points if point <= sys.maxunicode])
+    table = [switch_plan(node, matchers, lower) for lower in bounds]
+    return bounds, table, switch_plan(node, matchers, None)
+
+
+@register
+class SwitchChoice(Matcher, metaclass=base.TreeMeta):
+    __schema__ = 'children:[]Matcher names:[]?string prefixes:[]?Character bounds:[]int@[no_init, no_compare] table:[]*@[no_init, no_compare] eos:*@[no_init, no_compare]'
+
+    def __init__(self, children, names, prefixes):
+        assert isinstance(children, list), (type(self), type(children))
+        assert isinstance(names, list), (type(self), type(names))
+        assert isinstance(prefixes, list), (type(self), type(prefixes))
+        assert len(children) == len(names) == len(prefixes), self
+        self.children = children
+        self.names = names
+        self.prefixes = prefixes
+        self.bounds, self.table, self.eos = build_switch(self, children)
+
+    def match(self, parser):
+        pos = parser.pos
+        if parser.hasNext():
+            steps, tail = self.table[bisect.bisect_right(self.bounds, ord(parser.peek())) - 1]
+        else:
+            steps, tail = self.eos
+        result = None
+        for name, m in steps:
+            if name is not None:
+                parser.recordFailure(name)
+            result = m.match(parser)
+            if parser.ok:
+                return result
+            parser.recover(pos)
+        if tail is None:
+            parser.fail()
+        else:
+            parser.recordFailure(tail)
+            parser.ok = False
+        return result
+
+
 @register
 class Repeat(Matcher, metaclass=base.TreeMeta):
     __schema__ = 'expr:Matcher min:int max:int'
 
     def match(self, parser):
+        if type(self.expr) is Character:
+            self.expr.matchRun(parser, self.min, self.max)
+            return
+
         count = 0
         while count < self.min:
             self.expr.match(parser)
@@ -112,28 +197,107 @@ class Range(object, metaclass=base.TreeMeta):
     __schema__ = 'lower:rune upper:rune'
 
 
+# A precomputed classifier for a set of character ranges.
+# ASCII characters are looked up in a table, anything else is found with a
+# bisect over the sorted ranges.
+class CharacterClass(object):
+    __slots__ = ['ascii', 'lowers', 'uppers', 'invert', 'run']
+
+    def __init__(self, ranges, invert):
+        merged = []
+        for lower, upper in sorted([(ord(r.lower), ord(r.upper)) for r in ranges]):
+            if merged and lower <= merged[-1][1] + 1:
+                if upper > merged[-1][1]:
+                    merged[-1][1] = upper
+            else:
+                merged.append([lower, upper])
+
+        self.invert = invert
+        self.lowers = [lower for lower, upper in merged]
+        self.uppers = [upper for lower, upper in merged]
+        self.ascii = tuple([self.lookup(o) for o in range(128)])
+
+        if merged:
+            parts = ['\\U%08x-\\U%08x' % (lower, upper) for lower, upper in merged]
+            self.run = re.compile('[%s%s]*' % ('^' if invert else '', ''.join(parts)))
+        elif invert:
+            self.run = re.compile('.*', re.DOTALL)
+        else:
+            self.run = re.compile('')
+
+    def intervals(self):
+        # The matching code points as inclusive (lower, upper) pairs.
+        if not self.invert:
+            return list(zip(self.lowers, self.uppers))
+        out = []
+        prev = 0
+        for lower, upper in zip(self.lowers, self.uppers):
+            if lower > prev:
+                out.append((prev, lower - 1))
+            prev = upper + 1
+        if prev <= sys.maxunicode:
+            out.append((prev, sys.maxunicode))
+        return out
+
+    def lookup(self, o):
+        i = bisect.bisect_right(self.lowers, o) - 1
+        return (i >= 0 and o <= self.uppers[i]) != self.invert
+
+    def contains(self, c):
+        o = ord(c)
+        if o < 128:
+            return self.ascii[o]
+        return self.lookup(o)
+
+    def scan(self, stream, pos, end):
+        # Returns the end of the run of matching characters starting at pos.
+        return self.run.match(stream, pos, end).end()
+
+
 @register
 class Character(Matcher, metaclass=base.TreeMeta):
-    __schema__ = 'ranges:[]Range invert:bool'
+    __schema__ = 'ranges:[]Range invert:bool classifier:CharacterClass@[no_init, no_compare]'
+
+    def __init__(self, ranges, invert):
+        assert isinstance(ranges, list), (type(self), type(ranges))
+        for r in ranges:
+            assert isinstance(r, Range), (type(self), type(r))
+        assert isinstance(invert, bool), (type(self), type(invert))
+        self.ranges = ranges
+        self.invert = invert
+        self.classifier = CharacterClass(ranges, invert)
 
     def match(self, parser):
         if not parser.hasNext():
             parser.fail()
             return
         c = parser.peek()
-
-        matches = False
-        for r in self.ranges:
-            if r.lower <= c <= r.upper:
-                matches = True
-                break
-
-        if matches != self.invert:
+        o = ord(c)
+        classifier = self.classifier
+        if classifier.ascii[o] if o < 128 else classifier.lookup(o):
             parser.consume()
         else:
             parser.fail()
         return c
 
+    def matchRun(self, parser, min, max):
+        pos = parser.pos
+        if parser.source is None:
+            end = parser.end
+            if max > 0 and pos + max < end:
+                end = pos + max
+            parser.pos = self.classifier.scan(parser.stream, pos, end)
+        else:
+            parser.keepDeepest()
+            parser.pos = parser.source.scan(self.classifier, pos, pos + max if max > 0 else None)
+            parser.end = parser.source.end
+        count = parser.pos - pos
+        if count < max or max <= 0:
+            # The run was ended by a character that did not match.
+            parser.fail()
+        if count >= min:
+            parser.recover(parser.pos)
+
 
 @register
 class MatchValue(Matcher, metaclass=base.TreeMeta):
@@ -161,8 +325,17 @@ class Lookahead(Matcher, metaclass=base.TreeMeta):
         pos = parser.pos
         deepest = parser.deepest
         deepest_name = parser.deepest_name
+        restored_deepest = parser.restored_deepest
+        parser.restored_deepest = min(restored_deepest, max(deepest, parser.outer_deepest))
 
         result = self.expr.match(parser)
+        parser.restored_deepest = restored_deepest
+
+        # Remember how far ahead the lookahead looked, even though its failures are discarded.
+        if parser.deepest >= parser.examined:
+            parser.examined = parser.deepest + 1
+        if parser.pos > parser.examined:
+            parser.examined = parser.pos
 
         # Restore
         # TODO local state?
@@ -194,36 +367,34 @@ class Slice(Matcher, metaclass=base.TreeMeta):
 
 @register
 class Get(Matcher, metaclass=base.TreeMeta):
-    __schema__ = 'name:string'
+    __schema__ = 'name:string slot:int@[no_init, no_compare] target:?Callable@[no_init, no_compare]'
 
     def match(self, parser):
-        n = self.name
-        lcls = parser.stack[-1].scope
-        if n in lcls:
-            return lcls[n]
-        elif n in parser.rules:
-            return parser.rules[n]
-        else:
-            parser.internalError(self, "Unbound name %r" % n)
+        if self.slot >= 0:
+            value = parser.locals[self.slot]
+            if value is not UNBOUND:
+                return value
+        if self.target is not None:
+            return self.target
+        parser.internalError(self, "Unbound name %r" % self.name)
 
 
 @register
 class Set(Matcher, metaclass=base.TreeMeta):
-    __schema__ = 'expr:Matcher name:string'
+    __schema__ = 'expr:Matcher name:string slot:int@[no_init, no_compare]'
 
     def match(self, parser):
         result = self.expr.match(parser)
         if parser.ok:
             if isinstance(result, Callable):
                 parser.internalError(self, "Should not be storing a Callable to %r: %r" % (self.name, result))
-            lcls = parser.stack[-1].scope
-            lcls[self.name] = result
+            parser.locals[self.slot] = result
         return result
 
 
 @register
 class Append(Matcher, metaclass=base.TreeMeta):
-    __schema__ = 'expr:Matcher name:string'
+    __schema__ = 'expr:Matcher name:string slot:int@[no_init, no_compare]'
 
     def match(self, parser):
         result = self.expr.match(parser)
@@ -231,10 +402,9 @@ class Append(Matcher, metaclass=base.TreeMeta):
             n = self.name
             if isinstance(result, Callable):
                 parser.internalError(self, "Should not be storing a Callable to %r: %r" % (self.name, result))
-            lcls = parser.stack[-1].scope
-            if n not in lcls:
+            tgt = parser.locals[self.slot]
+            if tgt is UNBOUND:
                 parser.internalError(self, "Unbound name %r" % n)
-            tgt = lcls[n]
             if not isinstance(tgt, list):
                 parser.internalError(self, "Append target %r is a %r and not a list" % (n, type(tgt)))
             tgt.append(result)
@@ -271,6 +441,20 @@ class Location(Matcher, metaclass=base.TreeMeta):
         return parser.pos + parser.pos_offset
 
 
+# Counts how often an alternative of a choice is tried and fails.
+# Only inserted into the copy of the grammar a profiled parser links.
+class ProfiledAlternative(Matcher, metaclass=base.TreeMeta):
+    __schema__ = 'expr:Matcher profile:AlternativeProfile'
+
+    def match(self, parser):
+        result = self.expr.match(parser)
+        profile = self.profile
+        profile.attempts += 1
+        if not parser.ok:
+            profile.backtracks += 1
+        return result
+
+
 class Param(object, metaclass=base.TreeMeta):
     __schema__ = 'name:string'
 
@@ -280,21 +464,27 @@ class Callable(object):
 
 
 class Rule(Callable, metaclass=base.TreeMeta):
-    __schema__ = 'name:string params:[]Param body:Matcher'
+    __schema__ = 'name:string params:[]Param body:Matcher names:[]string@[no_init, no_compare] pool:[]StackFrame@[no_init, no_compare]'
 
     def call(self, parser, args):
         if len(args) != len(self.params):
             parser.internalError(self, 'Expected %d arguments for %s, got %d' % (len(self.params), self.name, len(args)))
 
-        parser.enterFrame(self.name)
-
-        # Bind arguments to parameters.
-        lcls = parser.stack[-1].scope
-        for i in range(len(self.params)):
-            lcls[self.params[i].name] = args[i]
-
-        result = self.body.match(parser)
-        parser.exitFrame()
+        if parser.memo is not None:
+            return parser.memo.call(self, parser, args)
+        return self.invoke(parser, args)
+
+    def invoke(self, parser, args):
+        name = parser.rule_name
+        parser.rule_name = self.name
+        if self.names:
+            parser.enterFrame(self, args)
+            result = self.body.match(parser)
+            parser.exitFrame()
+        else:
+            # Rules without locals need no frame, only their name to attribute failures.
+            result = self.body.match(parser)
+        parser.rule_name = name
         return result
 
 
@@ -311,37 +501,528 @@ class Native(Callable, metaclass=base.TreeMeta):
             raise
 
 
+# Resolves names once, when the parser is loaded, rather than on every match.
+# Locals are assigned fixed slots in their rule's frame and other names are
+# bound directly to the rules they refer to.
+class LinkMatcher(object, metaclass=base.TypeDispatcher):
+
+    @base.dispatch(Sequence)
+    def visitChildren(cls, node, rule, parser):
+        for child in node.children:
+            cls.visit(child, rule, parser)
+
+    @base.dispatch(Choice, SwitchChoice)
+    def visitChoice(cls, node, rule, parser):
+        for child in node.children:
+            cls.visit(child, rule, parser)
+        if parser.profiler is not None:
+            parser.profiler.instrumentChoice(node, rule)
+
+    @base.dispatch(Repeat, MatchValue, Lookahead, Slice)
+    def visitExpr(cls, node, rule, parser):
+        cls.visit(node.expr, rule, parser)
+
+    @base.dispatch(Call)
+    def visitCall(cls, node, rule, parser):
+        cls.visit(node.expr, rule, parser)
+        for arg in node.args:
+            cls.visit(arg, rule, parser)
+
+    @base.dispatch(List)
+    def visitList(cls, node, rule, parser):
+        for arg in node.args:
+            cls.visit(arg, rule, parser)
+
+    @base.dispatch(Character, Literal, Location)
+    def visitLeaf(cls, node, rule, parser):
+        pass
+
+    @base.dispatch(Set, Append)
+    def visitAssign(cls, node, rule, parser):
+        cls.visit(node.expr, rule, parser)
+        node.slot = rule.names.index(node.name)
+
+    @base.dispatch(Get)
+    def visitGet(cls, node, rule, parser):
+        node.slot = rule.names.index(node.name) if node.name in rule.names else -1
+        node.target = parser.lookup(node.name)
+
+
+class CollectLocals(object, metaclass=base.TypeDispatcher):
+
+    @base.dispatch(Set, Append)
+    def visitAssign(cls, node, names):
+        if node.name not in names:
+            names.append(node.name)
+        cls.visit(node.expr, names)
+
+    @base.dispatch(Sequence, Choice, SwitchChoice)
+    def visitChildren(cls, node, names):
+        for child in node.children:
+            cls.visit(child, names)
+
+    @base.dispatch(Repeat, MatchValue, Lookahead, Slice)
+    def visitExpr(cls, node, names):
+        cls.visit(node.expr, names)
+
+    @base.dispatch(Call)
+    def visitCall(cls, node, names):
+        cls.visit(node.expr, names)
+        for arg in node.args:
+            cls.visit(arg, names)
+
+    @base.dispatch(List)
+    def visitList(cls, node, names):
+        for arg in node.args:
+            cls.visit(arg, names)
+
+    @base.dispatch(Character, Get, Literal, Location)
+    def visitLeaf(cls, node, names):
+        pass
+
+
+# The names of the locals of a rule, parameters first.
+def ruleLocals(rule):
+    names = [p.name for p in rule.params]
+    CollectLocals.visit(rule.body, names)
+    return names
+
+
+# Linking writes into the tree, so each parser links its own copy of the rules it was given.
+def copyMatcher(node):
+    copied = copy.copy(node)
+    for f in type(node).__fields__:
+        value = getattr(node, f.name)
+        if isinstance(value, Matcher):
+            setattr(copied, f.name, copyMatcher(value))
+        elif isinstance(value, list):
+            setattr(copied, f.name, [copyMatcher(child) if isinstance(child, Matcher) else child for child in value])
+    if isinstance(copied, SwitchChoice):
+        copied.bounds, copied.table, copied.eos = build_switch(copied, copied.children)
+    return copied
+
+
+def linkRule(rule, parser):
+    rule.names = ruleLocals(rule)
+    # Rules without locals do not use frames.
+    # Otherwise frames are recycled through a free list.
+    rule.pool = []
+    if parser.profiler is not None:
+        parser.profiler.instrumentRule(rule)
+    LinkMatcher.visit(rule.body, rule, parser)
+
+
 def registerInterpreterTypes(p):
     for t in types:
-        p.rule(Native(t.__name__, [Param(slot) for slot in t.__slots__], t))
+        p.rule(Native(t.__name__, [Param(slot) for slot in t.__init_slots__], t))
 
 
 @register
 class ParseResult(object, metaclass=base.TreeMeta):
-    __schema__ = 'value:* pos:int ok:bool error_scope:?string error_location:?location.LocationInfo loc:int'
+    __schema__ = 'value:* pos:int ok:bool error_scope:?string loc:int source:?location.SourceText@[no_compare] info:?location.LocationInfo@[no_init, no_compare]'
+
+    def error_location(self):
+        # The line and column are only found once the error is reported.
+        if self.info is None:
+            self.info = self.source.extract_location_info(self.loc)
+        return self.info
 
     def error_message(self):
         assert not self.ok
-        info = self.error_location
+        info = self.error_location()
         return 'Error at %d:%d @ %s (%s)\n%s\n%s' % (info.line, info.column, info.character, self.error_scope, info.text, info.arrow)
 
 
-class StackFrame(object):
+class ParseStats(object):
+    def __init__(self):
+        self.memo_hits = 0
+        self.memo_misses = 0
+        self.memo_evictions = 0
+        self.memo_invalidations = 0
+        self.frame_allocations = 0
+
+    def hitRate(self):
+        total = self.memo_hits + self.memo_misses
+        return self.memo_hits / total if total else 0.0
+
+    def __repr__(self):
+        return 'ParseStats(hits=%d, misses=%d, evictions=%d, invalidations=%d, hit_rate=%.3f, frame_allocations=%d)' % (self.memo_hits, self.memo_misses, self.memo_evictions, self.memo_invalidations, self.hitRate(), self.frame_allocations)
+
+
+class RuleProfile(object):
+    __slots__ = ['name', 'calls', 'successes', 'failures', 'consumed', 'inclusive', 'exclusive', 'active']
+
     def __init__(self, name):
         self.name = name
-        self.scope = {}
+        self.calls = 0
+        self.successes = 0
+        self.failures = 0
+        # Characters consumed by successful invocations.
+        self.consumed = 0
+        # Time including the rules it called, only counting the outermost of recursive invocations.
+        self.inclusive = 0.0
+        # Time excluding the rules it called.
+        self.exclusive = 0.0
+        self.active = 0
+
+
+class AlternativeProfile(object):
+    __slots__ = ['rule', 'choice', 'index', 'attempts', 'backtracks']
+
+    def __init__(self, rule, choice, index):
+        self.rule = rule
+        # Numbers the choices within the rule, in the order they are linked.
+        self.choice = choice
+        self.index = index
+        self.attempts = 0
+        self.backtracks = 0
+
+
+# Stands in for a rule or native when the parser is profiled.
+# Names are bound to it when the parser is linked, so unprofiled parsers do not pay for it.
+class ProfiledCallable(Callable):
+    __slots__ = ['callable', 'profile', 'profiler']
+
+    def __init__(self, callable, profile, profiler):
+        self.callable = callable
+        self.profile = profile
+        self.profiler = profiler
 
+    def call(self, parser, args):
+        profile = self.profile
+        profiler = self.profiler
+        pos = parser.pos
+        profile.active += 1
+        profiler.children.append(0.0)
+        start = time.perf_counter()
+
+        result = self.callable.call(parser, args)
+
+        elapsed = time.perf_counter() - start
+        children = profiler.children.pop()
+        profile.active -= 1
+        profile.calls += 1
+        profile.exclusive += elapsed - children
+        if not profile.active:
+            profile.inclusive += elapsed
+        if profiler.children:
+            profiler.children[-1] += elapsed
+        if parser.ok:
+            profile.successes += 1
+            profile.consumed += parser.pos - pos
+        else:
+            profile.failures += 1
+        return result
 
-class Parser(object):
+    def __repr__(self):
+        return 'ProfiledCallable(%r)' % self.callable
+
+
+# Gathers statistics about each rule and each alternative of each choice.
+class RuleProfiler(object):
     def __init__(self):
         self.rules = {}
+        self.callables = {}
+        self.alternatives = []
+        # (rule name, choice, index) => AlternativeProfile, so relinking the parser keeps counting in the same place.
+        self.alternativeProfiles = {}
+        self.choices = {}
+        # The time spent in called rules, for each active invocation.
+        self.children = []
+
+    def wrap(self, callable):
+        wrapped = self.callables.get(callable.name)
+        if wrapped is None or wrapped.callable is not callable:
+            profile = self.rules.get(callable.name)
+            if profile is None:
+                profile = RuleProfile(callable.name)
+                self.rules[callable.name] = profile
+            wrapped = ProfiledCallable(callable, profile, self)
+            self.callables[callable.name] = wrapped
+        return wrapped
+
+    def instrumentRule(self, rule):
+        self.choices[rule.name] = 0
+
+    # The choice belongs to the parser's linked copy of the rule, so it can be modified.
+    def instrumentChoice(self, node, rule):
+        choice = self.choices[rule.name]
+        self.choices[rule.name] = choice + 1
+        children = []
+        for i, child in enumerate(node.children):
+            key = (rule.name, choice, i)
+            profile = self.alternativeProfiles.get(key)
+            if profile is None:
+                profile = AlternativeProfile(rule.name, choice, i)
+                self.alternativeProfiles[key] = profile
+                self.alternatives.append(profile)
+            children.append(ProfiledAlternative(child, profile))
+        node.children = children
+        if isinstance(node, SwitchChoice):
+            node.bounds, node.table, node.eos = build_switch(node, children)
+
+    def top(self, limit=10, key='exclusive'):
+        profiles = sorted(self.rules.values(), key=lambda profile: getattr(profile, key), reverse=True)
+        return [profile for profile in profiles[:limit] if profile.calls]
+
+    def topBacktracks(self, limit=10):
+        alternatives = sorted(self.alternatives, key=lambda profile: profile.backtracks, reverse=True)
+        return [profile for profile in alternatives[:limit] if profile.backtracks]
+
+    def report(self, limit=10):
+        lines = ['%-25s %8s %8s %8s %10s %10s %10s' % ('rule', 'calls', 'ok', 'failed', 'consumed', 'incl ms', 'excl ms')]
+        for profile in self.top(limit):
+            lines.append('%-25s %8d %8d %8d %10d %10.2f %10.2f' % (profile.name, profile.calls, profile.successes, profile.failures, profile.consumed, profile.inclusive * 1e3, profile.exclusive * 1e3))
+        lines.append('')
+        lines.append('%-25s %8s %8s %8s' % ('alternative', 'choice', 'tried', 'failed'))
+        for profile in self.topBacktracks(limit):
+            lines.append('%-25s %8d %8d %8d' % ('%s[%d]' % (profile.rule, profile.index), profile.choice, profile.attempts, profile.backtracks))
+        return '\n'.join(lines)
+
+
+# Append modifies lists in place, so memoized lists are copied rather than shared with the caller.
+def unshared(value):
+    return list(value) if isinstance(value, list) else value
+
+
+class MemoEntry(object):
+    __slots__ = ['args', 'result', 'end', 'ok', 'deepest', 'deepest_name', 'extent']
+
+    def __init__(self, args, result, end, ok, deepest, deepest_name, extent):
+        # Holding onto the arguments keeps their ids from being reused while the entry is live.
+        self.args = args
+        self.result = result
+        self.end = end
+        self.ok = ok
+        self.deepest = deepest
+        self.deepest_name = deepest_name
+        # One past the last character the invocation depended on.
+        self.extent = extent
+
+
+def is_location(t):
+    if isinstance(t, base.NullableType):
+        t = t.t
+    return isinstance(t, base.NamedType) and t.name == 'location'
+
+
+# Shift the location fields of trees reachable from "value" that are at or after "start".
+# Each object is only shifted once, no matter how many times it is reached.
+def relocate(value, start, delta, visited):
+    pending = [value]
+    while pending:
+        value = pending.pop()
+        if isinstance(value, list):
+            if id(value) not in visited:
+                visited.add(id(value))
+                pending.extend(value)
+            continue
+        fields = getattr(type(value), '__fields__', None)
+        if fields is None or id(value) in visited:
+            continue
+        visited.add(id(value))
+        for f in fields:
+            child = getattr(value, f.name)
+            if is_location(f.t):
+                if child is not None and child >= start:
+                    setattr(value, f.name, child + delta)
+            elif 'backedge' not in f.attrs:
+                pending.append(child)
+
+
+# Packrat memo table.
+# Maps (rule, argument identities, position) to the outcome of invoking the rule.
+# If a window is specified, entries that start more than "window" characters
+# before the most recent invocation are evicted to bound memory use.
+class PackratMemo(object):
+    def __init__(self, stats, window=None):
+        self.stats = stats
+        self.window = window
+        self.table = {}
+        self.low = 0
+
+        # The parse that filled the table, so it can be repeated after an edit.
+        self.name = None
+        self.args = None
+        self.text = None
+        self.loc = 0
+        self.must_consume_everything = False
+        self.result = None
+
+    def lookup(self, rule, args, pos):
+        entries = self.table.get(pos)
+        if entries is None:
+            return None
+        return entries.get((rule, tuple(map(id, args))))
+
+    def store(self, rule, args, pos, entry):
+        if pos < self.low:
+            # The invocation started before the window, so it would never be evicted.
+            self.stats.memo_evictions += 1
+            return
+        entries = self.table.get(pos)
+        if entries is None:
+            entries = {}
+            self.table[pos] = entries
+        entries[(rule, tuple(map(id, args)))] = entry
+        if self.window is not None:
+            self.evict(pos - self.window)
+
+    def evict(self, limit):
+        while self.low < limit:
+            entries = self.table.pop(self.low, None)
+            if entries:
+                self.stats.memo_evictions += len(entries)
+            self.low += 1
+
+    # Replace "removed" characters at "offset" with "inserted".
+    # Entries that depended on the replaced characters are dropped, entries
+    # before the edit are kept as is, and entries after the edit are moved.
+    # Note: trees produced by moved entries are updated in place.
+    def edit(self, offset, removed, inserted):
+        assert 0 <= offset and removed >= 0 and offset + removed <= len(self.text), (offset, removed)
+        limit = offset + removed
+        delta = len(inserted) - removed
+
+        table = {}
+        visited = set()
+        for pos, entries in self.table.items():
+            for key, entry in entries.items():
+                if entry.extent <= offset:
+                    start = pos
+                elif pos >= limit:
+                    start = pos + delta
+                    entry.end += delta
+                    entry.extent += delta
+                    if entry.deepest >= 0:
+                        entry.deepest += delta
+                    relocate(entry.args, limit + self.loc, delta, visited)
+                    relocate(entry.result, limit + self.loc, delta, visited)
+                else:
+                    self.stats.memo_invalidations += 1
+                    continue
+                if start not in table:
+                    table[start] = {}
+                table[start][key] = entry
+
+        self.table = table
+        self.low = min(self.low, offset)
+        self.text = self.text[:offset] + inserted + self.text[limit:]
+        self.result = None
+
+    def call(self, rule, parser, args):
+        pos = parser.pos
+        entry = self.lookup(rule, args, pos)
+        if entry is not None:
+            self.stats.memo_hits += 1
+            parser.pos = entry.end
+            parser.ok = entry.ok
+            if entry.deepest > parser.deepest:
+                parser.deepest = entry.deepest
+                parser.deepest_name = entry.deepest_name
+            if entry.extent > parser.examined:
+                parser.examined = entry.extent
+            return unshared(entry.result)
+        self.stats.memo_misses += 1
+
+        # Track the deepest failure inside this invocation separately so it can be replayed.
+        deepest = parser.deepest
+        deepest_name = parser.deepest_name
+        examined = parser.examined
+        outer_deepest = parser.outer_deepest
+        if deepest > outer_deepest:
+            parser.outer_deepest = deepest
+        parser.deepest = -1
+        parser.examined = 0
+
+        result = rule.invoke(parser, args)
+        parser.outer_deepest = outer_deepest
+
+        extent = max(parser.pos, parser.deepest + 1, parser.examined)
+        entry = MemoEntry(args, unshared(result), parser.pos, parser.ok, parser.deepest, parser.deepest_name, extent)
+        self.store(rule, args, pos, entry)
+
+        if deepest >= parser.deepest:
+            parser.deepest = deepest
+            parser.deepest_name = deepest_name
+        parser.examined = max(examined, extent)
+        return result
+
+
+class StackFrame(object):
+    __slots__ = ['name', 'names', 'scope', 'blank', 'pool']
+
+    def __init__(self, rule):
+        self.name = rule.name
+        self.names = rule.names
+        self.scope = [UNBOUND] * len(rule.names)
+        self.blank = [UNBOUND] * len(rule.names)
+        self.pool = rule.pool
+
+
+class Parser(object):
+    def __init__(self, profiler=None):
+        self.rules = {}
+        # The linked copies of the rules, and the natives.
+        self.callables = {}
+        self.linked = False
+        self.packrat = False
+        self.packrat_window = None
+        self.memo = None
+        self.stats = ParseStats()
+        self.profiler = profiler
+
+    # Memoize rule invocations for subsequent parses.
+    # Note: memoized lists are copied, but anything else is shared between call sites and should not be mutated.
+    def enablePackrat(self, window=None):
+        self.packrat = True
+        self.packrat_window = window
+
+    # Gather statistics about every rule invocation and choice.
+    # Only the parser's own linked copy of the grammar is instrumented.
+    def enableProfiling(self, profiler=None):
+        self.profiler = profiler if profiler is not None else RuleProfiler()
+        self.linked = False
+        return self.profiler
 
     def rule(self, rule):
         assert rule.name not in self.rules
         self.rules[rule.name] = rule
+        self.linked = False
+
+    # The callable a name refers to, as it should be invoked.
+    def lookup(self, name):
+        target = self.callables.get(name)
+        if target is not None and self.profiler is not None:
+            target = self.profiler.wrap(target)
+        return target
+
+    def link(self):
+        if not self.linked:
+            self.callables = {}
+            for name, rule in self.rules.items():
+                if isinstance(rule, Rule):
+                    rule = Rule(rule.name, rule.params, copyMatcher(rule.body))
+                self.callables[name] = rule
+            for rule in self.callables.values():
+                if isinstance(rule, Rule):
+                    linkRule(rule, self)
+            self.linked = True
 
     def hasNext(self):
-        return self.pos < len(self.stream)
+        return self.pos < self.end or self.source is not None and self.fill()
+
+    def fill(self):
+        self.keepDeepest()
+        more = self.source.fill(self.pos)
+        self.end = self.source.end
+        return more
+
+    # The deepest failure may be reported as the error, so its line must not be released.
+    # Memoized invocations hide the deepest failure outside of them while they track their own,
+    # and lookaheads restore the deepest failure from before them.
+    def keepDeepest(self):
+        self.source.keep = min(max(self.deepest, self.outer_deepest), self.restored_deepest)
 
     def peek(self):
         return self.stream[self.pos]
@@ -352,23 +1033,43 @@ class Parser(object):
     def fail(self):
         if self.pos > self.deepest:
             self.deepest = self.pos
-            self.deepest_name = self.stack[-1].name if self.stack else '<EOS>'
+            self.deepest_name = self.rule_name
         self.ok = False
         #self.printStack()
 
+    def recordFailure(self, name):
+        if self.pos > self.deepest:
+            self.deepest = self.pos
+            self.deepest_name = name
+
     def recover(self, pos):
         self.pos = pos
         self.ok = True
 
-    def enterFrame(self, name):
-        self.stack.append(StackFrame(name))
+    def enterFrame(self, rule, args):
+        pool = rule.pool
+        if pool:
+            frame = pool.pop()
+        else:
+            frame = StackFrame(rule)
+            self.stats.frame_allocations += 1
+        if args:
+            # Parameters occupy the first slots of the frame.
+            frame.scope[:len(args)] = args
+        self.stack.append(frame)
+        self.locals = frame.scope
 
     def exitFrame(self):
-        self.stack.pop()
+        frame = self.stack.pop()
+        # Drop the values so they can be collected, then recycle the frame.
+        frame.scope[:] = frame.blank
+        frame.pool.append(frame)
+        self.locals = self.stack[-1].scope if self.stack else None
 
     def printStack(self):
         for frame in reversed(self.stack):
-            print('    %-25s %r' % (frame.name, frame.scope))
+            scope = dict([(name, value) for name, value in zip(frame.names, frame.scope) if value is not UNBOUND])
+            print('    %-25s %r' % (frame.name, scope))
 
     def internalError(self, node, msg):
         print(msg)
@@ -380,26 +1081,70 @@ class Parser(object):
         info = location.extractLocationInfo(self.stream, self.deepest)
         return '%d:%d @ %s (%s)\n%s\n%s' % (info.line, info.column, info.character, self.deepest_name, info.text, info.arrow)
 
+    # The text may be a str, or a chunked.ChunkedStream to read large inputs incrementally.
     def parse(self, name, args, text, loc=0, must_consume_everything=False):
         assert isinstance(name, str), type(name)
-        assert isinstance(text, str), type(text)
+        assert isinstance(text, (str, chunked.ChunkedStream)), type(text)
         assert isinstance(loc, int), type(loc)
+        args = list(args)
+        memo = None
+        if self.packrat:
+            memo = PackratMemo(self.stats, self.packrat_window)
+            memo.name = name
+            memo.args = args
+            memo.loc = loc
+            memo.must_consume_everything = must_consume_everything
+        return self.run(name, args, text, loc, must_consume_everything, memo)
+
+    # Parse the text again after replacing "removed" characters at "offset" with "inserted".
+    # Only the rule invocations that depended on the replaced characters are repeated;
+    # the rest are taken from the memo table of the previous parse and shifted.
+    # Note: the previous result shares trees with the new result, and is invalidated.
+    def reparse(self, previous, memo, offset, removed, inserted):
+        assert previous is memo.result, 'memo table does not belong to the previous result'
+        assert isinstance(memo.text, str), 'cannot reparse a chunked stream'
+        assert isinstance(inserted, str), type(inserted)
+        memo.edit(offset, removed, inserted)
+        return self.run(memo.name, memo.args, memo.text, memo.loc, memo.must_consume_everything, memo)
+
+    def run(self, name, args, text, loc, must_consume_everything, memo):
         self.stream = text
+        if isinstance(text, chunked.ChunkedStream):
+            self.source = text
+            self.end = text.end
+        else:
+            self.source = None
+            self.end = len(text)
         self.pos_offset = loc
         self.pos = 0
         self.deepest = 0
         self.deepest_name = '<EOS>'
+        self.rule_name = '<EOS>'
+        self.outer_deepest = -1
+        self.restored_deepest = sys.maxsize
+        self.examined = 0
         self.ok = True
         self.stack = []
-        result = self.rules[name].call(self, args)
+        self.locals = None
+        self.link()
+        self.memo = memo
+        result = self.lookup(name).call(self, args)
         if self.hasNext() and must_consume_everything:
             self.fail()
         pos = self.pos
         error_scope = None
-        info = None
+        source = None
         if not self.ok:
             result = None
             pos = 0
             error_scope = self.deepest_name
-            info = location.extractLocationInfo(name, self.stream, self.deepest)
-        return ParseResult(result, pos, self.ok, error_scope, info, self.deepest + loc)
+            if self.source is None:
+                source = location.SourceText(name, self.stream, loc)
+        out = ParseResult(result, pos, self.ok, error_scope, self.deepest + loc, source)
+        if not self.ok and self.source is not None:
+            # The stream may not be readable later, so find the location now.
+            out.info = self.source.extractLocationInfo(name, self.deepest)
+        if memo is not None:
+            memo.text = text
+            memo.result = out
+        return out
@@ -0,0 +1,108 @@
+import bisect
+import codecs
+
+from . import location
+
+
+class StreamError(Exception):
+    pass
+
+
+# Text that is read incrementally from a file object or mmap, for Parser.parse.
+# Only the characters within "window" of the furthest position read are retained,
+# so backtracking further than that is an error.
+# The line of the current position and of the deepest failure are retained as well, for error messages.
+class ChunkedStream(object):
+    def __init__(self, f, chunk_size=1 << 16, window=1 << 20, encoding='utf-8'):
+        assert chunk_size > 0, chunk_size
+        assert window > 0, window
+        self.f = f
+        self.chunk_size = chunk_size
+        self.window = window
+        self.encoding = encoding
+        self.decoder = None
+        self.eof = False
+
+        # The retained text starts at "base" and ends at "end".
+        self.buffer = ''
+        self.base = 0
+        self.end = 0
+
+        # The start of every line seen so far, so locations can be found after the text is released.
+        self.line_starts = [0]
+
+        # The lowest position the parser's deepest failure can still be reported at.
+        self.keep = None
+
+    def read(self):
+        data = self.f.read(self.chunk_size)
+        if not data:
+            self.eof = True
+        if isinstance(data, str):
+            return data
+        # mmap objects and binary files produce bytes, which may split a character.
+        if self.decoder is None:
+            self.decoder = codecs.getincrementaldecoder(self.encoding)()
+        return self.decoder.decode(data, final=self.eof)
+
+    def release(self, limit):
+        if limit > self.base:
+            self.buffer = self.buffer[limit - self.base:]
+            self.base = limit
+
+    def line_start_of(self, pos):
+        return self.line_starts[bisect.bisect_right(self.line_starts, pos) - 1]
+
+    # Read until the character at "pos" is available.
+    # Returns False if the stream ends before "pos".
+    def fill(self, pos):
+        while pos >= self.end and not self.eof:
+            text = self.read()
+            if not text:
+                continue
+            keep = pos if self.keep is None else min(pos, self.keep)
+            self.release(min(min(pos, self.end) - self.window, self.line_start_of(keep)))
+            i = text.find('\n')
+            while i >= 0:
+                self.line_starts.append(self.end + i + 1)
+                i = text.find('\n', i + 1)
+            self.buffer += text
+            self.end += len(text)
+        return pos < self.end
+
+    def check(self, pos):
+        if pos < self.base:
+            raise StreamError('Position %d has been released, backtracked more than %d characters' % (pos, self.window))
+
+    def __getitem__(self, index):
+        base = self.base
+        if isinstance(index, slice):
+            self.check(index.start)
+            return self.buffer[index.start - base:index.stop - base]
+        self.check(index)
+        return self.buffer[index - base]
+
+    # Returns the end of the run of characters in "classifier" starting at pos, reading as needed.
+    def scan(self, classifier, pos, limit=None):
+        self.check(pos)
+        while True:
+            end = self.end if limit is None else min(limit, self.end)
+            pos = classifier.scan(self.buffer, pos - self.base, end - self.base) + self.base
+            if pos < end or pos == limit or not self.fill(pos):
+                return pos
+
+    def extractLocationInfo(self, filename, pos):
+        # Make sure the whole line is available.
+        self.keep = pos
+        while not self.eof and self.line_starts[-1] <= pos:
+            self.fill(self.end)
+        line = bisect.bisect_right(self.line_starts, pos)
+        line_start = self.line_starts[line - 1]
+        if pos < self.base:
+            return location.LocationInfo(filename, line, pos - line_start, '<released>', '', '')
+
+        # The start of the line may have been released.
+        start = max(line_start, self.base)
+        info = location.extractLineInfo(filename, self.buffer, pos - self.base, line, start - self.base)
+        info.column += start - line_start
+        return info
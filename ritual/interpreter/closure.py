@@ -0,0 +1,452 @@
+import bisect
+
+from ritual.base import TypeDispatcher, dispatch
+from ritual import interpreter
+from ritual.interpreter import runtime
+
+
+UNBOUND = interpreter.UNBOUND
+EMPTY_FRAME = ()
+
+
+class CompiledRule(interpreter.Callable):
+    __slots__ = ['name', 'params', 'slots', 'body']
+
+    def __init__(self, name, params, names):
+        self.name = name
+        self.params = params
+        self.slots = {}
+        for slot in names:
+            self.slots[slot] = len(self.slots)
+        self.body = None
+
+    def call(self, parser, args):
+        if len(args) != len(self.params):
+            parser.internalError(self, 'Expected %d arguments for %s, got %d' % (len(self.params), self.name, len(args)))
+        size = len(self.slots)
+        if size:
+            frame = list(args)
+            frame.extend([UNBOUND] * (size - len(args)))
+        else:
+            frame = EMPTY_FRAME
+        return self.body(parser, frame)
+
+    def __repr__(self):
+        return 'CompiledRule(%r)' % self.name
+
+
+class RuleContext(object):
+    def __init__(self, compiler, rule):
+        self.compiler = compiler
+        self.rule = rule
+        self.name = rule.name
+        self.slots = rule.slots
+
+    def lookup(self, name):
+        return self.compiler.callables.get(name)
+
+
+def call_value(parser, node, value, args):
+    if isinstance(value, interpreter.Callable):
+        return value.call(parser, args)
+    parser.internalError(node, 'Cannot call %r' % (value,))
+
+
+def make_fail(name):
+    def fail(p):
+        if p.pos > p.deepest:
+            p.deepest = p.pos
+            p.deepest_name = name
+        p.ok = False
+    return fail
+
+
+class CompileMatcher(object, metaclass=TypeDispatcher):
+
+    @dispatch(interpreter.Sequence)
+    def visitSequence(cls, node, ctx):
+        children = tuple([cls.visit(child, ctx) for child in node.children])
+        if not children:
+            return lambda p, frame: None
+        elif len(children) == 1:
+            return children[0]
+        elif len(children) == 2:
+            first, second = children
+            def match(p, frame):
+                result = first(p, frame)
+                if not p.ok:
+                    return result
+                return second(p, frame)
+            return match
+
+        def match(p, frame):
+            result = None
+            for m in children:
+                result = m(p, frame)
+                if not p.ok:
+                    return result
+            return result
+        return match
+
+    @dispatch(interpreter.Choice)
+    def visitChoice(cls, node, ctx):
+        children = tuple([cls.visit(child, ctx) for child in node.children])
+        fail = make_fail(ctx.name)
+
+        def match(p, frame):
+            result = None
+            pos = p.pos
+            for m in children:
+                result = m(p, frame)
+                if p.ok:
+                    return result
+                p.pos = pos
+                p.ok = True
+            fail(p)
+            return result
+        return match
+
+    @dispatch(interpreter.SwitchChoice)
+    def visitSwitchChoice(cls, node, ctx):
+        children = [cls.visit(child, ctx) for child in node.children]
+        bounds, table, eos = interpreter.build_switch(node, children)
+
+        # Resolve how each case fails ahead of time.
+        def bind_failure(case):
+            steps, tail = case
+            return steps, make_fail(ctx.name if tail is None else tail)
+        table = [bind_failure(case) for case in table]
+        eos = bind_failure(eos)
+
+        def match(p, frame):
+            result = None
+            pos = p.pos
+            if pos < p.end:
+                steps, fail = table[bisect.bisect_right(bounds, ord(p.stream[pos])) - 1]
+            else:
+                steps, fail = eos
+            for name, m in steps:
+                if name is not None and pos > p.deepest:
+                    p.deepest = pos
+                    p.deepest_name = name
+                result = m(p, frame)
+                if p.ok:
+                    return result
+                p.pos = pos
+                p.ok = True
+            fail(p)
+            return result
+        return match
+
+    @classmethod
+    def scanCharacters(cls, node, ctx):
+        scan = node.expr.classifier.scan
+        fail = make_fail(ctx.name)
+        min_count = node.min
+        max_count = node.max
+
+        def match(p, frame):
+            pos = p.pos
+            end = p.end
+            if max_count > 0 and pos + max_count < end:
+                end = pos + max_count
+            p.pos = scan(p.stream, pos, end)
+            count = p.pos - pos
+            if count < max_count or max_count <= 0:
+                fail(p)
+            if count >= min_count:
+                p.ok = True
+        return match
+
+    @dispatch(interpreter.Repeat)
+    def visitRepeat(cls, node, ctx):
+        if type(node.expr) is interpreter.Character:
+            return cls.scanCharacters(node, ctx)
+
+        expr = cls.visit(node.expr, ctx)
+        min_count = node.min
+        max_count = node.max
+
+        if min_count == 0 and max_count <= 0:
+            def match(p, frame):
+                while True:
+                    pos = p.pos
+                    expr(p, frame)
+                    if not p.ok:
+                        p.pos = pos
+                        p.ok = True
+                        return
+            return match
+
+        def match(p, frame):
+            count = 0
+            while count < min_count:
+                expr(p, frame)
+                if not p.ok:
+                    return
+                count += 1
+
+            while count < max_count or max_count <= 0:
+                pos = p.pos
+                expr(p, frame)
+                if not p.ok:
+                    p.pos = pos
+                    p.ok = True
+                    return
+                count += 1
+        return match
+
+    @dispatch(interpreter.Call)
+    def visitCall(cls, node, ctx):
+        args = tuple([cls.visit(arg, ctx) for arg in node.args])
+        target = None
+        if isinstance(node.expr, interpreter.Get) and node.expr.name not in ctx.slots:
+            target = ctx.lookup(node.expr.name)
+
+        if isinstance(target, CompiledRule):
+            if len(args) != len(target.params):
+                def match(p, frame):
+                    p.internalError(node, 'Expected %d arguments for %s, got %d' % (len(target.params), target.name, len(args)))
+                return match
+
+            size = len(target.slots)
+            padding = size - len(args)
+            if not args:
+                if size:
+                    return lambda p, frame: target.body(p, [UNBOUND] * size)
+                else:
+                    return lambda p, frame: target.body(p, EMPTY_FRAME)
+
+            def match(p, frame):
+                values = []
+                for arg in args:
+                    value = arg(p, frame)
+                    if not p.ok:
+                        return value
+                    values.append(value)
+                if padding:
+                    values.extend([UNBOUND] * padding)
+                return target.body(p, values)
+            return match
+
+        elif isinstance(target, interpreter.Native):
+            func = target.func
+            if len(args) != len(target.params):
+                def match(p, frame):
+                    p.internalError(node, 'Expected %d arguments for %s, got %d' % (len(target.params), target.name, len(args)))
+                return match
+
+            def match(p, frame):
+                values = []
+                for arg in args:
+                    value = arg(p, frame)
+                    if not p.ok:
+                        return value
+                    values.append(value)
+                return func(*values)
+            return match
+
+        expr = cls.visit(node.expr, ctx)
+
+        def match(p, frame):
+            value = expr(p, frame)
+            if not p.ok:
+                return value
+            values = []
+            for arg in args:
+                v = arg(p, frame)
+                if not p.ok:
+                    return v
+                values.append(v)
+            return call_value(p, node, value, values)
+        return match
+
+    @dispatch(interpreter.Character)
+    def visitCharacter(cls, node, ctx):
+        test = node.classifier.contains
+        fail = make_fail(ctx.name)
+
+        def match(p, frame):
+            pos = p.pos
+            if pos >= p.end:
+                fail(p)
+                return
+            c = p.stream[pos]
+            if test(c):
+                p.pos = pos + 1
+            else:
+                fail(p)
+            return c
+        return match
+
+    @dispatch(interpreter.MatchValue)
+    def visitMatchValue(cls, node, ctx):
+        expr = cls.visit(node.expr, ctx)
+        fail = make_fail(ctx.name)
+
+        def match(p, frame):
+            value = expr(p, frame)
+            if not p.ok:
+                return value
+            pos = p.pos
+            if p.stream.startswith(value, pos):
+                p.pos = pos + len(value)
+                return value
+            # Find where the mismatch occurred so the failure is reported in the right place.
+            for c in value:
+                if pos >= p.end or p.stream[pos] != c:
+                    break
+                pos += 1
+            p.pos = pos
+            fail(p)
+        return match
+
+    @dispatch(interpreter.Lookahead)
+    def visitLookahead(cls, node, ctx):
+        expr = cls.visit(node.expr, ctx)
+        invert = node.invert
+        fail = make_fail(ctx.name)
+
+        def match(p, frame):
+            pos = p.pos
+            deepest = p.deepest
+            deepest_name = p.deepest_name
+
+            result = expr(p, frame)
+
+            p.pos = pos
+            p.deepest = deepest
+            p.deepest_name = deepest_name
+
+            if invert:
+                if p.ok:
+                    fail(p)
+                else:
+                    p.ok = True
+                return
+            else:
+                return result
+        return match
+
+    @dispatch(interpreter.Slice)
+    def visitSlice(cls, node, ctx):
+        expr = cls.visit(node.expr, ctx)
+
+        def match(p, frame):
+            pos = p.pos
+            result = expr(p, frame)
+            if p.ok:
+                result = p.stream[pos:p.pos]
+            return result
+        return match
+
+    @dispatch(interpreter.Get)
+    def visitGet(cls, node, ctx):
+        name = node.name
+        global_value = ctx.lookup(name)
+        if name in ctx.slots:
+            index = ctx.slots[name]
+
+            def match(p, frame):
+                value = frame[index]
+                if value is UNBOUND:
+                    if global_value is None:
+                        p.internalError(node, 'Unbound name %r' % name)
+                    return global_value
+                return value
+            return match
+        elif global_value is not None:
+            return lambda p, frame: global_value
+        else:
+            def match(p, frame):
+                p.internalError(node, 'Unbound name %r' % name)
+            return match
+
+    @dispatch(interpreter.Set)
+    def visitSet(cls, node, ctx):
+        expr = cls.visit(node.expr, ctx)
+        index = ctx.slots[node.name]
+
+        def match(p, frame):
+            result = expr(p, frame)
+            if p.ok:
+                if isinstance(result, interpreter.Callable):
+                    p.internalError(node, 'Should not be storing a Callable to %r: %r' % (node.name, result))
+                frame[index] = result
+            return result
+        return match
+
+    @dispatch(interpreter.Append)
+    def visitAppend(cls, node, ctx):
+        expr = cls.visit(node.expr, ctx)
+        index = ctx.slots[node.name]
+        name = node.name
+
+        def match(p, frame):
+            result = expr(p, frame)
+            if p.ok:
+                if isinstance(result, interpreter.Callable):
+                    p.internalError(node, 'Should not be storing a Callable to %r: %r' % (name, result))
+                tgt = frame[index]
+                if tgt is UNBOUND:
+                    p.internalError(node, 'Unbound name %r' % name)
+                if not isinstance(tgt, list):
+                    p.internalError(node, 'Append target %r is a %r and not a list' % (name, type(tgt)))
+                tgt.append(result)
+            return result
+        return match
+
+    @dispatch(interpreter.List)
+    def visitList(cls, node, ctx):
+        args = tuple([cls.visit(arg, ctx) for arg in node.args])
+        if not args:
+            return lambda p, frame: []
+
+        def match(p, frame):
+            values = []
+            for arg in args:
+                value = arg(p, frame)
+                if not p.ok:
+                    return value
+                values.append(value)
+            return values
+        return match
+
+    @dispatch(interpreter.Literal)
+    def visitLiteral(cls, node, ctx):
+        value = node.value
+        return lambda p, frame: value
+
+    @dispatch(interpreter.Location)
+    def visitLocation(cls, node, ctx):
+        return lambda p, frame: p.pos + p.pos_offset
+
+
+class ParserCompiler(object):
+    def __init__(self, parser):
+        self.parser = parser
+        self.callables = {}
+
+    def compile(self):
+        # Create all the rules up front so calls can be bound directly, even when recursive.
+        rules = []
+        for name, rule in self.parser.rules.items():
+            if isinstance(rule, interpreter.Rule):
+                compiled = CompiledRule(name, rule.params, interpreter.ruleLocals(rule))
+                self.callables[name] = compiled
+                rules.append((rule, compiled))
+            else:
+                self.callables[name] = rule
+
+        for rule, compiled in rules:
+            compiled.body = CompileMatcher.visit(rule.body, RuleContext(self, compiled))
+
+        out = runtime.CompiledParser()
+        out.rules.update(self.callables)
+        return out
+
+
+# Translate the rules of an interpreter.Parser into nested Python closures.
+# The result has the same parse() interface as the Parser it was compiled from.
+def compileParser(parser):
+    return ParserCompiler(parser).compile()
@@ -1,3 +1,4 @@
+import bisect
 import traceback
 import sys
 
@@ -8,24 +9,15 @@ class LocationInfo(object, metaclass=base.TreeMeta):
     __schema__ = 'filename:string line:int column:int character:string text:string arrow:string'
 
 
-def extractLocationInfo(filename, stream, pos):
-    line = 1
-    line_start = 0
-    tabs = 0
-    for i in range(0, pos):
-        if stream[i] == '\n':
-            line += 1
-            line_start = i + 1
-            tabs = 0
-        elif stream[i] == '\t':
-            tabs += 1
-    line_end = pos
-    while line_end < len(stream) and stream[line_end] != '\n':
-        line_end += 1
+# Describe "pos", given the line it is on and where that line starts.
+def extractLineInfo(filename, stream, pos, line, line_start):
+    line_end = stream.find('\n', pos)
+    if line_end < 0:
+        line_end = len(stream)
 
     TAB_SIZE = 4
     text = stream[line_start:line_end].replace('\t', ' ' * TAB_SIZE)
-    col = pos - line_start + tabs * (TAB_SIZE - 1)
+    col = pos - line_start + stream.count('\t', line_start, pos) * (TAB_SIZE - 1)
 
     if pos < len(stream):
         c = repr(stream[pos])
@@ -35,6 +27,43 @@ def extractLocationInfo(filename, stream, pos):
     return LocationInfo(filename, line, col, c, text, ' '*col + '^')
 
 
+def extractLocationInfo(filename, stream, pos):
+    line = stream.count('\n', 0, pos) + 1
+    line_start = stream.rfind('\n', 0, pos) + 1
+    return extractLineInfo(filename, stream, pos, line, line_start)
+
+
+# The text of a source file, starting at location "begin".
+# The start of each line is indexed the first time a location is looked up,
+# after which finding the line of a location is a binary search.
+class SourceText(object):
+    def __init__(self, filename, text, begin=0):
+        self.filename = filename
+        self.text = text
+        self.begin = begin
+        self.end = begin + len(text) + 1 # For EOF
+        self.line_starts = None
+
+    def index_lines(self):
+        text = self.text
+        line_starts = [0]
+        i = text.find('\n')
+        while i >= 0:
+            line_starts.append(i + 1)
+            i = text.find('\n', i + 1)
+        self.line_starts = line_starts
+
+    def extract_location_info(self, loc):
+        if self.line_starts is None:
+            self.index_lines()
+        pos = loc - self.begin
+        line = bisect.bisect_right(self.line_starts, pos)
+        return extractLineInfo(self.filename, self.text, pos, line, self.line_starts[line - 1])
+
+    def __repr__(self):
+        return 'SourceText(%r, %d)' % (self.filename, self.begin)
+
+
 class HaltCompilation(Exception):
     pass
 
@@ -42,21 +71,23 @@ class HaltCompilation(Exception):
 class CompileStatus(object):
     def __init__(self, debug=False):
         self.sources = []
+        # The first location of each source, in ascending order.
+        self.begins = []
         self.loc = 0
         self.errors = 0
         self.debug = debug
 
     def add_source(self, filename, text):
-        loc = self.loc
-        self.loc += len(text) + 1 # For EOF
-        self.sources.append((loc, self.loc, filename, text))
-        return loc
+        source = SourceText(filename, text, self.loc)
+        self.loc = source.end
+        self.sources.append(source)
+        self.begins.append(source.begin)
+        return source.begin
 
     def extract_location_info(self, loc):
-        for begin, end, filename, text in self.sources:
-            if begin <= loc and loc < end:
-                return extractLocationInfo(filename, text, loc - begin)
-        assert False, loc
+        i = bisect.bisect_right(self.begins, loc) - 1
+        assert i >= 0 and loc < self.sources[i].end, loc
+        return self.sources[i].extract_location_info(loc)
 
     def error(self, msg, loc=None, trace=None):
         if loc is None:
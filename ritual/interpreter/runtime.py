@@ -0,0 +1,75 @@
+from ritual import interpreter
+from ritual.interpreter import location
+
+
+# Shared runtime state for parsers that do not walk interpreter trees.
+class CompiledParser(object):
+    def __init__(self):
+        self.rules = {}
+
+    def internalError(self, node, msg):
+        print(msg)
+        print(node)
+        raise Exception(msg)
+
+    def printStack(self):
+        pass
+
+    def parse(self, name, args, text, loc=0, must_consume_everything=False):
+        assert isinstance(name, str), type(name)
+        assert isinstance(text, str), type(text)
+        assert isinstance(loc, int), type(loc)
+        self.stream = text
+        self.end = len(text)
+        self.pos_offset = loc
+        self.pos = 0
+        self.deepest = 0
+        self.deepest_name = '<EOS>'
+        self.ok = True
+        result = self.rules[name].call(self, args)
+        if self.pos < self.end and must_consume_everything:
+            if self.pos > self.deepest:
+                self.deepest = self.pos
+                self.deepest_name = '<EOS>'
+            self.ok = False
+        pos = self.pos
+        error_scope = None
+        source = None
+        if not self.ok:
+            result = None
+            pos = 0
+            error_scope = self.deepest_name
+            source = location.SourceText(name, self.stream, loc)
+        return interpreter.ParseResult(result, pos, self.ok, error_scope, self.deepest + loc, source)
+
+    def rule(self, rule):
+        assert rule.name not in self.rules
+        self.rules[rule.name] = rule
+
+
+class FunctionRule(interpreter.Callable):
+    __slots__ = ['name', 'params', 'func']
+
+    def __init__(self, name, params, func):
+        self.name = name
+        self.params = params
+        self.func = func
+
+    def call(self, parser, args):
+        if len(args) != len(self.params):
+            parser.internalError(self, 'Expected %d arguments for %s, got %d' % (len(self.params), self.name, len(args)))
+        result, parser.pos, parser.ok = self.func(parser, parser.pos, *args)
+        return result
+
+    def __repr__(self):
+        return 'FunctionRule(%r)' % self.name
+
+
+def mismatch(stream, pos, value):
+    # Find where a failed literal match stopped.
+    end = len(stream)
+    for c in value:
+        if pos >= end or stream[pos] != c:
+            break
+        pos += 1
+    return pos
@@ -1,4 +1,10 @@
+import io
+import unittest
+
 from ritual.interpreter import *
+from ritual.interpreter import location
+from ritual.interpreter.chunked import ChunkedStream, StreamError
+from ritual.interpreter.closure import compileParser
 from ritual.interpreter.testutil import ParserTestCase
 
 class TestSimpleParser(ParserTestCase):
@@ -13,6 +19,10 @@ class TestSimpleParser(ParserTestCase):
         p.rule(Rule("word", [], Repeat(Get("letter")(), 1, 0)))
         p.rule(Rule("short_word", [], Repeat(Get("letter")(), 1, 3)))
         p.rule(Rule("maybe_word", [], Repeat(Get("letter")(), 0, 0)))
+        p.rule(Rule("greek", [], Character([Range(u'\u03b1', u'\u03c9'), Range('_', '_')], False)))
+        p.rule(Rule("run", [], Repeat(Character([Range('a', 'z'), Range('A', 'Z')], False), 1, 0)))
+        p.rule(Rule("hex4", [], Repeat(Character([Range('0', '9'), Range('a', 'f')], False), 4, 4)))
+        p.rule(Rule("line", [], Repeat(Character([Range('\n', '\n')], True), 0, 0)))
         self.parser = p
 
     def test_t_match(self):
@@ -68,6 +78,34 @@ class TestSimpleParser(ParserTestCase):
         self.p_ok("maybe_word", "")
         self.p_ok("maybe_word", "aardvark")
 
+    def test_greek(self):
+        self.p_ok("greek", u"\u03b1")
+        self.p_ok("greek", u"\u03bb")
+        self.p_ok("greek", "_")
+        self.p_fail("greek", u"\u0391")
+        self.p_fail("greek", "a")
+
+    def test_run(self):
+        self.p_ok("run", "aardvark")
+        self.p_ok("run", "AardVark")
+        self.p_fail("run", "")
+        self.p_fail("run", "aard vark")
+
+        self.p_ok("hex4", "00ff")
+        self.p_fail("hex4", "0ff")
+        self.p_fail("hex4", "00ff0")
+        self.p_fail("hex4", "00fg")
+
+        self.p_ok("line", "")
+        self.p_ok("line", u"caf\u00e9 [x]")
+        self.p_fail("line", "a\nb")
+
+    def test_run_error_location(self):
+        result = self.parser.parse("run", [], "abc!", must_consume_everything=True)
+        self.assertEqual(result.ok, False)
+        self.assertEqual(result.error_scope, "run")
+        self.assertEqual(result.loc, 3)
+
 
 class TestParserValues(ParserTestCase):
     def setUp(self):
@@ -79,3 +117,307 @@ class TestParserValues(ParserTestCase):
     def test_three(self):
         self.p_ok("three", "123", ["1", "2", "3"])
         self.p_fail("three", "12b")
+
+
+class TestCharacterClass(unittest.TestCase):
+    def test_contains(self):
+        c = CharacterClass([Range('m', 'z'), Range('a', 'n'), Range(u'\u00e0', u'\u00ff')], False)
+        for ch in u"amz\u00e0\u00ff":
+            self.assertTrue(c.contains(ch), ch)
+        for ch in u"A0\u00df\u0100":
+            self.assertFalse(c.contains(ch), ch)
+
+    def test_contains_inverted(self):
+        c = CharacterClass([Range(']', ']'), Range('-', '-'), Range('^', '^')], True)
+        self.assertTrue(c.contains('a'))
+        self.assertTrue(c.contains(u'\u2014'))
+        self.assertFalse(c.contains('^'))
+        self.assertFalse(c.contains(']'))
+
+    def test_scan(self):
+        c = CharacterClass([Range('0', '9')], False)
+        self.assertEqual(c.scan("ab1234cd", 2, 8), 6)
+        self.assertEqual(c.scan("ab1234cd", 2, 4), 4)
+        self.assertEqual(c.scan("ab1234cd", 0, 8), 0)
+        self.assertEqual(CharacterClass([], True).scan(u"x\ny", 0, 3), 3)
+        self.assertEqual(CharacterClass([], False).scan("xy", 0, 2), 0)
+
+
+class TestLocation(unittest.TestCase):
+    def test_source_text(self):
+        source = location.SourceText("f", "ab\n\tcd\n", 10)
+        self.assertIsNone(source.line_starts)
+        info = source.extract_location_info(15)
+        self.assertEqual(source.line_starts, [0, 3, 7])
+        self.assertEqual((info.line, info.column, info.character, info.text), (2, 5, repr("d"), "    cd"))
+        info = source.extract_location_info(17)
+        self.assertEqual((info.line, info.column, info.character), (3, 0, "<EOS>"))
+
+    def test_compile_status(self):
+        status = location.CompileStatus()
+        a = status.add_source("a", "x\ny")
+        b = status.add_source("b", "")
+        c = status.add_source("c", "\n\nz")
+        self.assertEqual((a, b, c), (0, 4, 5))
+        for loc, expected in [(0, ("a", 1, 0)), (2, ("a", 2, 0)), (3, ("a", 2, 1)), (4, ("b", 1, 0)), (7, ("c", 3, 0))]:
+            info = status.extract_location_info(loc)
+            self.assertEqual((info.filename, info.line, info.column), expected)
+
+    def test_lazy_parse_result(self):
+        p = Parser()
+        p.rule(Rule("t", [], MatchValue(Literal("true"))))
+        result = p.parse("t", [], "tr\nue", loc=5)
+        self.assertFalse(result.ok)
+        self.assertIsNone(result.info)
+        self.assertEqual(result.error_location().line, 1)
+        self.assertEqual(result.error_location().column, 2)
+
+
+class TestCompiledSimpleParser(TestSimpleParser):
+    def setUp(self):
+        super().setUp()
+        self.parser = compileParser(self.parser)
+
+
+class TestCompiledParserValues(TestParserValues):
+    def setUp(self):
+        super().setUp()
+        self.parser = compileParser(self.parser)
+
+
+class TestProfiledSimpleParser(TestSimpleParser):
+    def setUp(self):
+        super().setUp()
+        self.profiler = self.parser.enableProfiling()
+
+    def test_profile(self):
+        self.p_ok("b", "false")
+        self.p_fail("b", "maybe")
+        rules = self.profiler.rules
+        self.assertEqual((rules["b"].calls, rules["b"].successes, rules["b"].failures, rules["b"].consumed), (2, 1, 1, 5))
+        self.assertEqual((rules["t"].calls, rules["t"].failures), (2, 2))
+        self.assertEqual([(a.rule, a.choice, a.index, a.attempts, a.backtracks) for a in self.profiler.alternatives], [("b", 0, 0, 2, 2), ("b", 0, 1, 2, 1)])
+        self.assertGreaterEqual(rules["b"].inclusive, rules["b"].exclusive)
+        self.assertEqual(sorted([profile.name for profile in self.profiler.top(key='calls')]), ["b", "f", "t"])
+        self.assertIn("b[0]", self.profiler.report())
+
+    def test_compile_profiled(self):
+        self.p_ok("b", "true")
+        compiled = compileParser(self.parser)
+        self.assertTrue(compiled.parse("b", [], "false").ok)
+
+    def test_shared_rules(self):
+        plain = Parser()
+        for rule in self.parser.rules.values():
+            plain.rule(rule)
+        self.p_ok("b", "false")
+        self.assertTrue(plain.parse("b", [], "false").ok)
+        self.assertNotIsInstance(self.parser.rules["b"].body.children[0], ProfiledAlternative)
+        self.assertNotIsInstance(plain.callables["b"].body.children[0], ProfiledAlternative)
+        self.assertIsInstance(self.parser.callables["b"].body.children[0], ProfiledAlternative)
+
+        # Relinking keeps counting the same alternatives.
+        self.parser.rule(Rule("bb", [], Get("b")() & Get("b")()))
+        self.p_ok("bb", "truefalse")
+        self.assertEqual([(a.rule, a.choice, a.index, a.attempts, a.backtracks) for a in self.profiler.alternatives], [("b", 0, 0, 3, 2), ("b", 0, 1, 2, 0)])
+
+
+class ChunkedParser(object):
+    def __init__(self, parser, chunk_size):
+        self.parser = parser
+        self.chunk_size = chunk_size
+
+    def parse(self, name, args, text, **kwargs):
+        return self.parser.parse(name, args, ChunkedStream(io.StringIO(text), chunk_size=self.chunk_size), **kwargs)
+
+
+class TestChunkedSimpleParser(TestSimpleParser):
+    def setUp(self):
+        super().setUp()
+        self.parser = ChunkedParser(self.parser, 2)
+
+
+class TestChunkedParserValues(TestParserValues):
+    def setUp(self):
+        super().setUp()
+        self.parser = ChunkedParser(self.parser, 1)
+
+
+class TestChunkedStream(ParserTestCase):
+    def setUp(self):
+        p = Parser()
+        p.rule(Rule("letters", [], Slice(Repeat(Character([Range('a', 'z'), Range(u'\u03b1', u'\u03c9')], False), 0, 0))))
+        p.rule(Rule("line", [], Get("letters")() & MatchValue(Literal("\n"))))
+        p.rule(Rule("lines", [], Repeat(Get("line")(), 0, 0) & Get("letters")()))
+        p.rule(Rule("retry", [], Get("lines")() & MatchValue(Literal("!")) | Get("lines")()))
+        p.rule(Rule("peek", [], Get("letters")() & MatchValue(Literal("!")) | Lookahead(Get("lines")(), True)))
+        self.parser = p
+
+    def test_bytes(self):
+        text = u'\u03b1\u03b2c\nabc\n\u03c9'
+        stream = ChunkedStream(io.BytesIO(text.encode('utf-8')), chunk_size=3)
+        result = self.parser.parse("lines", [], stream, must_consume_everything=True)
+        self.assertTrue(result.ok)
+        self.assertEqual(result.value, u'\u03c9')
+
+    def test_release(self):
+        text = 'abc\n' * 100 + 'xyz'
+        stream = ChunkedStream(io.StringIO(text), chunk_size=8, window=16)
+        result = self.parser.parse("lines", [], stream, must_consume_everything=True)
+        self.assertEqual(result.value, 'xyz')
+        self.assertLessEqual(len(stream.buffer), 16 + 8)
+
+    def test_backtrack_past_window(self):
+        stream = ChunkedStream(io.StringIO('abc\n' * 100), chunk_size=8, window=16)
+        with self.assertRaises(StreamError):
+            self.parser.parse("retry", [], stream)
+
+    def test_error_location(self):
+        text = 'abc\n' * 50 + 'ab?c\nabc\n'
+        expected = self.parser.parse("lines", [], text, must_consume_everything=True)
+        stream = ChunkedStream(io.StringIO(text), chunk_size=8, window=16)
+        result = self.parser.parse("lines", [], stream, must_consume_everything=True)
+        self.assertFalse(result.ok)
+        self.assertEqual(result.loc, expected.loc)
+        self.assertEqual(result.error_message(), expected.error_message())
+
+    def test_error_before_release(self):
+        # The lookahead reads far past the deepest failure, which is in the first chunk.
+        text = 'abc\n' * 50
+        expected = self.parser.parse("peek", [], text)
+        for packrat in [False, True]:
+            self.parser.packrat = packrat
+            stream = ChunkedStream(io.StringIO(text), chunk_size=8, window=16)
+            result = self.parser.parse("peek", [], stream)
+            self.assertFalse(result.ok)
+            self.assertEqual(result.loc, 3)
+            self.assertEqual(result.error_message(), expected.error_message())
+
+
+class TestPackrat(ParserTestCase):
+    def setUp(self):
+        p = Parser()
+        p.rule(Rule("letter", [], Character([Range('a', 'z')], False)))
+        p.rule(Rule("word", [], Slice(Repeat(Get("letter")(), 1, 0))))
+        p.rule(Rule("statement", [],
+            Set(Get("word")(), "w") & MatchValue(Literal("!")) & Get("w")
+            | Set(Get("word")(), "w") & MatchValue(Literal("?")) & Get("w")
+        ))
+        p.enablePackrat()
+        self.parser = p
+
+    def test_memo_hit(self):
+        self.p_ok("statement", "abc?", "abc")
+        self.assertEqual(self.parser.stats.memo_hits, 1)
+        self.p_ok("statement", "abc!", "abc")
+        self.assertEqual(self.parser.stats.memo_hits, 1)
+
+    def test_error_location(self):
+        result = self.parser.parse("statement", [], "abc.")
+        self.parser.packrat = False
+        expected = self.parser.parse("statement", [], "abc.")
+        self.assertFalse(result.ok)
+        self.assertEqual(result.loc, expected.loc)
+        self.assertEqual(result.error_scope, expected.error_scope)
+
+    def test_window(self):
+        self.parser.enablePackrat(window=2)
+        self.p_ok("statement", "abcd?", "abcd")
+        self.assertGreater(self.parser.stats.memo_evictions, 0)
+        # "statement" finished after the window moved past its start, so it was not stored.
+        memo = self.parser.memo
+        self.assertTrue(all([pos >= memo.low for pos in memo.table]))
+
+    def test_unshared_list(self):
+        p = self.parser
+        p.rule(Rule("letters", [], Set(List([]), "l") & Append(Slice(Get("letter")()), "l") & Get("l")))
+        p.rule(Rule("marked", [],
+            Set(Get("letters")(), "l") & Append(Literal("!"), "l") & MatchValue(Literal("!")) & Get("l")
+            | Get("letters")()
+        ))
+        self.p_ok("marked", "a", ["a"])
+        self.assertEqual(p.stats.memo_hits, 1)
+
+    def test_reparse(self):
+        result = self.parser.parse("statement", [], "abc?")
+        memo = self.parser.memo
+        hits = self.parser.stats.memo_hits
+        result = self.parser.reparse(result, memo, 3, 1, "!")
+        self.assertTrue(result.ok)
+        self.assertEqual(result.value, "abc")
+        self.assertGreater(self.parser.stats.memo_hits, hits)
+
+        result = self.parser.reparse(result, memo, 1, 2, "")
+        self.assertEqual(memo.text, "a!")
+        self.assertEqual(result.value, "a")
+        self.assertGreater(self.parser.stats.memo_invalidations, 0)
+
+    def test_reparse_lookahead(self):
+        p = self.parser
+        p.rule(Rule("keyword", [], Slice(MatchValue(Literal("if")) & Lookahead(Get("letter")(), True))))
+        p.rule(Rule("name", [], Get("keyword")() | Get("word")()))
+        result = p.parse("name", [], "if", must_consume_everything=True)
+        self.assertEqual(result.value, "if")
+        # The lookahead examined the end of the text, so appending must invalidate the keyword.
+        result = p.reparse(result, p.memo, 2, 0, "x")
+        self.assertTrue(result.ok)
+        self.assertEqual(result.value, "ifx")
+
+
+class TestLocals(ParserTestCase):
+    def setUp(self):
+        p = Parser()
+        p.rule(Rule("letter", [], Slice(Character([Range('a', 'z')], False))))
+        # "letter" names the rule until the local is assigned.
+        p.rule(Rule("shadow", [], Set(Get("letter")(), "letter") & Get("letter")))
+        p.rule(Rule("pair", [Param("a")], Set(List([Get("a")]), "l") & Append(Get("letter")(), "l") & Get("l")))
+        p.rule(Rule("nested", [], Set(Get("letter")(), "x") & Get("pair")(Get("x"))))
+        self.parser = p
+
+    def test_slots(self):
+        self.p_ok("shadow", "q", "q")
+        self.p_ok("pair", "b", ["a", "b"], args=["a"])
+        self.p_ok("nested", "xy", ["x", "y"])
+        self.assertEqual(self.parser.callables["pair"].names, ["a", "l"])
+
+    def test_relink(self):
+        self.p_ok("nested", "xy", ["x", "y"])
+        self.parser.rule(Rule("twice", [], Get("nested")() & Get("nested")()))
+        self.p_ok("twice", "xyzw", ["z", "w"])
+
+    def test_unbound(self):
+        self.parser.rule(Rule("bad", [], Append(Get("letter")(), "l")))
+        with self.assertRaises(Exception):
+            self.parser.parse("bad", [], "a")
+
+    def test_frame_reuse(self):
+        self.p_ok("nested", "xy", ["x", "y"])
+        # "letter" has no locals and shares one frame, "nested" and "pair" need one each.
+        self.assertEqual(self.parser.stats.frame_allocations, 2)
+        self.p_ok("nested", "ab", ["a", "b"])
+        self.assertEqual(self.parser.stats.frame_allocations, 2)
+
+    def test_no_frame(self):
+        p = self.parser
+        p.enablePackrat()
+        p.rule(Native("depth", [], lambda: len(p.stack)))
+        p.rule(Rule("inner", [], Get("depth")()))
+        p.rule(Rule("outer", [], Set(Get("inner")(), "d") & Get("d")))
+        # Only "outer" has a local, memoized invocations of "inner" do not take a frame.
+        self.p_ok("outer", "", 1)
+        self.assertEqual(p.stats.frame_allocations, 1)
+        self.assertEqual(p.callables["inner"].pool, [])
+
+    def test_shared_rules(self):
+        # The same rule refers to a different "letter" in each parser.
+        word = Rule("word", [], Slice(Repeat(Get("letter")(), 1, 0)))
+        digits = Parser()
+        digits.rule(Rule("letter", [], Character([Range('0', '9')], False)))
+        digits.rule(word)
+        self.parser.rule(word)
+        self.p_ok("word", "abc", "abc")
+        self.assertTrue(digits.parse("word", [], "123", must_consume_everything=True).ok)
+        self.p_ok("word", "abc", "abc")
+        compileParser(digits)
+        self.p_ok("word", "abc", "abc")
+        self.assertEqual(word.names, [])
@@ -1,10 +1,10 @@
 import os.path
-import ritual.phase1.parser
+import ritual.phase1.cache
 
 base_file = os.path.join(os.path.dirname(__file__), 'base.ritual')
 
 
-def generate_parser(src_file, inject_base, glbls):
+def generate_parser(src_file, inject_base, glbls, functions=False):
     src = ''
     with open(src_file) as f:
         src += f.read()
@@ -14,4 +14,4 @@ def generate_parser(src_file, inject_base, glbls):
         src += '\n\n'
         with open(base_file) as f:
             src += f.read()
-    ritual.phase1.parser.compile(src_file, src, glbls)
\ No newline at end of file
+    return ritual.phase1.cache.compile_cached(src_file, src, glbls, functions)
\ No newline at end of file
@@ -1,6 +1,12 @@
 from ritual.base import TypeDispatcher, dispatch
+import concurrent.futures
+import hashlib
 import os.path
+import pickle
+from ritual import interpreter
+from ritual.base.profile import NULL_PROFILE, count_trees
 import ritual.interpreter.location
+import ritual.phase1.cache
 
 from . import parser
 from . import semantic
@@ -61,17 +67,184 @@ class FindImports(object, metaclass=TypeDispatcher):
             cls.visit(decl, loader)
 
 
-def parse_file(module_name, path, status):
-    with open(path) as f:
-        text = f.read()
+# Parsed modules, kept between compilations and optionally on disk.
+# Trees are found by a hash of their source and the grammar, and are moved to
+# the location of the current compilation.
+# Note: a tree returned by an earlier compilation is relocated in place when reused.
+class ParseCache(object):
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.modules = {}
+        self.hits = 0
+
+    def digest(self, module_name, path, text):
+        h = hashlib.sha256()
+        h.update(parser.grammar_key.encode('ascii'))
+        h.update(repr((module_name, path)).encode('utf-8'))
+        h.update(text.encode('utf-8'))
+        return h.hexdigest()
+
+    def cache_file(self, digest):
+        return os.path.join(self.directory, digest + '.pickle')
+
+    def load(self, digest):
+        try:
+            with open(self.cache_file(digest), 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            # A missing or corrupt file is a miss.
+            return None
+
+    def contains(self, module_name, path, text):
+        digest = self.digest(module_name, path, text)
+        entry = self.modules.get((module_name, path))
+        if entry is not None and entry[0] == digest:
+            return True
+        return self.directory is not None and os.path.exists(self.cache_file(digest))
+
+    def lookup(self, module_name, path, text, loc):
+        digest = self.digest(module_name, path, text)
+        entry = self.modules.get((module_name, path))
+        if (entry is None or entry[0] != digest) and self.directory is not None:
+            cached = self.load(digest)
+            if cached is not None:
+                entry = (digest,) + cached
+        if entry is None or entry[0] != digest:
+            return None
+        _, old_loc, m = entry
+        if loc != old_loc:
+            interpreter.relocate(m, old_loc, loc - old_loc, set())
+        self.modules[(module_name, path)] = (digest, loc, m)
+        self.hits += 1
+        return m
+
+    # Forget the modules held in memory.
+    def clear(self):
+        self.modules = {}
+
+    def store(self, module_name, path, text, loc, module):
+        digest = self.digest(module_name, path, text)
+        self.modules[(module_name, path)] = (digest, loc, module)
+        if self.directory is not None:
+            ritual.phase1.cache.write_atomic(self.cache_file(digest), pickle.dumps((loc, module), pickle.HIGHEST_PROTOCOL))
+
+
+# Parse a module, producing (value, ok, error loc).
+# This is also run in worker processes, which parse at location 0 because the
+# final location is not known until the result is merged.
+def parse_text(module_name, path, text, loc=0):
+    result = parser.compiled.parse('module', [module_name, path], text, loc)
+    return result.value, result.ok, result.loc
+
+
+# The generated parser has no hooks to count with, so the interpreter version
+# of the grammar parses the text again with a RuleProfiler.
+class RuleCounter(object):
+    def __init__(self):
+        self.parser = interpreter.Parser()
+        for rule in parser.p.rules.values():
+            self.parser.rule(rule)
+        self.profiler = self.parser.enableProfiling()
+
+    def totals(self):
+        rules = self.parser.rules
+        calls = sum([profile.calls for name, profile in self.profiler.rules.items() if isinstance(rules[name], interpreter.Rule)])
+        backtracks = sum([alternative.backtracks for alternative in self.profiler.alternatives])
+        return calls, backtracks
+
+    def count(self, module_name, path, text, profile):
+        calls, backtracks = self.totals()
+        self.parser.parse('module', [module_name, path], text)
+        after_calls, after_backtracks = self.totals()
+        profile.count('rule_calls', after_calls - calls)
+        profile.count('backtracks', after_backtracks - backtracks)
+
+
+# Parsing again with the interpreter is much slower than the compile, so it is
+# only done on request, in phases of its own, after the compile has been timed.
+# "sources" holds the (module name, path, text) of each module that was parsed.
+def count_rules(sources, profile):
+    counter = RuleCounter()
+    for module_name, path, text in sources:
+        with profile.phase('count_rules', module_name):
+            counter.count(module_name, path, text, profile)
+
+
+# Register the source of a module and produce its tree, either from the cache,
+# by moving a tree parsed at location 0, or by parsing it here.
+# Returns the tree and whether it came from the cache.
+def finish_parse(module_name, path, text, parsed, status, cache, profile=NULL_PROFILE):
     loc = status.add_source(path, text)
-    result = parser.p.parse('module', [module_name, path], text, loc)
-    if not result.ok:
-        status.error('unexpected character', result.loc)
-    return result.value
+    profile.count('source_chars', len(text))
+    if cache is not None:
+        m = cache.lookup(module_name, path, text, loc)
+        if m is not None:
+            profile.count('parse_cache_hits')
+            return m, True
+    if parsed is None:
+        value, ok, error_loc = parse_text(module_name, path, text, loc)
+    else:
+        value, ok, error_loc = parsed
+        error_loc += loc
+        if ok:
+            interpreter.relocate(value, 0, loc, set())
+    if not ok:
+        status.error('unexpected character', error_loc)
+    else:
+        if profile.enabled:
+            profile.count('tree_nodes', count_trees(value))
+        if cache is not None:
+            cache.store(module_name, path, text, loc, value)
+    return value, False
 
 
-def frontend(system, root, entrypoint, status):
+# Modules that are parsed rather than taken from the cache are appended to "sources", if it is given.
+def parse_file(module_name, path, status, cache=None, profile=NULL_PROFILE, sources=None):
+    with profile.phase('read', module_name):
+        with open(path) as f:
+            text = f.read()
+    with profile.phase('parse', module_name):
+        m, cached = finish_parse(module_name, path, text, None, status, cache, profile)
+    if sources is not None and not cached:
+        sources.append((module_name, path, text))
+    return m
+
+
+# Parse modules in worker processes as they are discovered.
+# Results are merged in the order a serial compile would parse them, so the
+# locations allocated in "status" and the output are identical.
+def parse_modules_parallel(loader, status, cache, jobs, profile=NULL_PROFILE, sources=None):
+    modules = []
+    started = []
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        def start_pending():
+            while loader.pending:
+                module_path, fn = loader.pending.pop(0)
+                module_name = '.'.join(module_path)
+                with profile.phase('read', module_name):
+                    with open(fn) as f:
+                        text = f.read()
+                future = None
+                if cache is None or not cache.contains(module_name, fn, text):
+                    future = pool.submit(parse_text, module_name, fn, text)
+                started.append((module_name, fn, text, future))
+
+        start_pending()
+        while started:
+            module_name, fn, text, future = started.pop(0)
+            with profile.phase('parse', module_name):
+                result = future.result() if future is not None else None
+                m, cached = finish_parse(module_name, fn, text, result, status, cache, profile)
+            if sources is not None and not cached:
+                sources.append((module_name, fn, text))
+            if m:
+                FindImports.visit(m, loader)
+                modules.append(m)
+            start_pending()
+    return modules
+
+
+def frontend(system, root, entrypoint, status, cache=None, jobs=1, incremental=None, profile=NULL_PROFILE, sources=None):
     assert isinstance(entrypoint, list), entrypoint
 
     loader = ModuleLoader(system, root, status)
@@ -79,16 +252,24 @@ def frontend(system, root, entrypoint, status):
     status.halt_if_errors()
 
     # Parse and resolve imports
-    modules = []
-    while loader.pending:
-        module_path, fn = loader.pending.pop(0)
-        m = parse_file('.'.join(module_path), fn, status)
-        if m:
-            FindImports.visit(m, loader)
-            modules.append(m)
+    with profile.phase('parse'):
+        if jobs > 1:
+            modules = parse_modules_parallel(loader, status, cache, jobs, profile, sources)
+        else:
+            modules = []
+            while loader.pending:
+                module_path, fn = loader.pending.pop(0)
+                m = parse_file('.'.join(module_path), fn, status, cache, profile, sources)
+                if m:
+                    FindImports.visit(m, loader)
+                    modules.append(m)
     status.halt_if_errors()
 
-    p = semantic.process(modules, status)
+    with profile.phase('semantic'):
+        if incremental is not None:
+            p = incremental.process(modules, status, profile)
+        else:
+            p = semantic.process(modules, status, profile)
     status.halt_if_errors()
 
     # Identify the entrypoint.
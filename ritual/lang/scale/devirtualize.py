@@ -0,0 +1,111 @@
+from ritual.base.profile import NULL_PROFILE
+from . import model
+from .semantic import struct_lookup
+
+# Class hierarchy analysis over the whole program.
+# A method call is monomorphic if nothing derived from the static type of the receiver overrides the method,
+# in which case it can call the implementation directly rather than through the vtable.
+
+
+def methods_defined(s):
+    return [name for name, obj in s.namespace.items() if isinstance(obj, model.BaseFunction)]
+
+
+class Hierarchy(object):
+    def __init__(self, structs):
+        self.children = {}
+        for s in structs:
+            if s.parent:
+                self.children.setdefault(s.parent, []).append(s)
+        self.below = {}
+
+    def is_leaf(self, s):
+        return s not in self.children
+
+    # The names of the methods defined by structs derived from "s".
+    def methods_below(self, s):
+        names = self.below.get(s)
+        if names is None:
+            names = set()
+            for child in self.children.get(s, []):
+                names.update(methods_defined(child))
+                names.update(self.methods_below(child))
+            self.below[s] = names
+        return names
+
+
+class Devirtualizer(object):
+    def __init__(self, hierarchy):
+        self.hierarchy = hierarchy
+        self.eliminated = 0
+        self.remaining = 0
+
+    def rewrite(self, node):
+        if isinstance(node, model.IndirectMethodCall):
+            name = node.name
+        elif isinstance(node, model.DirectMethodCall) and node.devirtualized:
+            # Calls devirtualized by a previous run are reconsidered, as the hierarchy may have changed since.
+            name = node.f.name
+        else:
+            return node
+
+        t = model.expr_type(node.expr)
+        if name in self.hierarchy.methods_below(t):
+            self.remaining += 1
+            if isinstance(node, model.DirectMethodCall):
+                return model.IndirectMethodCall(node.loc, node.expr, name, node.args, node.t)
+            return node
+
+        self.eliminated += 1
+        f = struct_lookup(t, name)
+        if isinstance(node, model.DirectMethodCall):
+            node.f = f
+            return node
+        call = model.DirectMethodCall(node.loc, node.expr, f, node.args, node.t)
+        call.devirtualized = True
+        return call
+
+    def walk(self, root):
+        pending = [root]
+        visited = set()
+        while pending:
+            node = pending.pop()
+            fields = getattr(type(node), '__fields__', None)
+            if fields is None or id(node) in visited:
+                continue
+            visited.add(id(node))
+            for f in fields:
+                if 'backedge' in f.attrs:
+                    continue
+                value = getattr(node, f.name)
+                if isinstance(value, list):
+                    for i, child in enumerate(value):
+                        child = self.rewrite(child)
+                        value[i] = child
+                        pending.append(child)
+                else:
+                    child = self.rewrite(value)
+                    if child is not value:
+                        setattr(node, f.name, child)
+                    pending.append(child)
+
+
+# Turn monomorphic method calls into direct calls, and mark the structs and methods that are never overridden as final.
+# Returns the number of virtual calls eliminated.
+def devirtualize(p, profile=NULL_PROFILE):
+    structs = []
+    for m in p.modules:
+        structs += m.structs
+    hierarchy = Hierarchy(structs)
+
+    for s in structs:
+        # Only structs that inherit have virtual methods that "final" could help with.
+        s.is_final = s.parent is not None and hierarchy.is_leaf(s)
+        for f in s.methods:
+            f.is_final = f.overrides is not None and not f.is_overridden
+
+    devirtualizer = Devirtualizer(hierarchy)
+    devirtualizer.walk(p)
+    profile.count('virtual_calls_eliminated', devirtualizer.eliminated)
+    profile.count('virtual_calls', devirtualizer.remaining)
+    return devirtualizer.eliminated
@@ -0,0 +1,383 @@
+from ritual.base import TypeDispatcher, dispatch
+from ritual.base.profile import NULL_PROFILE
+from . import model
+from .semantic import VOID_TYPE
+
+# Constant folding and propagation over the model, before generating C++.
+# Integer arithmetic wraps at the width of the type, as the generated code does.
+# Anything that would trap or is inexact, such as division by zero or float arithmetic, is left for runtime.
+
+
+Literal = (model.BooleanLiteral, model.IntLiteral, model.StringLiteral)
+
+
+def nop(loc):
+    return model.Sequence(loc, [], VOID_TYPE)
+
+
+def is_nop(node):
+    return isinstance(node, model.Sequence) and not node.children
+
+
+# Integer division by zero and reading a field through a null reference trap at runtime,
+# so they are kept even when their value is not used.
+def can_trap(node):
+    if isinstance(node, model.BinaryOp):
+        if node.op not in ('/', '%') or not is_integer(node.left.t):
+            return False
+        # Dividing by a constant other than 0 or -1 cannot trap.
+        divisor = node.right
+        return not (isinstance(divisor, model.IntLiteral) and wrap(divisor.value, divisor.t.tag) not in (0, -1))
+    elif isinstance(node, model.GetField):
+        t = model.expr_type(node.expr)
+        return isinstance(t, model.Struct) and t.is_ref
+    return False
+
+
+def contains_trap(node):
+    if can_trap(node):
+        return True
+    for _, _, child in code_children(node):
+        if contains_trap(child):
+            return True
+    return False
+
+
+# The value of "node" is not used, only its side effects matter.
+# Operators and field reads that cannot trap are pure, but their operands are still evaluated.
+def discard(node):
+    if isinstance(node, Literal + (model.GetLocal,)):
+        return nop(node.loc)
+    if can_trap(node):
+        return node
+    if isinstance(node, model.Sequence) and node.children:
+        node.children[-1] = discard(node.children[-1])
+    elif isinstance(node, (model.PrefixOp, model.GetField)):
+        return discard(node.expr)
+    elif isinstance(node, model.BinaryOp):
+        children = [child for child in (discard(node.left), discard(node.right)) if not is_nop(child)]
+        if len(children) == 1:
+            return children[0]
+        return model.Sequence(node.loc, children, VOID_TYPE)
+    return node
+
+
+def is_void(t):
+    return isinstance(t, model.TupleType) and not t.children
+
+
+def is_integer(t):
+    return isinstance(t, model.Struct) and isinstance(t.tag, model.IntegerTypeTag)
+
+
+def wrap(value, tag):
+    value &= (1 << tag.width) - 1
+    if not tag.unsigned and value >> (tag.width - 1):
+        value -= 1 << tag.width
+    return value
+
+
+# C++ division truncates towards zero.
+def truncated_div(a, b):
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+
+def fold_integer_op(op, a, b, tag):
+    a = wrap(a, tag)
+    b = wrap(b, tag)
+    if op in ('/', '%'):
+        if b == 0:
+            return None
+        # The most negative value divided by -1 overflows, which traps.
+        if not tag.unsigned and a == -(1 << (tag.width - 1)) and b == -1:
+            return None
+        q = truncated_div(a, b)
+        return wrap(q if op == '/' else a - b * q, tag)
+    elif op == '+':
+        return wrap(a + b, tag)
+    elif op == '-':
+        return wrap(a - b, tag)
+    elif op == '*':
+        return wrap(a * b, tag)
+    elif op == '&':
+        return wrap(a & b, tag)
+    elif op == '|':
+        return wrap(a | b, tag)
+    elif op == '^':
+        return wrap(a ^ b, tag)
+    return compare(op, a, b)
+
+
+def compare(op, a, b):
+    if op == '==':
+        return a == b
+    elif op == '!=':
+        return a != b
+    elif op == '<':
+        return a < b
+    elif op == '<=':
+        return a <= b
+    elif op == '>':
+        return a > b
+    elif op == '>=':
+        return a >= b
+    return None
+
+
+def fold_binary_op(node):
+    l = node.left
+    r = node.right
+    op = node.op
+    if isinstance(l, model.IntLiteral) and isinstance(r, model.IntLiteral) and is_integer(l.t):
+        value = fold_integer_op(op, l.value, r.value, l.t.tag)
+    elif isinstance(l, model.BooleanLiteral) and isinstance(r, model.BooleanLiteral):
+        if op == '&':
+            value = l.value and r.value
+        elif op == '|':
+            value = l.value or r.value
+        elif op == '^':
+            value = l.value != r.value
+        else:
+            value = compare(op, l.value, r.value)
+    elif isinstance(l, model.StringLiteral) and isinstance(r, model.StringLiteral):
+        if op == '+':
+            value = l.value + r.value
+        elif op in ('==', '!='):
+            value = compare(op, l.value, r.value)
+        else:
+            value = None
+    elif op == '+' and isinstance(r, model.StringLiteral) and isinstance(l, model.BinaryOp) and l.op == '+' and isinstance(l.right, model.StringLiteral):
+        # Concatenation is associative, so adjacent pieces of an interpolated string can be joined.
+        return model.BinaryOp(node.loc, l.left, '+', model.StringLiteral(l.right.loc, l.right.value + r.value, r.t), node.t)
+    else:
+        value = None
+
+    if value is None:
+        return node
+    return make_literal(node.loc, value, node.t)
+
+
+def fold_prefix_op(node):
+    expr = node.expr
+    if node.op == '!' and isinstance(expr, model.BooleanLiteral):
+        return model.BooleanLiteral(node.loc, not expr.value, node.t)
+    if node.op in ('-', '+') and isinstance(expr, model.IntLiteral) and is_integer(expr.t):
+        value = -expr.value if node.op == '-' else expr.value
+        return model.IntLiteral(node.loc, wrap(value, expr.t.tag), node.t)
+    return node
+
+
+def make_literal(loc, value, t):
+    if isinstance(value, bool):
+        return model.BooleanLiteral(loc, value, t)
+    elif isinstance(value, int):
+        return model.IntLiteral(loc, value, t)
+    else:
+        return model.StringLiteral(loc, value, t)
+
+
+# The text std::to_string produces for a literal.
+def literal_to_string(node):
+    if isinstance(node, model.StringLiteral):
+        return node.value
+    elif isinstance(node, model.BooleanLiteral):
+        return '1' if node.value else '0'
+    elif isinstance(node, model.IntLiteral) and is_integer(node.t):
+        return str(wrap(node.value, node.t.tag))
+    return None
+
+
+class FunctionState(object):
+    def __init__(self, params, assignments):
+        self.params = params
+        # Local => number of times it is assigned.
+        self.assignments = assignments
+        # Local => literal it always holds.
+        self.constants = {}
+        self.folded = 0
+
+
+class FoldExpr(object, metaclass=TypeDispatcher):
+
+    @dispatch(model.BinaryOp)
+    def visitBinaryOp(cls, node, state):
+        return fold_binary_op(node)
+
+    @dispatch(model.PrefixOp)
+    def visitPrefixOp(cls, node, state):
+        return fold_prefix_op(node)
+
+    @dispatch(model.If)
+    def visitIf(cls, node, state):
+        if not isinstance(node.cond, model.BooleanLiteral):
+            return node
+        taken = node.tbody if node.cond.value else node.fbody
+        # The branch may have a more specific type than the If, only replace it when that cannot matter.
+        # Statements such as assignments have no type, but they are only taken by an If whose value is not used.
+        if not is_void(node.t) and model.expr_type(taken) is not node.t:
+            return node
+        return taken
+
+    @dispatch(model.While)
+    def visitWhile(cls, node, state):
+        if isinstance(node.cond, model.BooleanLiteral) and not node.cond.value:
+            return nop(node.loc)
+        return node
+
+    @dispatch(model.Sequence)
+    def visitSequence(cls, node, state):
+        if len(node.children) > 1:
+            children = [discard(child) for child in node.children[:-1]]
+            children = [child for child in children if not is_nop(child)]
+            node.children = children + node.children[-1:]
+        if len(node.children) == 1 and isinstance(node.children[0], Literal) and node.children[0].t is node.t:
+            return node.children[0]
+        return node
+
+    @dispatch(model.Assign)
+    def visitAssign(cls, node, state):
+        target = node.target
+        value = node.value
+        if isinstance(target, model.SetLocal) and isinstance(value, Literal):
+            lcl = target.lcl
+            if lcl not in state.params and state.assignments.get(lcl) == 1 and value.t is lcl.t:
+                state.constants[lcl] = value
+                return nop(node.loc)
+        return node
+
+    @dispatch(model.GetLocal)
+    def visitGetLocal(cls, node, state):
+        value = state.constants.get(node.lcl)
+        if value is None:
+            return node
+        return make_literal(node.loc, value.value, value.t)
+
+    @dispatch(model.DirectMethodCall)
+    def visitDirectMethodCall(cls, node, state):
+        f = node.f
+        if isinstance(f, model.ExternFunction) and f.module.name == 'builtin' and f.name == 'to_string':
+            text = literal_to_string(node.expr)
+            if text is not None:
+                return model.StringLiteral(node.loc, text, node.t)
+        return node
+
+    @dispatch(model.GetType, model.GetFunction, model.GetModule, model.GetField, model.GetMethod,
+              model.DirectCall, model.IndirectMethodCall, model.Constructor, model.BooleanLiteral,
+              model.TupleLiteral, model.FloatLiteral, model.IntLiteral, model.StringLiteral,
+              model.Match, model.Case, model.PoisonExpr,
+              model.SetLocal, model.SetField, model.DestructureTuple, model.DestructureStruct, model.PoisonTarget)
+    def visitOther(cls, node, state):
+        return node
+
+
+Code = model.Expr + model.Target + (model.Case,)
+
+
+def code_children(node):
+    for f in type(node).__fields__:
+        if 'backedge' in f.attrs:
+            continue
+        value = getattr(node, f.name)
+        if isinstance(value, list):
+            for i, child in enumerate(value):
+                if isinstance(child, Code):
+                    yield value, i, child
+        elif isinstance(value, Code):
+            yield node, f.name, value
+
+
+# Fold the children first, in the order they are evaluated, so constants are known before their uses.
+def fold(node, state):
+    for owner, key, child in code_children(node):
+        folded = fold(child, state)
+        if folded is not child:
+            state.folded += 1
+            if isinstance(owner, list):
+                owner[key] = folded
+            else:
+                setattr(owner, key, folded)
+    return FoldExpr.visit(node, state)
+
+
+def locals_used(node, used):
+    if isinstance(node, (model.GetLocal, model.SetLocal)):
+        used.add(node.lcl)
+    for _, _, child in code_children(node):
+        locals_used(child, used)
+    return used
+
+
+def locals_read(node, read):
+    if isinstance(node, model.GetLocal):
+        read.add(node.lcl)
+    for _, _, child in code_children(node):
+        locals_read(child, read)
+    return read
+
+
+# Storing to a local that is never read only needs to evaluate the value, for its side effects.
+def remove_dead_stores(node, read, state):
+    for owner, key, child in code_children(node):
+        removed = remove_dead_stores(child, read, state)
+        if removed is not child:
+            state.folded += 1
+            if isinstance(owner, list):
+                owner[key] = removed
+            else:
+                setattr(owner, key, removed)
+    if isinstance(node, model.Assign) and isinstance(node.target, model.SetLocal):
+        lcl = node.target.lcl
+        # The store is kept if evaluating the value could trap, as the value alone would not be generated.
+        if lcl not in read and lcl not in state.params and not contains_trap(node.value):
+            return discard(node.value)
+    return node
+
+
+def count_assignments(node, assignments):
+    if isinstance(node, model.SetLocal):
+        assignments[node.lcl] = assignments.get(node.lcl, 0) + 1
+    for _, _, child in code_children(node):
+        count_assignments(child, assignments)
+    return assignments
+
+
+# Returns the number of expressions replaced.
+def fold_body(obj, params, returns_void):
+    state = FunctionState(params, count_assignments(obj.body, {}))
+    obj.body = fold(obj.body, state)
+    if returns_void:
+        obj.body = discard(obj.body)
+    # Removing a store may remove the last read of another local.
+    while True:
+        folded = state.folded
+        body = remove_dead_stores(obj.body, locals_read(obj.body, set()), state)
+        if body is not obj.body:
+            state.folded += 1
+            obj.body = body
+        if state.folded == folded:
+            break
+
+    # Locals that are propagated or only used by pruned code would otherwise be declared but unused.
+    used = locals_used(obj.body, set())
+    obj.locals = [lcl for lcl in obj.locals if lcl in used or lcl in params]
+    return state.folded
+
+
+def fold_constants(p, profile=NULL_PROFILE):
+    folded = 0
+    for m in p.modules:
+        funcs = list(m.funcs)
+        for s in m.structs:
+            funcs += s.methods
+        for f in funcs:
+            if not isinstance(f, model.Function):
+                continue
+            params = set([param.lcl for param in f.params])
+            if f.self:
+                params.add(f.self.lcl)
+            folded += fold_body(f, params, is_void(f.t.rt))
+        for t in m.tests:
+            folded += fold_body(t, set(), True)
+    profile.count('constants_folded', folded)
+    return folded
@@ -1,14 +1,28 @@
 from ritual.base import TypeDispatcher, dispatch
 import ritual.base.io
+from ritual.base.profile import NULL_PROFILE
 from . import model
 
 
+# How ref structs are allocated and reclaimed.
+# "shared" reference counts them with std::shared_ptr.
+# "arena" bump allocates them from a region in the runtime and refers to them with raw pointers.
+# The region is reset after each test, and by the runtime when the program exits, so no refcounts are maintained.
+MEMORY_MODES = ['shared', 'arena']
+
+
 class Generator(object):
-    def __init__(self, out):
+    def __init__(self, out, status, memory='shared'):
+        assert memory in MEMORY_MODES, memory
         self.out = out
+        self.status = status
         self.names = {}
         self.tmp_id = 0
         self.label_id = 0
+        self.profile = NULL_PROFILE
+        self.memory = memory
+        # Ref struct => (tag, end), see number_structs.
+        self.type_tags = {}
 
     def alloc_temp(self):
         tmp = f'tmp_{self.tmp_id}'
@@ -53,6 +67,8 @@ class GenerateTypeRef(object, metaclass=TypeDispatcher):
         if isinstance(tag, model.UserTypeTag):
             name = gen.get_name(node)
             if node.is_ref:
+                if gen.memory == 'arena':
+                    return f'{name}*'
                 return f'std::shared_ptr<{name}>'
             else:
                 return name
@@ -238,7 +254,32 @@ static inline {ret_type} op_{t}_{name}({c_type} a, {c_type} b) {{
 
 
 
+def gen_arena_runtime(gen):
+    gen.out.write("""
+void* scale_arena_alloc(size_t size, size_t align);
+void scale_arena_finalize(void (*destroy)(void*), void* object);
+void scale_arena_reset();
+
+template<typename T>
+static void scale_destroy(void* object) {
+    static_cast<T*>(object)->~T();
+}
+
+template<typename T, typename... Args>
+static inline T* scale_new(Args&&... args) {
+    T* object = new (scale_arena_alloc(sizeof(T), alignof(T))) T(std::forward<Args>(args)...);
+    if (!std::is_trivially_destructible<T>::value) {
+        scale_arena_finalize(scale_destroy<T>, object);
+    }
+    return object;
+}
+""")
+
+
 def gen_runtime(gen):
+    if gen.memory == 'arena':
+        gen_arena_runtime(gen)
+
     gen_runtime_op('+', 'string', 'std::string', 'std::string', gen)
     gen_runtime_op('==', 'string', 'std::string', 'bool', gen)
     gen_runtime_op('!=', 'string', 'std::string', 'bool', gen)
@@ -294,7 +335,15 @@ class GenerateExpr(object, metaclass=TypeDispatcher):
 
     @dispatch(model.IntLiteral)
     def visitIntLiteral(cls, node, used, gen):
-        literal = repr(node.value)
+        value = node.value
+        if value == -(1 << 63):
+            # There is no positive literal to negate.
+            return f'({value + 1} - 1)', 0, False, False
+        elif value >= 1 << 63:
+            return f'{value}ull', 0, False, False
+        elif value < 0:
+            return repr(value), 3, False, False
+        literal = repr(value)
         return literal, 0, False, False
 
     @dispatch(model.FloatLiteral)
@@ -315,6 +364,8 @@ class GenerateExpr(object, metaclass=TypeDispatcher):
         t_name = gen.get_name(node.t)
         arg_list = ', '.join(args)
         if node.t.is_ref:
+            if gen.memory == 'arena':
+                return f'scale_new<{t_name}>({arg_list})', 2, True, True
             return f'std::make_shared<{t_name}>({arg_list})', 2, True, True
         else:
             return f'{t_name}{{{arg_list}}}', 2, True, False
@@ -329,6 +380,16 @@ class GenerateExpr(object, metaclass=TypeDispatcher):
     @dispatch(model.DirectMethodCall)
     def visitDirectMethodCall(cls, node, used, gen):
         expr, is_ptr = gen_arg(node.expr, 2, gen)
+        self_t = node.f.self.t
+        if expr == 'this' and isinstance(node.f, model.Function):
+            # Inside an inline method self is a raw pointer, so call the method as a member without virtual dispatch.
+            args = [gen_arg(arg, 17, gen)[0] for arg in node.args]
+            return f'this->{gen.get_name(self_t)}::{node.f.name}({", ".join(args)})', 2, True, implemented_as_ptr(node.t)
+        if implemented_as_ptr(self_t) and model.expr_type(node.expr) is not self_t:
+            # Self is passed by reference, so a pointer to a derived struct must be converted into a temporary first.
+            tmp = gen.alloc_temp()
+            gen.out.write(f'{GenerateTypeRef.visit(self_t, gen)} {tmp} = {expr};\n')
+            expr = tmp
         args = [gen_arg(arg, 17, gen)[0] for arg in node.args]
         name = gen.get_name(node.f)
         return f'{name}({", ".join([expr] + args)})', 2, True, implemented_as_ptr(node.t)
@@ -471,6 +532,55 @@ def gen_matcher(node, expr, next, gen):
     gen.out.write(f'if ({tmp} == nullptr) goto {next};\n')
 
 
+# Assign each case the tags it is the first to match.
+def match_arms(node, gen):
+    begin, end = gen.type_tags[node.cond.t]
+    ranges = [gen.type_tags[case.matcher.t] for case in node.cases]
+    arms = [[] for case in node.cases]
+    for tag in range(begin, end):
+        for i, (case_begin, case_end) in enumerate(ranges):
+            if case_begin <= tag < case_end:
+                arms[i].append(tag)
+                break
+    return arms
+
+
+# Dispatch on the type tag of a ref struct, rather than trying each case in turn.
+def gen_tag_switch(node, cond, target, gen):
+    done = gen.alloc_label()
+    arms = match_arms(node, gen)
+
+    if has_type_tag(node.cond.t, gen):
+        tag = gen.alloc_temp()
+        gen.out.write(f'uint32_t {tag} = {cond} == nullptr ? 0 : {cond}->scale_type_tag;\n')
+    else:
+        # There is only one type it can be.
+        tag = f'({cond} == nullptr ? 0 : {gen.type_tags[node.cond.t][0]})'
+
+    gen.out.write(f'switch ({tag}) {{\n')
+    for case, tags in zip(node.cases, arms):
+        if not tags:
+            # Every type this case matches is matched by an earlier case.
+            continue
+        for i, value in enumerate(tags):
+            if i != 0:
+                gen.out.write('\n')
+            gen.out.write(f'case {value}:')
+        gen.out.write(' {\n')
+        with gen.out.block():
+            gen_capture(case.expr, target, gen)
+            gen.out.write(f'goto {done};\n')
+        gen.out.write('}\n')
+    gen.out.write('default:\n')
+    with gen.out.block():
+        # TODO better validation.
+        gen.out.write('abort();\n')
+    gen.out.write('}\n')
+
+    # Exit
+    gen.out.write(f'{done}:\n')
+
+
 def gen_match(node, target, gen):
     if not node.cases:
         assert not target, node
@@ -478,6 +588,10 @@ def gen_match(node, target, gen):
         return
 
     cond, _ = gen_arg(node.cond, 17, gen, always_capture=True)
+    if implemented_as_ptr(node.cond.t):
+        gen_tag_switch(node, cond, target, gen)
+        return
+
     done = gen.alloc_label()
 
     for i, case in enumerate(node.cases):
@@ -521,6 +635,22 @@ def gen_void(node, gen):
         gen.out.write(f'{expr};\n')
 
 
+# Only hierarchies with more than one type need to store their tags.
+def has_type_tag(s, gen):
+    while s.parent:
+        s = s.parent
+    begin, end = gen.type_tags[s]
+    return end - begin > 1
+
+
+def gen_constructor_body(node, gen):
+    if node.is_ref and has_type_tag(node, gen):
+        # Constructors run from the root down, so the most derived tag is stored last.
+        gen.out.write(f' {{ scale_type_tag = {gen.type_tags[node][0]}; }}\n\n')
+    else:
+        gen.out.write(' {}\n\n')
+
+
 class GenerateSource(object, metaclass=TypeDispatcher):
 
     @classmethod
@@ -564,6 +694,8 @@ class GenerateSource(object, metaclass=TypeDispatcher):
         gen.out.write(') ')
         if inline_method and node.overrides:
             gen.out.write('override ')
+            if node.is_final:
+                gen.out.write('final ')
         gen.out.write('{\n')
 
         # Body
@@ -590,6 +722,8 @@ class GenerateSource(object, metaclass=TypeDispatcher):
         name = gen.get_name(node)
         gen.out.write('\n')
         gen.out.write('struct ').write(name)
+        if node.is_final:
+            gen.out.write(' final')
         if node.parent:
             gen.out.write(' : public ').write(gen.get_name(node.parent))
         gen.out.write(' {\n')
@@ -627,7 +761,7 @@ class GenerateSource(object, metaclass=TypeDispatcher):
                 gen.out.write(f'{f.name}({f.name})')
                 dirty = True
 
-            gen.out.write(' {}\n\n')
+            gen_constructor_body(node, gen)
 
             # Default constructor.
             # TODO zero value initialization?
@@ -656,11 +790,13 @@ class GenerateSource(object, metaclass=TypeDispatcher):
                 gen.out.write(f'{f.name}({zero})')
                 dirty = True
 
-            gen.out.write(' {}\n\n')
+            gen_constructor_body(node, gen)
 
             # Tracing destructor.
             #gen.out.write(f'~{name}() {{ std::cout << "    destroy {name}" << std::endl; }}\n')
 
+            if node.is_ref and not node.parent and has_type_tag(node, gen):
+                gen.out.write('uint32_t scale_type_tag;\n')
             for f in node.fields:
                 cls.visit(f, gen)
             for m in node.methods:
@@ -685,6 +821,10 @@ class GenerateSource(object, metaclass=TypeDispatcher):
     @dispatch(model.Program)
     def visitProgram(cls, node, gen):
         includes = ['cstdint', 'iostream', 'tuple', 'string']
+        if gen.memory == 'arena':
+            includes += ['cstddef', 'new', 'type_traits', 'utility']
+        else:
+            includes.append('memory')
         includes.sort()
         for name in includes:
             gen.out.write(f'#include <{name}>\n')
@@ -704,7 +844,9 @@ class GenerateSource(object, metaclass=TypeDispatcher):
             externs += m.extern_funcs
             for s in m.structs:
                 funcs += s.methods
-        structs = sort_structs(structs)
+        with gen.profile.phase('sort_structs'):
+            structs = sort_structs(structs, gen.status)
+        gen.type_tags = number_structs(structs)
 
         # Forward declarations
         gen.out.write('\n')
@@ -738,6 +880,8 @@ class GenerateSource(object, metaclass=TypeDispatcher):
             for name, m, t in tests:
                 gen.out.write(f'std::cout << "test " << {string_literal(m.name)} << ": " << {string_literal(t.desc)} << "..." << std::endl;\n')
                 gen.out.write(f'{name}();\n')
+                if gen.memory == 'arena':
+                    gen.out.write('scale_arena_reset();\n')
             gen.out.write('\n')
             gen.out.write('std::cout << "DONE" << std::endl;\n')
             gen.out.write('std::cout << std::endl;\n')
@@ -752,30 +896,163 @@ class GenerateSource(object, metaclass=TypeDispatcher):
         gen.out.write('}\n')
 
 
-# TODO something less O(n^2)-ish
-def sort_structs(pending):
-    out = []
-    done = set()
+# Number ref structs in preorder, so that the tags of a struct and everything derived from it form a range.
+# Returns struct => (tag, end), where the range is [tag, end).
+# Tag 0 is reserved for null.
+def number_structs(structs):
+    roots = []
+    children = {}
+    for s in structs:
+        if not s.is_ref:
+            continue
+        if s.parent:
+            children.setdefault(s.parent, []).append(s)
+        else:
+            roots.append(s)
 
+    tags = {}
+    begin = {}
+    tag = 1
+    pending = [(s, False) for s in reversed(roots)]
     while pending:
-        defer = []
-        for s in pending:
-            if s.parent and s.parent not in done:
-                defer.append(s)
-                continue
-            for f in s.fields:
-                if isinstance(f.t, model.Struct) and isinstance(f.t.tag, model.UserTypeTag) and f.t not in done:
-                    defer.append(s)
+        s, done = pending.pop()
+        if done:
+            tags[s] = (begin[s], tag)
+            continue
+        begin[s] = tag
+        tag += 1
+        pending.append((s, True))
+        pending.extend([(child, False) for child in reversed(children.get(s, []))])
+    return tags
+
+
+# Referenced structures are only needed by inline methods, so depending on them is optional.
+def is_optional_dependency(s, t):
+    return t.is_ref and t is not s.parent
+
+
+# The structures that should be defined before "s", except for the "dropped" dependencies.
+def struct_dependencies(s, dropped):
+    if s.parent:
+        yield s.parent
+    for f in s.fields:
+        t = f.t
+        if isinstance(t, model.Struct) and isinstance(t.tag, model.UserTypeTag) and (s, t) not in dropped:
+            yield t
+
+
+# Find when each structure could be defined, if the structures were scanned in
+# order, repeatedly, and each one defined once its dependencies were.
+# A dependency defined on the same scan comes earlier in the order, otherwise
+# it was defined on a previous scan.
+# Returns the scan of each structure, and a dependency cycle if there is one.
+def struct_scans(structs, dropped):
+    index = dict([(s, i) for i, s in enumerate(structs)])
+    scans = {}
+    active = set()
+    for root in structs:
+        if root in scans:
+            continue
+        path = [root]
+        pending = [struct_dependencies(root, dropped)]
+        current = [0]
+        active.add(root)
+        while path:
+            s = path[-1]
+            for d in pending[-1]:
+                if d not in index:
+                    continue
+                if d in active:
+                    return None, path[path.index(d):] + [d]
+                if d not in scans:
+                    path.append(d)
+                    pending.append(struct_dependencies(d, dropped))
+                    current.append(0)
+                    active.add(d)
                     break
+                scan = scans[d] + (1 if index[d] > index[s] else 0)
+                if scan > current[-1]:
+                    current[-1] = scan
             else:
-                out.append(s)
-                done.add(s)
-        # Recursive value types?
-        assert len(pending) != len(defer), pending
-        pending = defer
-    return out
-
-
-def generate_source(p, out):
-    gen = Generator(ritual.base.io.TabbedWriter(out))
+                path.pop()
+                pending.pop()
+                scans[s] = current.pop()
+                active.remove(s)
+                if path:
+                    parent = path[-1]
+                    scan = scans[s] + (1 if index[s] > index[parent] else 0)
+                    if scan > current[-1]:
+                        current[-1] = scan
+    return scans, None
+
+
+# Tarjan's algorithm, iteratively, as there can be thousands of structures.
+# Returns the strongly connected component of each structure, named by its root.
+def struct_components(structs):
+    included = set(structs)
+    index = {}
+    low = {}
+    component = {}
+    stack = []
+    for root in structs:
+        if root in index:
+            continue
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        pending = [(root, struct_dependencies(root, ()))]
+        while pending:
+            s, dependencies = pending[-1]
+            for d in dependencies:
+                if d not in included:
+                    continue
+                if d not in index:
+                    index[d] = low[d] = len(index)
+                    stack.append(d)
+                    pending.append((d, struct_dependencies(d, ())))
+                    break
+                # Visited structures without a component are still on the stack.
+                if d not in component:
+                    low[s] = min(low[s], index[d])
+            else:
+                pending.pop()
+                if pending:
+                    parent = pending[-1][0]
+                    low[parent] = min(low[parent], low[s])
+                if low[s] == index[s]:
+                    while True:
+                        d = stack.pop()
+                        component[d] = s
+                        if d is s:
+                            break
+    return component
+
+
+# Order the structures so that each is defined after the structures it depends on.
+# The order is stable: structures stay in their original order unless a dependency requires otherwise.
+def sort_structs(structs, status):
+    # Structures that reference each other cannot all be defined first, so give up the references between them.
+    component = struct_components(structs)
+    dropped = set()
+    for s in structs:
+        for t in struct_dependencies(s, ()):
+            if component.get(t) is component[s] and is_optional_dependency(s, t):
+                dropped.add((s, t))
+
+    scans, cycle = struct_scans(structs, dropped)
+    if cycle:
+        status.error('recursive structures: %s' % ' -> '.join(['%s.%s' % (s.module.name, s.name) for s in cycle]), cycle[0].loc, [s.loc for s in cycle[1:-1]])
+        status.halt_if_errors()
+
+    ordered = []
+    for s in structs:
+        scan = scans[s]
+        while len(ordered) <= scan:
+            ordered.append([])
+        ordered[scan].append(s)
+    return [s for group in ordered for s in group]
+
+
+def generate_source(p, out, status, profile=NULL_PROFILE, memory='shared'):
+    gen = Generator(ritual.base.io.TabbedWriter(out), status, memory)
+    gen.profile = profile
     GenerateSource.visit(p, gen)
\ No newline at end of file
@@ -0,0 +1,148 @@
+import copy
+
+from ritual.base.profile import NULL_PROFILE
+from . import model
+from .fold import Code, code_children
+
+# Replaces calls to small functions and methods with copies of their bodies.
+# The parameters and locals of the callee are copied and renamed, and the arguments are assigned to them.
+# The size of a function is the number of expressions in its body, and only functions within the budget are inlined.
+
+DEFAULT_BUDGET = 12
+
+
+def code_size(node):
+    size = 1
+    for _, _, child in code_children(node):
+        size += code_size(child)
+    return size
+
+
+def copy_code(node, renamed):
+    node = copy.copy(node)
+    for f in type(node).__fields__:
+        value = getattr(node, f.name)
+        if isinstance(value, model.Local):
+            setattr(node, f.name, renamed.get(value, value))
+        elif 'backedge' in f.attrs:
+            continue
+        elif isinstance(value, list):
+            setattr(node, f.name, [copy_code(child, renamed) if isinstance(child, Code) else child for child in value])
+        elif isinstance(value, Code):
+            setattr(node, f.name, copy_code(value, renamed))
+    return node
+
+
+class Inliner(object):
+    def __init__(self, budget):
+        self.budget = budget
+        # Function => size of its body.
+        self.sizes = {}
+        self.inlined = 0
+        # Module => the other modules whose code was copied into it.
+        # Structs derive from structs in their own module, so this includes where devirtualized calls were resolved.
+        self.copied = {}
+
+        self.module = None
+        self.caller = None
+        self.caller_self = None
+        self.copies = 0
+
+    def size(self, f):
+        size = self.sizes.get(f)
+        if size is None:
+            size = code_size(f.body)
+            self.sizes[f] = size
+        return size
+
+    def can_inline(self, call, stack):
+        f = call.f
+        if not isinstance(f, model.Function) or f in stack:
+            return False
+        if isinstance(call, model.DirectMethodCall):
+            # Values are passed to methods by reference, so a copy of self would not see modifications.
+            if not f.self.t.is_ref:
+                return False
+            # Self cannot be copied inside the inline version of the caller, it is a raw pointer.
+            if isinstance(call.expr, model.GetLocal) and call.expr.lcl is self.caller_self:
+                return False
+        return self.size(f) <= self.budget
+
+    def inline(self, call, stack):
+        f = call.f
+        self.inlined += 1
+        if f.module is not self.module:
+            self.copied[self.module.name].add(f.module.name)
+
+        prefix = 'inline_%d_' % self.copies
+        self.copies += 1
+        renamed = {}
+        params = [p.lcl for p in f.params]
+        args = list(call.args)
+        if isinstance(call, model.DirectMethodCall):
+            params.insert(0, f.self.lcl)
+            args.insert(0, call.expr)
+            renamed[f.self.lcl] = model.Local(f.self.lcl.loc, prefix + 'self', f.self.lcl.t)
+        for lcl in f.locals + params:
+            if lcl not in renamed:
+                renamed[lcl] = model.Local(lcl.loc, prefix + lcl.name, lcl.t)
+        self.caller.locals.extend(renamed.values())
+
+        children = []
+        for lcl, arg in zip(params, args):
+            children.append(model.Assign(call.loc, model.SetLocal(call.loc, renamed[lcl]), arg))
+        children.append(self.rewrite(copy_code(f.body, renamed), stack + [f]))
+        return model.Sequence(call.loc, children, call.t)
+
+    # Self is passed to methods by reference, so an inlined receiver must be stored rather than passed as a value.
+    def store(self, value):
+        lcl = model.Local(value.loc, 'inline_%d_result' % self.copies, value.t)
+        self.copies += 1
+        self.caller.locals.append(lcl)
+        assign = model.Assign(value.loc, model.SetLocal(value.loc, lcl), value)
+        return model.Sequence(value.loc, [assign, model.GetLocal(value.loc, lcl, value.t)], value.t)
+
+    def rewrite(self, node, stack):
+        for owner, key, child in code_children(node):
+            rewritten = self.rewrite(child, stack)
+            if rewritten is not child:
+                if isinstance(node, model.DirectMethodCall) and child is node.expr:
+                    rewritten = self.store(rewritten)
+                if isinstance(owner, list):
+                    owner[key] = rewritten
+                else:
+                    setattr(owner, key, rewritten)
+        if isinstance(node, (model.DirectCall, model.DirectMethodCall)) and self.can_inline(node, stack):
+            return self.inline(node, stack)
+        return node
+
+    def process(self, obj, module, stack):
+        self.module = module
+        self.caller = obj
+        self.caller_self = obj.self.lcl if isinstance(obj, model.Function) and obj.self else None
+        self.copies = 0
+        obj.body = self.rewrite(obj.body, stack)
+
+
+# Only the code of the named modules is changed, or of every module if "modules" is None.
+# The code of the other modules is already inlined, such as when it is kept from a previous compilation.
+# Returns the Inliner, which records how many calls were inlined and where their code came from.
+def inline_functions(p, budget=DEFAULT_BUDGET, profile=NULL_PROFILE, modules=None):
+    inliner = Inliner(budget)
+    if budget > 0:
+        for m in p.modules:
+            if modules is not None and m.name not in modules:
+                continue
+            inliner.copied[m.name] = set()
+            funcs = list(m.funcs)
+            for s in m.structs:
+                funcs += s.methods
+            for f in funcs:
+                if isinstance(f, model.Function):
+                    inliner.process(f, m, [f])
+                    # Callers should copy what it has become.
+                    inliner.sizes[f] = code_size(f.body)
+            for t in m.tests:
+                inliner.process(t, m, [])
+    profile.count('calls_inlined', inliner.inlined)
+    return inliner
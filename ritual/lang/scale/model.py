@@ -34,11 +34,11 @@ class FunctionType(object, metaclass=TreeMeta):
 
 
 class Field(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int name:string t:Type@[no_init] owner:Struct@[backedge]'
+    __schema__ = 'loc:location name:string t:Type@[no_init] owner:Struct@[backedge]'
 
 
 class Struct(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int name:string is_ref:bool module:Module tag:TypeTag parent:?Struct@[backedge, no_init] fields:[]Field@[no_init] methods:[]Function@[no_init] namespace:OrderedDict@[simple_init]'
+    __schema__ = 'loc:location name:string is_ref:bool module:Module tag:TypeTag parent:?Struct@[backedge, no_init] is_final:bool@[no_init] fields:[]Field@[no_init] methods:[]Function@[no_init] namespace:OrderedDict@[simple_init]'
 
 
 class PoisonType(object, metaclass=TreeMeta):
@@ -49,85 +49,85 @@ Type = (ModuleType, TupleType, FunctionType, Struct, PoisonType)
 
 
 class GetLocal(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int lcl:Local@[backedge] t:Type@[backedge]'
+    __schema__ = 'loc:location lcl:Local@[backedge] t:Type@[backedge]'
 
 
 class GetType(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int t:Type@[backedge]'
+    __schema__ = 'loc:location t:Type@[backedge]'
 
 
 class GetFunction(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int f:BaseFunction@[backedge]'
+    __schema__ = 'loc:location f:BaseFunction@[backedge]'
 
 
 class GetModule(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int m:Module@[backedge]'
+    __schema__ = 'loc:location m:Module@[backedge]'
 
 
 class GetField(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int expr:Expr field:Field@[backedge] t:Type@[backedge]'
+    __schema__ = 'loc:location expr:Expr field:Field@[backedge] t:Type@[backedge]'
 
 
 class GetMethod(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int expr:Expr func:BaseFunction@[backedge]'
+    __schema__ = 'loc:location expr:Expr func:BaseFunction@[backedge]'
 
 
 class DirectCall(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int f:BaseFunction@[backedge] args:[]Expr t:Type@[backedge]'
+    __schema__ = 'loc:location f:BaseFunction@[backedge] args:[]Expr t:Type@[backedge]'
 
 
 class DirectMethodCall(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int expr:Expr f:BaseFunction@[backedge] args:[]Expr t:Type@[backedge]'
+    __schema__ = 'loc:location expr:Expr f:BaseFunction@[backedge] args:[]Expr t:Type@[backedge] devirtualized:bool@[no_init]'
 
 class IndirectMethodCall(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int expr:Expr name:string args:[]Expr t:Type@[backedge]'
+    __schema__ = 'loc:location expr:Expr name:string args:[]Expr t:Type@[backedge]'
 
 class Constructor(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int t:Struct@[backedge] args:[]Expr'
+    __schema__ = 'loc:location t:Struct@[backedge] args:[]Expr'
 
 
 class BooleanLiteral(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int value:bool t:Type@[backedge]'
+    __schema__ = 'loc:location value:bool t:Type@[backedge]'
 
 
 class TupleLiteral(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int t:TupleType@[backedge] args:[]Expr'
+    __schema__ = 'loc:location t:TupleType@[backedge] args:[]Expr'
 
 
 class FloatLiteral(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int text:string value:float t:Type@[backedge]'
+    __schema__ = 'loc:location text:string value:float t:Type@[backedge]'
 
 
 class IntLiteral(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int value:int t:Type@[backedge]'
+    __schema__ = 'loc:location value:int t:Type@[backedge]'
 
 
 class StringLiteral(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int value:string t:Type@[backedge]'
+    __schema__ = 'loc:location value:string t:Type@[backedge]'
 
 
 class Assign(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int target:Target value:Expr'
+    __schema__ = 'loc:location target:Target value:Expr'
 
 
 class Sequence(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int children:[]Expr t:Type@[backedge]'
+    __schema__ = 'loc:location children:[]Expr t:Type@[backedge]'
 
 
 class PrefixOp(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int op:string expr:Expr t:Type@[backedge]'
+    __schema__ = 'loc:location op:string expr:Expr t:Type@[backedge]'
 
 
 class BinaryOp(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int left:Expr op:string right:Expr t:Type@[backedge]'
+    __schema__ = 'loc:location left:Expr op:string right:Expr t:Type@[backedge]'
 
 
 class If(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int cond:Expr tbody:Expr fbody:Expr t:Type@[backedge]'
+    __schema__ = 'loc:location cond:Expr tbody:Expr fbody:Expr t:Type@[backedge]'
 
 
 class While(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int cond:Expr body:Expr'
+    __schema__ = 'loc:location cond:Expr body:Expr'
 
 
 class StructMatch(object, metaclass=TreeMeta):
@@ -138,11 +138,11 @@ Matcher = (StructMatch,)
 
 
 class Case(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int matcher:Matcher expr:Expr'
+    __schema__ = 'loc:location matcher:Matcher expr:Expr'
 
 
 class Match(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int cond:Expr cases:[]Case rt:Type'
+    __schema__ = 'loc:location cond:Expr cases:[]Case rt:Type'
 
 
 class PoisonExpr(object, metaclass=TreeMeta):
@@ -152,20 +152,27 @@ class PoisonExpr(object, metaclass=TreeMeta):
 Expr = (GetLocal, GetType, GetFunction, GetModule, GetField, GetMethod, DirectCall, DirectMethodCall, IndirectMethodCall, Constructor, BooleanLiteral, TupleLiteral, FloatLiteral, IntLiteral, StringLiteral, Assign, Sequence, PrefixOp, BinaryOp, If, While, Match, PoisonExpr)
 
 
+# The type of an expression that produces a value.
+def expr_type(node):
+    if isinstance(node, Match):
+        return node.rt
+    return node.t
+
+
 class SetLocal(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int lcl:Local@[backedge]'
+    __schema__ = 'loc:location lcl:Local@[backedge]'
 
 
 class SetField(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int expr:Expr field:Field@[backedge]'
+    __schema__ = 'loc:location expr:Expr field:Field@[backedge]'
 
 
 class DestructureTuple(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int args:[]Target'
+    __schema__ = 'loc:location args:[]Target'
 
 
 class DestructureStruct(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int t:Type args:[]Target'
+    __schema__ = 'loc:location t:Type args:[]Target'
 
 
 class PoisonTarget(object, metaclass=TreeMeta):
@@ -176,19 +183,19 @@ Target = (SetLocal, SetField, DestructureTuple, DestructureStruct, PoisonTarget)
 
 
 class Param(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int name:string t:Type lcl:Local@[no_init]'
+    __schema__ = 'loc:location name:string t:Type lcl:Local@[no_init]'
 
 
 class Local(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int name:string t:Type'
+    __schema__ = 'loc:location name:string t:Type'
 
 
 class Function(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int name:string module:Module overrides:BaseFunction@[no_init] is_overridden:bool@[no_init] self:Param@[no_init] params:[]Param@[no_init] t:FunctionType@[no_init] locals:[]Local@[no_init] body:Expr@[no_init]'
+    __schema__ = 'loc:location name:string module:Module overrides:BaseFunction@[no_init] is_overridden:bool@[no_init] is_final:bool@[no_init] self:Param@[no_init] params:[]Param@[no_init] t:FunctionType@[no_init] locals:[]Local@[no_init] body:Expr@[no_init]'
 
 
 class ExternFunction(object, metaclass=TreeMeta):
-    __schema__ = 'loc:int name:string module:Module is_overridden:bool@[no_init] self:Param@[no_init] params:[]Param@[no_init] t:FunctionType@[no_init]'
+    __schema__ = 'loc:location name:string module:Module is_overridden:bool@[no_init] self:Param@[no_init] params:[]Param@[no_init] t:FunctionType@[no_init]'
 
 
 BaseFunction = (Function, ExternFunction)
@@ -1,9 +1,13 @@
+import time
+
+
 def setup():
     import ritual.lang.base
     import os.path
 
     src_file = os.path.join(os.path.dirname(__file__), 'scale.ritual')
-    ritual.lang.base.generate_parser(src_file, True, globals())
+    # Identifies the grammar, for caching parsed trees.
+    grammar_key = ritual.lang.base.generate_parser(src_file, True, globals(), functions=True)
 
     def int_to_rune(i):
         return chr(i)
@@ -14,11 +18,16 @@ def setup():
     def string_to_int(text, base):
         return int(text, base)
 
-    return buildParser(
+    externs = dict(
         int_to_rune=int_to_rune,
         runes_to_string=runes_to_string,
         string_to_int=string_to_int
     )
+    return buildParser(**externs), buildFunctionParser(**externs), grammar_key
 
 
-p = setup()
+# When the grammar was loaded and how long it took, for profiling.
+_start = time.perf_counter()
+_cpu = time.process_time()
+p, compiled, grammar_key = setup()
+setup_times = (_start, time.perf_counter() - _start, time.process_time() - _cpu)
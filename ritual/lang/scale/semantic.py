@@ -1,5 +1,8 @@
 from ritual.base import TypeDispatcher, dispatch
 from collections import OrderedDict
+import bisect
+from ritual.base.profile import NULL_PROFILE
+from ritual.interpreter import is_location
 from . import model
 from . import parser
 
@@ -36,6 +39,13 @@ class SemanticPass(object):
         self.tuple_cache = {}
         self.func_cache = {}
 
+        # The namespace of the module from a previous analysis, so its objects can be reused.
+        self.previous = {}
+        # The names in other modules used by the code being resolved.
+        self.uses = None
+
+        self.profile = NULL_PROFILE
+
     def lookup(self, name):
         for ns in self._namespaces:
             if name in ns:
@@ -57,6 +67,18 @@ class SemanticPass(object):
         self._namespaces[0][name] = obj
         return True
 
+    # Reinitialize the object from the previous analysis instead of creating a new one,
+    # so references to it from modules that are not analyzed again remain valid.
+    def reclaim(self, old, cls, *args):
+        if type(old) is cls:
+            old.__init__(*args)
+            return old
+        return cls(*args)
+
+    def use(self, module, name):
+        if self.uses is not None:
+            self.uses.add((module.name, name))
+
     def define_lcl(self, loc, name, t):
         lcl = model.Local(loc, name, t)
         self.register(loc, name, lcl)
@@ -102,7 +124,7 @@ class IndexNamespace(object, metaclass=TypeDispatcher):
     def visitFuncDecl(cls, node, module, semantic):
         loc = node.name.loc
         name = node.name.text
-        f = model.Function(loc, name, module)
+        f = semantic.reclaim(semantic.previous.get(name), model.Function, loc, name, module)
         semantic.register(loc, name, f)
         return f
 
@@ -110,7 +132,9 @@ class IndexNamespace(object, metaclass=TypeDispatcher):
     def visitStructDecl(cls, node, module, semantic):
         loc = node.name.loc
         name = node.name.text
-        s = model.Struct(loc, name, node.is_ref, module, model.UserTypeTag())
+        old = semantic.previous.get(name)
+        previous = old.namespace if isinstance(old, model.Struct) else {}
+        s = semantic.reclaim(old, model.Struct, loc, name, node.is_ref, module, model.UserTypeTag())
         semantic.register(loc, name, s)
 
         fields = []
@@ -122,11 +146,11 @@ class IndexNamespace(object, metaclass=TypeDispatcher):
                 semantic.status.error('tried to redefine "%s"' % name, loc)
 
             if isinstance(m, parser.FuncDecl):
-                f = model.Function(loc, name, module)
+                f = semantic.reclaim(previous.get(name), model.Function, loc, name, module)
                 methods.append(f)
                 s.namespace[name] = f
             elif isinstance(m, parser.FieldDecl):
-                f = model.Field(loc, name, s)
+                f = semantic.reclaim(previous.get(name), model.Field, loc, name, s)
                 fields.append(f)
                 s.namespace[name] = f
             else:
@@ -140,7 +164,7 @@ class IndexNamespace(object, metaclass=TypeDispatcher):
     def visitExternFuncDecl(cls, node, module, semantic):
         loc = node.name.loc
         name = node.name.text
-        f = model.ExternFunction(loc, name, module)
+        f = semantic.reclaim(semantic.previous.get(name), model.ExternFunction, loc, name, module)
         semantic.register(loc, name, f)
         return f
 
@@ -523,6 +547,7 @@ class ResolveCode(object, metaclass=TypeDispatcher):
             return POISON_EXPR, POISON_TYPE
         elif isinstance(t, model.ModuleType):
             m = expr.m
+            semantic.use(m, name)
             obj = m.namespace.get(name)
             if obj is None:
                 semantic.status.error('cannot get attribute "%s" of %s' % (name, PrintableTypeName.visit(t)), loc)
@@ -912,8 +937,7 @@ def init_builtins(ns, semantic):
 
     return builtin
 
-def process(modules, status):
-    semantic = SemanticPass(status)
+def create_program(modules, semantic):
     module = init_builtins(semantic.builtins, semantic)
 
     # Create module objects
@@ -928,38 +952,291 @@ def process(modules, status):
         assert m.name not in semantic.modules, m.name
         semantic.modules[m.name] = module
         p.modules.append(module)
+    return p
+
+
+# Analyze the declarations of the modules, up to but not including function bodies.
+# Modules that were analyzed before reuse the objects of their previous analysis.
+def resolve_declarations(p, modules, semantic):
+    status = semantic.status
+    profile = semantic.profile
 
     # Create the objects contained in each module.
-    for m in modules:
-        module = semantic.modules[m.name]
-        IndexNamespace.visit(m, module, semantic)
+    with profile.phase('index'):
+        for m in modules:
+            module = semantic.modules[m.name]
+            semantic.previous = module.namespace
+            module.__init__(m.name)
+            IndexNamespace.visit(m, module, semantic)
+        semantic.previous = {}
     status.halt_if_errors()
 
     # Resolve type inheritance.
-    for m in modules:
-        module = semantic.modules[m.name]
-        ResolveInheritance.visit(m, module, semantic)
+    with profile.phase('inheritance'):
+        for m in modules:
+            module = semantic.modules[m.name]
+            ResolveInheritance.visit(m, module, semantic)
     status.halt_if_errors()
 
     # Evaluate without fields to check for inheritance loops.
     # Inheritance loops can make field lookups hang.
-    check_for_type_loops(p, status)
+    with profile.phase('check_for_type_loops'):
+        check_for_type_loops(p, status)
     status.halt_if_errors()
 
     # Resolve field and parameter types.
-    for m in modules:
-        module = semantic.modules[m.name]
-        ResolveSignatures.visit(m, module, semantic)
+    with profile.phase('signatures'):
+        for m in modules:
+            module = semantic.modules[m.name]
+            ResolveSignatures.visit(m, module, semantic)
     status.halt_if_errors()
 
     # Now that field are resolved, check there are no loops in value type embedding.
-    check_for_type_loops(p, status)
+    with profile.phase('check_for_type_loops'):
+        check_for_type_loops(p, status)
     status.halt_if_errors()
 
+
+def resolve_code(m, semantic):
+    with semantic.profile.phase('code', m.name):
+        ResolveCode.visit(m, semantic.modules[m.name], semantic)
+
+
+def process(modules, status, profile=NULL_PROFILE):
+    semantic = SemanticPass(status)
+    semantic.profile = profile
+    p = create_program(modules, semantic)
+    resolve_declarations(p, modules, semantic)
+
     # Resolve function bodies.
     for m in modules:
-        module = semantic.modules[m.name]
-        ResolveCode.visit(m, module, semantic)
+        resolve_code(m, semantic)
     status.halt_if_errors()
 
     return p
+
+
+def type_key(t):
+    if isinstance(t, model.Struct):
+        return (t.module.name, t.name)
+    elif isinstance(t, model.TupleType):
+        return ('tuple',) + tuple([type_key(child) for child in t.children])
+    elif isinstance(t, model.FunctionType):
+        return ('func', tuple([type_key(param) for param in t.params]), type_key(t.rt))
+    else:
+        return type(t).__name__
+
+
+def decl_key(obj):
+    if isinstance(obj, model.Struct):
+        parent = obj.parent.name if obj.parent else None
+        fields = tuple([(f.name, type_key(f.t)) for f in obj.fields])
+        methods = tuple([decl_key(f) for f in obj.methods])
+        return ('struct', obj.name, obj.is_ref, parent, fields, methods)
+    elif isinstance(obj, model.BaseFunction):
+        return (type(obj).__name__, obj.name, type_key(obj.t), obj.is_overridden)
+    elif isinstance(obj, model.Module):
+        return ('module', obj.name)
+    else:
+        assert False, obj
+
+
+def structs_in_type(t):
+    if isinstance(t, model.Struct):
+        yield t
+    elif isinstance(t, model.TupleType):
+        for child in t.children:
+            yield from structs_in_type(child)
+    elif isinstance(t, model.FunctionType):
+        for param in t.params:
+            yield from structs_in_type(param)
+        yield from structs_in_type(t.rt)
+
+
+def referenced_structs(obj):
+    if isinstance(obj, model.Struct):
+        if obj.parent:
+            yield obj.parent
+        for f in obj.fields:
+            yield from structs_in_type(f.t)
+        for f in obj.methods:
+            yield from structs_in_type(f.t)
+    elif isinstance(obj, model.BaseFunction):
+        yield from structs_in_type(obj.t)
+
+
+# What code in other modules can observe about a declaration.
+# This includes the structures reachable from its types, as fields and methods
+# of those structures can be used without naming them.
+def signature(obj):
+    keys = []
+    pending = [obj]
+    visited = set()
+    while pending:
+        obj = pending.pop()
+        if id(obj) in visited:
+            continue
+        visited.add(id(obj))
+        keys.append(decl_key(obj))
+        pending.extend([s for s in referenced_structs(obj) if s.module.name != 'builtin'])
+    return tuple(keys)
+
+
+def module_signatures(module):
+    return dict([(name, signature(obj)) for name, obj in module.namespace.items()])
+
+
+def reset_code(module):
+    for f in module.funcs:
+        f.locals = []
+        f.body = None
+    for s in module.structs:
+        for f in s.methods:
+            f.locals = []
+            f.body = None
+    module.tests = []
+
+
+# Move the locations in the model from where their sources were to where they are now.
+# "moves" holds the (begin, end, delta) of each source that moved.
+def rebase_locations(p, moves):
+    moves = sorted(moves)
+    begins = [move[0] for move in moves]
+    pending = list(p.modules)
+    visited = set()
+    while pending:
+        value = pending.pop()
+        if isinstance(value, list):
+            pending.extend(value)
+            continue
+        fields = getattr(type(value), '__fields__', None)
+        if fields is None or id(value) in visited:
+            continue
+        visited.add(id(value))
+        for f in fields:
+            child = getattr(value, f.name)
+            if is_location(f.t):
+                i = bisect.bisect_right(begins, child) - 1
+                if i >= 0 and child < moves[i][1]:
+                    setattr(value, f.name, child + moves[i][2])
+            elif 'backedge' not in f.attrs:
+                pending.append(child)
+
+
+# Semantic analysis that is kept between compilations.
+# A module is analyzed again if its parse tree is a different object than last time,
+# otherwise the model of the previous compilation is reused.
+# Of the modules that use an edited module, only those that use a name whose
+# signature changed have their code resolved again.
+class IncrementalSemantic(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.semantic = None
+        self.program = None
+        self.trees = OrderedDict()
+        self.sources = {}
+        self.signatures = {}
+        self.uses = {}
+        # Module => the modules whose code inlining copied into it.
+        self.copied = {}
+        # The budget the kept code was inlined with.
+        self.inline_budget = None
+
+        # The modules whose declarations and code were analyzed by the last compilation.
+        self.declared = []
+        self.resolved = []
+
+    def process(self, modules, status, profile=NULL_PROFILE):
+        try:
+            return self.update(modules, status, profile)
+        except Exception:
+            # The model may be partially updated, so start over next time.
+            self.reset()
+            raise
+
+    # Optimizations change the code in place, so code that is kept was optimized by a previous compilation.
+    # Code copied from other modules makes it depend on more than the uses of the module.
+    def record_copies(self, copied, inline_budget):
+        for name in self.resolved:
+            self.copied[name] = copied.get(name, set())
+        self.inline_budget = inline_budget
+
+    def update(self, modules, status, profile):
+        sources = dict([(source.filename, (source.begin, source.end)) for source in status.sources])
+        if self.semantic is None or [m.name for m in modules] != list(self.trees):
+            self.reset()
+            self.semantic = SemanticPass(status)
+            self.program = create_program(modules, self.semantic)
+            changed = modules
+        else:
+            changed = [m for m in modules if m is not self.trees[m.name]]
+        semantic = self.semantic
+        semantic.status = status
+        semantic.profile = profile
+        p = self.program
+
+        changed_names = set([m.name for m in changed])
+        moves = []
+        for m in modules:
+            if m.name not in changed_names:
+                old_begin, old_end = self.sources[m.name]
+                begin = sources[m.path][0]
+                if begin != old_begin:
+                    moves.append((old_begin, old_end, begin - old_begin))
+        if moves:
+            with profile.phase('rebase_locations'):
+                rebase_locations(p, moves)
+
+        resolve_declarations(p, changed, semantic)
+
+        # Find the names whose signatures changed.
+        dirty = set()
+        for m in changed:
+            old = self.signatures.get(m.name, {})
+            new = module_signatures(semantic.modules[m.name])
+            for name in set(old) | set(new):
+                if old.get(name) != new.get(name):
+                    dirty.add((m.name, name))
+            self.signatures[m.name] = new
+
+        # Resolve the code of the changed modules, and the code that depends on them.
+        stale = set(changed_names)
+        for m in modules:
+            if m.name not in changed_names and self.uses[m.name] & dirty:
+                stale.add(m.name)
+        # Code copied from a module that is resolved again is stale as well.
+        growing = True
+        while growing:
+            growing = False
+            for name, copied in self.copied.items():
+                if name not in stale and copied & stale:
+                    stale.add(name)
+                    growing = True
+        resolved = []
+        for m in modules:
+            if m.name in stale:
+                if m.name not in changed_names:
+                    reset_code(semantic.modules[m.name])
+                resolved.append(m)
+
+        for m in resolved:
+            semantic.uses = set()
+            resolve_code(m, semantic)
+            self.uses[m.name] = semantic.uses
+        semantic.uses = None
+        status.halt_if_errors()
+
+        for m in modules:
+            self.trees[m.name] = m
+            self.sources[m.name] = sources[m.path]
+        self.declared = [m.name for m in changed]
+        self.resolved = [m.name for m in resolved]
+        profile.count('modules_declared', len(self.declared))
+        profile.count('modules_resolved', len(self.resolved))
+        semantic.profile = NULL_PROFILE
+
+        # The entrypoint is found again by the caller.
+        p.entrypoint = None
+        return p
@@ -0,0 +1,704 @@
+import contextlib
+import io
+import os.path
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from ritual.interpreter.location import CompileStatus, HaltCompilation
+import sc
+
+from . import compile
+from . import devirtualize
+from . import fold
+from . import generate_cpp
+from . import inline
+from . import model
+from . import semantic
+
+
+SCALE_SRC = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'scale_src')
+RUNTIME = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'libscale', 'runtime.cc')
+CXX = shutil.which('clang++') or shutil.which('g++')
+
+
+# Compiles a program whose main module is "src", against the system modules.
+def compile_source(src):
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, 'main.scale'), 'w') as f:
+            f.write(src)
+        p, _ = compile.frontend(os.path.join(SCALE_SRC, 'system'), directory, ['main'], CompileStatus())
+    return p
+
+
+def main_module(p):
+    return [m for m in p.modules if m.name == 'main'][0]
+
+
+def model_locations(p):
+    locations = []
+    pending = [p]
+    visited = set()
+    while pending:
+        value = pending.pop()
+        if isinstance(value, list):
+            pending.extend(reversed(value))
+            continue
+        fields = getattr(type(value), '__fields__', None)
+        if fields is None or id(value) in visited:
+            continue
+        visited.add(id(value))
+        for f in fields:
+            if f.name == 'loc':
+                locations.append((type(value).__name__, value.loc))
+            elif 'backedge' not in f.attrs:
+                pending.append(getattr(value, f.name))
+    return locations
+
+
+class TestIncrementalSemantic(unittest.TestCase):
+
+    def test_incremental_semantic(self):
+        with tempfile.TemporaryDirectory() as directory:
+            shutil.copytree(SCALE_SRC, os.path.join(directory, 'src'))
+            system = os.path.join(directory, 'src', 'system')
+            user = os.path.join(directory, 'src', 'user')
+            cache = compile.ParseCache()
+            incremental = semantic.IncrementalSemantic()
+
+            def check(declared, resolved):
+                status = CompileStatus()
+                p, _ = compile.frontend(system, user, ['main'], status, cache, 1, incremental)
+                self.assertEqual(incremental.declared, declared)
+                self.assertEqual(incremental.resolved, resolved)
+
+                expected, _ = compile.frontend(system, user, ['main'], CompileStatus())
+                self.assertEqual(model_locations(p), model_locations(expected))
+                results = []
+                for program in [p, expected]:
+                    out = io.StringIO()
+                    generate_cpp.generate_source(program, out, CompileStatus())
+                    results.append(out.getvalue())
+                self.assertEqual(results[0], results[1])
+
+            def edit(path, old, new):
+                path = os.path.join(directory, 'src', path)
+                with open(path) as f:
+                    text = f.read()
+                self.assertIn(old, text)
+                with open(path, 'w') as f:
+                    f.write(text.replace(old, new, 1))
+
+            modules = ['main', 'std', 'foo.bar', 'spec.control', 'spec.numeric', 'spec.struct', 'spec.text']
+            check(modules, modules)
+            check([], [])
+
+            # Changing code does not change what other modules see.
+            edit('user/foo/bar.scale', '    v\n', '    v + 0\n')
+            check(['foo.bar'], ['foo.bar'])
+
+            # Neither does moving the modules after it.
+            edit('system/std.scale', 'extern fn abort();', '\n\nextern fn abort();')
+            check(['std'], ['std'])
+
+            # A new name is not used by anyone yet.
+            edit('user/foo/bar.scale', 'fn name_conflict()', 'fn unused() {}\n\nfn name_conflict()')
+            check(['foo.bar'], ['foo.bar'])
+
+            # Changing the signature of a name main uses.
+            edit('user/foo/bar.scale', 'fn name_conflict() -> i32 {\n    11\n}', 'extern fn name_conflict() -> i32;')
+            check(['foo.bar'], ['main', 'foo.bar'])
+
+            # Errors discard the previous analysis.
+            edit('user/foo/bar.scale', 'fn passthrough(v:i32)', 'fn passthrough(v:i64)')
+            with self.assertRaises(HaltCompilation):
+                compile.frontend(system, user, ['main'], CompileStatus(), cache, 1, incremental)
+            edit('user/foo/bar.scale', 'fn passthrough(v:i64)', 'fn passthrough(v:i32)')
+            check(modules, modules)
+
+    def test_inlined_code(self):
+        sources = {
+            'main.scale': """import shapes;
+import extra;
+
+extern fn sink(v:i32);
+
+fn main() {
+    let a = shapes.A(1);
+    sink(shapes.twice(a.get()));
+}
+""",
+            'shapes.scale': """class A {
+    a:i32;
+    fn get() -> i32 {
+        self.a
+    }
+}
+
+fn twice(v:i32) -> i32 {
+    v * 2
+}
+""",
+            'extra.scale': """import shapes;
+
+fn unused() -> i32 {
+    1
+}
+""",
+        }
+
+        # The whole program optimizations, as the compiler runs them.
+        def optimize(p, incremental):
+            fold.fold_constants(p)
+            devirtualize.devirtualize(p)
+            modules = incremental.resolved if incremental is not None else None
+            inliner = inline.inline_functions(p, inline.DEFAULT_BUDGET, modules=modules)
+            if incremental is not None:
+                incremental.record_copies(inliner.copied, inline.DEFAULT_BUDGET)
+            if inliner.inlined:
+                fold.fold_constants(p)
+            out = io.StringIO()
+            generate_cpp.generate_source(p, out, CompileStatus())
+            return out.getvalue()
+
+        system = os.path.join(SCALE_SRC, 'system')
+        with tempfile.TemporaryDirectory() as directory:
+            for name, text in sources.items():
+                with open(os.path.join(directory, name), 'w') as f:
+                    f.write(text)
+            cache = compile.ParseCache()
+            incremental = semantic.IncrementalSemantic()
+
+            def check(declared, resolved):
+                p, _ = compile.frontend(system, directory, ['main'], CompileStatus(), cache, 1, incremental)
+                self.assertEqual(incremental.declared, declared)
+                self.assertEqual(incremental.resolved, resolved)
+                result = optimize(p, incremental)
+                expected, _ = compile.frontend(system, directory, ['main'], CompileStatus())
+                self.assertEqual(result, optimize(expected, None))
+                return result
+
+            def edit(name, old, new):
+                sources[name] = sources[name].replace(old, new, 1)
+                with open(os.path.join(directory, name), 'w') as f:
+                    f.write(sources[name])
+
+            modules = ['main', 'shapes', 'extra']
+            main = check(modules, modules).split('f_main_main(void) {')[1].split('\n}\n')[0]
+            self.assertNotIn('f_shapes_twice(', main)
+            # The kept code is already optimized.
+            check([], [])
+
+            # Code copied from a module is resolved again with it.
+            edit('shapes.scale', 'v * 2', 'v * 3')
+            check(['shapes'], ['main', 'shapes'])
+            check([], [])
+            edit('extra.scale', '    1\n', '    2\n')
+            check(['extra'], ['extra'])
+
+            # A new override means the copied method is no longer the one called.
+            edit('shapes.scale', 'fn twice', 'class B : A {\n    fn get() -> i32 {\n        0\n    }\n}\n\nfn twice')
+            self.assertIn('->get()', check(['shapes'], ['main', 'shapes']))
+
+
+class TestGenerateCpp(unittest.TestCase):
+
+    def test_sort_structs(self):
+        m = model.Module('m')
+        status = CompileStatus()
+        text = 'struct G {}\nstruct H {}\n'
+        begin = status.add_source('m.scale', text)
+        locs = {'G': begin, 'H': begin + text.index('struct H')}
+
+        def struct(name, is_ref, *fields):
+            s = model.Struct(locs.get(name, begin), name, is_ref, m, model.UserTypeTag())
+            for t in fields:
+                f = model.Field(0, t.name.lower(), s)
+                f.t = t
+                s.fields.append(f)
+            return s
+
+        def names(structs):
+            return [s.name for s in generate_cpp.sort_structs(structs, status)]
+
+        a = struct('A', False)
+        b = struct('B', False, a)
+        c = struct('C', False)
+        c.parent = b
+        d = struct('D', False)
+        self.assertEqual(names([c, d, b, a]), ['D', 'A', 'B', 'C'])
+        self.assertEqual(names([a, b, c, d]), ['A', 'B', 'C', 'D'])
+
+        # References are only a preference, so cycles through them are allowed.
+        e = struct('E', True)
+        f = struct('F', True, e)
+        e.fields.append(model.Field(0, 'f', e))
+        e.fields[-1].t = f
+        self.assertEqual(names([f, e]), ['F', 'E'])
+        # Only the references that form the cycle are given up.
+        k = struct('K', True, e)
+        self.assertEqual(names([k, e, f]), ['E', 'F', 'K'])
+
+        g = struct('G', False, a)
+        h = struct('H', False, g)
+        g.fields[0].t = h
+        out = io.StringIO()
+        with self.assertRaises(HaltCompilation), contextlib.redirect_stdout(out):
+            generate_cpp.sort_structs([g, h], status)
+        self.assertEqual(status.errors, 1)
+        self.assertIn('m.scale:1:0: error: recursive structures: m.G -> m.H -> m.G', out.getvalue())
+        self.assertIn('m.scale:2:0', out.getvalue())
+
+    def test_sort_struct_cycles(self):
+        m = model.Module('m')
+
+        def struct(name, is_ref):
+            return model.Struct(0, name, is_ref, m, model.UserTypeTag())
+
+        def field(s, t):
+            f = model.Field(0, t.name.lower(), s)
+            f.t = t
+            s.fields.append(f)
+
+        # Many independent cycles are all broken by a single pass.
+        structs = []
+        count = 2000
+        for i in range(count):
+            a = struct('A%d' % i, True)
+            b = struct('B%d' % i, True)
+            c = struct('C%d' % i, False)
+            field(a, b)
+            field(b, a)
+            field(a, c)
+            structs += [a, b, c]
+        names = [s.name for s in generate_cpp.sort_structs(structs, CompileStatus())]
+        expected = [name for i in range(count) for name in ['B%d' % i, 'C%d' % i]]
+        expected += ['A%d' % i for i in range(count)]
+        self.assertEqual(names, expected)
+
+    def test_number_structs(self):
+        m = model.Module('m')
+
+        def struct(name, parent, is_ref=True):
+            s = model.Struct(0, name, is_ref, m, model.UserTypeTag())
+            s.parent = parent
+            return s
+
+        a = struct('A', None)
+        b = struct('B', a)
+        c = struct('C', b)
+        d = struct('D', a)
+        e = struct('E', None)
+        v = struct('V', None, False)
+        tags = generate_cpp.number_structs([a, b, c, d, e, v])
+        self.assertEqual(tags, {a: (1, 5), b: (2, 4), c: (3, 4), d: (4, 5), e: (5, 6)})
+
+        gen = generate_cpp.Generator(io.StringIO(), CompileStatus())
+        gen.type_tags = tags
+        self.assertTrue(generate_cpp.has_type_tag(c, gen))
+        self.assertFalse(generate_cpp.has_type_tag(e, gen))
+
+        # The first case to match a type takes it, so later cases may not get any.
+        def match(t, *cases):
+            cond = model.GetLocal(0, model.Local(0, 'v', t), t)
+            cases = [model.Case(0, model.StructMatch(ct), model.IntLiteral(0, i, t)) for i, ct in enumerate(cases)]
+            return generate_cpp.match_arms(model.Match(0, cond, cases, t), gen)
+
+        self.assertEqual(match(a, c, b, a), [[3], [2], [1, 4]])
+        self.assertEqual(match(a, a, b), [[1, 2, 3, 4], []])
+        self.assertEqual(match(b, d, c), [[], [3]])
+
+    def test_arena_memory(self):
+        p, _ = compile.frontend(os.path.join(SCALE_SRC, 'system'), os.path.join(SCALE_SRC, 'user'), ['main'], CompileStatus())
+        results = {}
+        for memory in generate_cpp.MEMORY_MODES:
+            out = io.StringIO()
+            generate_cpp.generate_source(p, out, CompileStatus(), memory=memory)
+            results[memory] = out.getvalue()
+
+        self.assertIn('std::make_shared<s_spec_struct_Child>(', results['shared'])
+        arena = results['arena']
+        self.assertNotIn('shared_ptr', arena)
+        self.assertNotIn('make_shared', arena)
+        self.assertIn('scale_new<s_spec_struct_Child>(', arena)
+        self.assertIn('s_spec_struct_Child* ', arena)
+        self.assertIn('scale_arena_reset();', arena)
+
+
+class TestDevirtualize(unittest.TestCase):
+
+    def test_devirtualize(self):
+        src = """import std;
+
+class A {
+    a:i32;
+    fn get() -> i32 {
+        self.a
+    }
+}
+
+class B : A {
+    fn get() -> i32 {
+        0
+    }
+}
+
+class C : A {
+}
+
+fn main() {
+    let a = A(1);
+    let c = C(2);
+    std.assertEqualI32(a.get() + c.get(), 3);
+}
+"""
+        p = compile_source(src)
+        m = main_module(p)
+        a, b, c = m.structs
+        add = m.funcs[0].body.children[2].args[0]
+        calls = [add.left, add.right]
+
+        # Both calls resolve to A.get, which B overrides.
+        self.assertIsInstance(calls[0], model.IndirectMethodCall)
+        self.assertIsInstance(calls[1], model.IndirectMethodCall)
+
+        # Running again reconsiders the calls it devirtualized, so it finds the same ones.
+        for i in range(2):
+            self.assertEqual(devirtualize.devirtualize(p), 1)
+            self.assertIs(add.left, calls[0])
+            self.assertIsInstance(add.right, model.DirectMethodCall)
+            self.assertTrue(add.right.devirtualized)
+            self.assertIs(add.right.f, a.namespace['get'])
+            self.assertEqual([s.is_final for s in m.structs], [False, True, True])
+            self.assertEqual([f.is_final for f in b.methods], [True])
+            self.assertEqual([f.is_final for f in a.methods], [False])
+
+        out = io.StringIO()
+        generate_cpp.generate_source(p, out, CompileStatus())
+        self.assertIn('struct s_main_B final : public s_main_A {', out.getvalue())
+        self.assertIn('override final {', out.getvalue())
+
+
+class TestFoldConstants(unittest.TestCase):
+
+    def test_fold_constants(self):
+        src = """
+fn wrap_i8() -> i8 {
+    127i8 + 1i8
+}
+
+fn wrap_u8() -> u8 {
+    65u8 * 65u8
+}
+
+fn negate_u32() -> u32 {
+    -1u32
+}
+
+fn div() -> i32 {
+    -7 / 2
+}
+
+fn mod() -> i32 {
+    -7 % 2
+}
+
+fn div_zero() -> i32 {
+    1 / 0
+}
+
+fn div_overflow() -> i32 {
+    (-2147483647 - 1) / -1
+}
+
+fn float() -> f32 {
+    1.0 + 2.0
+}
+
+fn compare() -> bool {
+    !(3u8 < 2u8) == (true != false)
+}
+
+fn propagate() -> i64 {
+    let a = 3i64;
+    let b = a * 4i64;
+    b + 1i64
+}
+
+fn reassigned(c:bool) -> i32 {
+    let a = 1;
+    if c {
+        a = 2;
+    };
+    a
+}
+
+fn prune() -> i32 {
+    if 1 > 2 {
+        let unused = 3;
+        unused
+    } else {
+        4
+    }
+}
+
+fn interpolate(v:i32) -> string {
+    "{v}{1 + 2}{true}-{"x"}"
+}
+
+fn sink(v:i32) {
+}
+
+fn dead_store(v:i32) {
+    let unused = v * 2;
+    let used = v;
+    sink(used);
+}
+
+fn unused_div(v:i32) {
+    let q = v / 0;
+    v / 2;
+    v % 0;
+    sink(v);
+}
+"""
+        p = compile_source('fn main() {}\n' + src)
+        self.assertGreater(fold.fold_constants(p), 0)
+        funcs = dict([(f.name, f) for f in main_module(p).funcs])
+
+        def result(name):
+            body = funcs[name].body
+            while isinstance(body, model.Sequence) and len(body.children) == 1:
+                body = body.children[0]
+            return body
+
+        def literal(name):
+            body = result(name)
+            self.assertIsInstance(body, (model.IntLiteral, model.BooleanLiteral, model.StringLiteral), name)
+            return body.value
+
+        self.assertEqual(literal('wrap_i8'), -128)
+        self.assertEqual(literal('wrap_u8'), 129)
+        self.assertEqual(literal('negate_u32'), 0xffffffff)
+        self.assertEqual(literal('div'), -3)
+        self.assertEqual(literal('mod'), -1)
+        self.assertEqual(literal('compare'), True)
+        self.assertEqual(literal('propagate'), 13)
+        self.assertEqual(funcs['propagate'].locals, [])
+        self.assertEqual(literal('prune'), 4)
+        self.assertEqual(funcs['prune'].locals, [])
+
+        # Left for runtime.
+        self.assertIsInstance(result('div_zero'), model.BinaryOp)
+        div_overflow = result('div_overflow')
+        self.assertIsInstance(div_overflow, model.BinaryOp)
+        self.assertEqual(div_overflow.left.value, -2147483648)
+        self.assertIsInstance(result('float'), model.BinaryOp)
+        self.assertIsInstance(result('reassigned').children[-1], model.GetLocal)
+
+        # Everything after the interpolated variable is one piece.
+        interpolate = result('interpolate')
+        self.assertIsInstance(interpolate, model.BinaryOp)
+        self.assertIsInstance(interpolate.left, model.DirectMethodCall)
+        self.assertEqual(interpolate.right.value, '31-x')
+
+        # Only the value of a store to a local that is never read is evaluated.
+        dead_store = funcs['dead_store']
+        self.assertEqual([lcl.name for lcl in dead_store.locals], ['v', 'used'])
+        self.assertTrue(fold.is_nop(dead_store.body.children[0]))
+
+        # Division that may trap is kept even though its value is unused.
+        unused_div = funcs['unused_div'].body.children
+        self.assertEqual(len(unused_div), 3)
+        self.assertIsInstance(unused_div[0], model.Assign)
+        self.assertEqual(unused_div[0].value.op, '/')
+        self.assertIsInstance(unused_div[1], model.BinaryOp)
+        self.assertEqual(unused_div[1].op, '%')
+
+        # Folding again finds nothing more.
+        self.assertEqual(fold.fold_constants(p), 0)
+
+    def test_constant_if_statement(self):
+        src = """
+fn sink(v:i32) {
+}
+
+fn update(c:bool) -> i32 {
+    let x = 1;
+    if c {
+        x = 5
+    };
+    x
+}
+
+fn direct() {
+    let x = 1;
+    if true {
+        x = 5
+    };
+    sink(x);
+}
+
+fn main() {
+    sink(update(true));
+}
+"""
+        p = compile_source(src)
+        fold.fold_constants(p)
+        funcs = dict([(f.name, f) for f in main_module(p).funcs])
+        # The assignment is taken in place of the If.
+        self.assertIsInstance(funcs['direct'].body.children[1], model.Assign)
+
+        # Inlining makes the condition constant.
+        self.assertGreater(inline.inline_functions(p).inlined, 0)
+        fold.fold_constants(p)
+        out = io.StringIO()
+        generate_cpp.generate_source(p, out, CompileStatus())
+        self.assertNotIn('if (', out.getvalue().split('static void f_main_main(void) {')[1].split('\n}\n')[0])
+
+
+class TestInlineFunctions(unittest.TestCase):
+
+    def test_inline_functions(self):
+        src = """
+class Box {
+    value:i32;
+    fn get() -> i32 {
+        self.value
+    }
+}
+
+struct Pair {
+    a:i32;
+    fn swap() {
+        self.a = 0 - self.a;
+    }
+}
+
+fn add(a:i32, b:i32) -> i32 {
+    let c = a + b;
+    c
+}
+
+fn countdown(n:i32) -> i32 {
+    if n > 0 {
+        countdown(n - 1)
+    } else {
+        0
+    }
+}
+
+fn main() {
+    let box = Box(1);
+    let pair = Pair(2);
+    add(box.get(), add(3, 4));
+    countdown(5);
+    pair.swap()
+}
+"""
+        programs = [compile_source(src) for i in range(2)]
+
+        def main_of(p):
+            return [f for f in main_module(p).funcs if f.name == 'main'][0]
+
+        # A budget of zero disables inlining.
+        self.assertEqual(inline.inline_functions(programs[0], 0).inlined, 0)
+
+        p = programs[1]
+        inliner = inline.inline_functions(p)
+        self.assertEqual(inliner.copied['main'], set())
+        main = main_of(p)
+        names = [lcl.name for lcl in main.locals]
+        self.assertEqual(names[:2], ['box', 'pair'])
+        self.assertIn('inline_0_self', names)
+        self.assertEqual(len([name for name in names if name.endswith('_c')]), 2)
+
+        calls = main.body.children[2:]
+        # The arguments are evaluated first, in order.
+        self.assertIsInstance(calls[0], model.Sequence)
+        self.assertIsInstance(calls[0].children[0].value, model.Sequence)
+        self.assertIsInstance(calls[0].children[1].value, model.Sequence)
+        # Recursion is copied once and the copy calls the original.
+        self.assertIsInstance(calls[1], model.Sequence)
+        recursive = calls[1].children[-1].tbody
+        while isinstance(recursive, model.Sequence):
+            recursive = recursive.children[-1]
+        self.assertIsInstance(recursive, model.DirectCall)
+        self.assertEqual(recursive.f.name, 'countdown')
+        # Methods on values modify self, so they are not copied.
+        self.assertIsInstance(calls[2], model.DirectMethodCall)
+
+        # The copies are independent of the original.
+        add = [f for f in main.module.funcs if f.name == 'add'][0]
+        self.assertEqual([lcl.name for lcl in add.locals], ['a', 'b', 'c'])
+
+        out = io.StringIO()
+        generate_cpp.generate_source(p, out, CompileStatus())
+        self.assertNotIn('f_main_add(', out.getvalue().split('static void f_main_main(void) {')[1])
+
+    @unittest.skipUnless(CXX, 'no C++ compiler')
+    def test_inlined_receiver(self):
+        src = """import std;
+
+fn add(a:i32, b:i32) -> i32 {
+    a + b
+}
+
+fn fact(n:i32) -> i32 {
+    if n > 1 {
+        n * fact(n - 1)
+    } else {
+        1
+    }
+}
+
+fn check(x:i32) {
+    std.assert(add(x, 1).to_string() == "3");
+    std.assert(fact(5).to_string() == "120");
+}
+
+fn main() {
+    check(2);
+}
+"""
+        p = compile_source(src)
+        fold.fold_constants(p)
+        devirtualize.devirtualize(p)
+        self.assertGreater(inline.inline_functions(p).inlined, 0)
+        fold.fold_constants(p)
+
+        # Self is passed by reference, which only compiles if the receiver is stored.
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, 'main.cc')
+            binary = os.path.join(directory, 'main')
+            with open(source, 'w') as f:
+                generate_cpp.generate_source(p, f, CompileStatus())
+            subprocess.run([CXX, '-std=c++14', '-Wall', '-Werror', '-Wno-unused-function', source, RUNTIME, '-o', binary], check=True)
+            result = subprocess.run([binary], stdout=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(result.returncode, 0)
+        self.assertIn('DONE', result.stdout)
+
+
+class TestServer(unittest.TestCase):
+
+    def test_failed_request(self):
+        cache = compile.ParseCache()
+        incremental = semantic.IncrementalSemantic()
+        with tempfile.TemporaryDirectory() as directory:
+            def request(out):
+                argv = ['--system', os.path.abspath(os.path.join(SCALE_SRC, 'system')), '--root', os.path.abspath(os.path.join(SCALE_SRC, 'user')), '--module', 'main', '--out', out]
+                return sc.handle_request({'cwd': directory, 'argv': argv}, cache, incremental)
+
+            # Writing into a missing directory raises rather than reporting a compile error.
+            response = request(os.path.join('missing', 'main.cc'))
+            self.assertEqual(response['status'], 1)
+            self.assertIn('Traceback', response['stderr'])
+            self.assertEqual(cache.modules, {})
+            self.assertIsNone(incremental.semantic)
+
+            # The next request is served from scratch.
+            response = request('main.cc')
+            self.assertEqual(response['status'], 0, response['stderr'])
+            self.assertTrue(os.path.exists(os.path.join(directory, 'main.cc')))
+            self.assertIn('main', incremental.resolved)
@@ -1,6 +1,11 @@
+import mmap
 import os.path
+import tempfile
 import unittest
 
+from ritual.base.profile import Profile
+from ritual.interpreter.chunked import ChunkedStream
+from ritual.interpreter.location import CompileStatus
 from ritual.interpreter.testutil import ParserTestCase
 
 from . import parser
@@ -34,3 +39,117 @@ class TestParser(ParserTestCase):
                 parser.GetName(40, parser.Token(40, 'a')),
             ]),
         ))
+
+    def test_compiled_parser_matches(self):
+        root = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'scale_src')
+        for dirpath, dirnames, filenames in os.walk(root):
+            for fn in filenames:
+                path = os.path.join(dirpath, fn)
+                with open(path) as f:
+                    text = f.read()
+                expected = parser.p.parse('module', ['test', path], text)
+                self.assertTrue(expected.ok)
+                self.assertEqual(parser.compiled.parse('module', ['test', path], text), expected)
+
+    def test_chunked_parser_matches(self):
+        root = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'scale_src')
+        for dirpath, dirnames, filenames in os.walk(root):
+            for fn in filenames:
+                path = os.path.join(dirpath, fn)
+                with open(path, 'rb') as f:
+                    text = f.read().decode('utf-8')
+                    expected = parser.p.parse('module', ['test', path], text)
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                        result = parser.p.parse('module', ['test', path], ChunkedStream(m, chunk_size=256, window=4096))
+                self.assertEqual(result, expected)
+
+    def test_parse_cache(self):
+        path = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'scale_src', 'system', 'std.scale')
+        with tempfile.TemporaryDirectory() as directory:
+            status = CompileStatus()
+            original = compile.parse_file('std', path, status, compile.ParseCache(directory))
+
+            # A fresh cache finds the tree on disk, and moves it to the new location.
+            status = CompileStatus()
+            status.add_source('padding', 'x' * 100)
+            cache = compile.ParseCache(directory)
+            m = compile.parse_file('std', path, status, cache)
+            self.assertEqual(cache.hits, 1)
+            self.assertIsNot(m, original)
+            with open(path) as f:
+                expected = parser.compiled.parse('module', ['std', path], f.read(), status.begins[-1])
+            self.assertEqual(m, expected.value)
+
+            # The tree is reused from memory, and moved again.
+            status = CompileStatus()
+            self.assertIs(compile.parse_file('std', path, status, cache), m)
+            self.assertEqual(cache.hits, 2)
+            self.assertEqual(m, original)
+
+    def test_parse_counters(self):
+        path = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'scale_src', 'system', 'std.scale')
+        p = Profile()
+        cache = compile.ParseCache()
+        sources = []
+        for i in range(2):
+            compile.parse_file('std', path, CompileStatus(), cache, p, sources)
+        # Only the parse that missed the cache is counted, after it is timed.
+        self.assertEqual([source[0] for source in sources], ['std'])
+        parsed, cached = [phase for phase in p.phases if phase.name == 'parse']
+        self.assertNotIn('rule_calls', parsed.counters)
+        self.assertEqual(cached.counters['parse_cache_hits'], 1)
+
+        compile.count_rules(sources, p)
+        counted = [phase for phase in p.phases if phase.name == 'count_rules']
+        self.assertEqual([phase.module for phase in counted], ['std'])
+        self.assertGreater(counted[0].counters['rule_calls'], 0)
+        self.assertGreater(counted[0].counters['backtracks'], 0)
+
+    def test_parse_parallel(self):
+        root = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'scale_src')
+        results = []
+        for jobs in [1, 2]:
+            status = CompileStatus()
+            loader = compile.ModuleLoader(os.path.join(root, 'system'), os.path.join(root, 'user'), status)
+            loader.require_module(['main'], None)
+            if jobs > 1:
+                modules = compile.parse_modules_parallel(loader, status, None, jobs)
+            else:
+                modules = []
+                while loader.pending:
+                    module_path, fn = loader.pending.pop(0)
+                    m = compile.parse_file('.'.join(module_path), fn, status)
+                    compile.FindImports.visit(m, loader)
+                    modules.append(m)
+            results.append((modules, status.begins, [source.filename for source in status.sources]))
+        self.assertGreater(len(results[0][0]), 1)
+        self.assertEqual(results[0], results[1])
+
+    def test_compiled_parser_errors(self):
+        for text in ['fn foo() { 1 + }', 'fn foo(', 'struct Foo { a:i32 ']:
+            expected = parser.p.parse('module', ['test', 'test.scale'], text)
+            result = parser.compiled.parse('module', ['test', 'test.scale'], text)
+            self.assertFalse(result.ok)
+            self.assertEqual(result.loc, expected.loc)
+            self.assertEqual(result.error_message(), expected.error_message())
+
+    def test_reparse(self):
+        p = parser.p
+        text = 'fn foo(a:i32) -> i32 {a}\nfn bar() -> i32 {foo(1) + 2}\n'
+        p.enablePackrat()
+        try:
+            result = p.parse('module', ['test', 'test.scale'], text, loc=10)
+            memo = p.memo
+            hits = p.stats.memo_hits
+            edits = [(text.index('a}'), 1, 'a * 3'), (0, 0, '\n\n'), (text.index('foo(1)'), 3, 'baz'), (4, 1, '')]
+            for offset, removed, inserted in edits:
+                result = p.reparse(result, memo, offset, removed, inserted)
+                p.packrat = False
+                expected = p.parse('module', ['test', 'test.scale'], memo.text, loc=10)
+                p.packrat = True
+                self.assertEqual(result.ok, expected.ok)
+                self.assertEqual(result.loc, expected.loc)
+                self.assertEqual(result.value, expected.value)
+            self.assertGreater(p.stats.memo_hits, hits)
+        finally:
+            p.packrat = False
@@ -0,0 +1,103 @@
+import hashlib
+import importlib.util
+import marshal
+import os.path
+import sys
+
+# Generated parsers are cached on disk, next to their grammar, so that warm starts
+# can skip bootstrapping the phase1 parser and compiling the grammar.
+# The cache is keyed by the grammar and the code of the compiler that translated it.
+
+compiler_packages = ['base', 'interpreter', 'phase0', 'phase1']
+# Modules outside those packages that generated parsers depend on.
+compiler_modules = [os.path.join('lang', 'base.py')]
+
+_compiler_version = None
+
+
+# The sources of the compiler, relative to the ritual package.
+def compiler_sources(root):
+    sources = list(compiler_modules)
+    for package in compiler_packages:
+        for fn in os.listdir(os.path.join(root, package)):
+            if fn.endswith('.py') and not fn.startswith('test_'):
+                sources.append(os.path.join(package, fn))
+    return sorted(sources)
+
+
+def compiler_version():
+    global _compiler_version
+    if _compiler_version is None:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        h = hashlib.sha256()
+        for source in compiler_sources(root):
+            h.update(source.encode('utf-8'))
+            with open(os.path.join(root, source), 'rb') as f:
+                h.update(f.read())
+        _compiler_version = h.hexdigest()
+    return _compiler_version
+
+
+def cache_key(name, text, functions):
+    h = hashlib.sha256()
+    h.update(importlib.util.MAGIC_NUMBER)
+    h.update(compiler_version().encode('ascii'))
+    h.update(repr((name, functions)).encode('utf-8'))
+    h.update(text.encode('utf-8'))
+    return h.hexdigest().encode('ascii')
+
+
+def cache_path(name, functions):
+    dirname, basename = os.path.split(name)
+    kind = 'functions' if functions else 'interpreter'
+    return os.path.join(dirname, '__pycache__', '%s.%s.%s.ritualc' % (basename, kind, sys.implementation.cache_tag))
+
+
+def load(path, key):
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    header, _, body = data.partition(b'\n')
+    if header != key:
+        return None
+    try:
+        return marshal.loads(body)
+    except (EOFError, ValueError, TypeError):
+        return None
+
+
+# Write to a temporary file and rename, so concurrent builds never see a partial file.
+# The cache is an optimization, so an unwritable directory is not an error.
+def write_atomic(path, data):
+    temp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(temp, 'wb') as f:
+            f.write(data)
+        os.replace(temp, path)
+    except OSError:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+
+def store(path, key, code):
+    if sys.dont_write_bytecode:
+        return
+    write_atomic(path, key + b'\n' + marshal.dumps(code))
+
+
+# Equivalent to ritual.phase1.parser.compile, but reuses the generated code of previous runs.
+def compile_cached(name, text, out_dict, functions=False):
+    key = cache_key(name, text, functions)
+    path = cache_path(name, functions)
+    code = load(path, key)
+    if code is None:
+        # Importing the phase1 parser bootstraps it, so only do it when needed.
+        import ritual.phase1.parser
+        src = ritual.phase1.parser.compile_src(name, text, functions)
+        code = compile(src, name, 'exec')
+        store(path, key, code)
+    exec(code, out_dict)
+    return key.decode('ascii')
@@ -5,16 +5,11 @@ import ritual.base.io
 from ritual import interpreter
 from . import model
 
-alternate_tree_names = {
-    'location': 'int',
-}
-
 class TreeType(object, metaclass=TypeDispatcher):
 
     @dispatch(model.IntrinsicType)
     def visitIntrinsicType(cls, node):
-        name = node.name
-        return alternate_tree_names.get(name, name)
+        return node.name
 
     @dispatch(model.StructType)
     def visitStructType(cls, node):
@@ -58,7 +53,7 @@ alternate_names = {
 
 class GenerateInterpreter(object, metaclass=TypeDispatcher):
 
-    @dispatch(int, str, bool)
+    @dispatch(int, str, bool, type(None))
     def visitIntrinstic(cls, node):
         return node
 
@@ -96,7 +91,7 @@ class GenerateInterpreter(object, metaclass=TypeDispatcher):
     def visitAppendLocal(cls, node):
         return interpreter.Append(cls.visit(node.expr), node.lcl.name)
 
-    @dispatch(model.Choice, model.Sequence, model.Repeat, model.Character,
+    @dispatch(model.Choice, model.SwitchChoice, model.Sequence, model.Repeat, model.Character,
         model.Range, model.MatchValue, model.ListLiteral, model.Slice,
         model.StringLiteral, model.RuneLiteral, model.IntLiteral, model.BoolLiteral,
         model.Location, model.Lookahead)
@@ -104,14 +99,14 @@ class GenerateInterpreter(object, metaclass=TypeDispatcher):
         # Assume named fields can be mapped to each other.
         n = type(node).__name__
         tgt = getattr(interpreter, alternate_names.get(n, n))
-        slots = tgt.__slots__
+        slots = tgt.__init_slots__
         args = [cls.visit(getattr(node, slot)) for slot in slots]
         return tgt(*args)
 
 
 class SerializeInterpreter(object, metaclass=TypeDispatcher):
 
-    @dispatch(int, str, bool)
+    @dispatch(int, str, bool, type(None))
     def visitIntrinstic(cls, node, out):
         out.write(repr(node))
 
@@ -127,7 +122,7 @@ class SerializeInterpreter(object, metaclass=TypeDispatcher):
                     out.write(',\n')
             out.write(']')
 
-    @dispatch(interpreter.Choice, interpreter.Sequence, interpreter.Repeat,
+    @dispatch(interpreter.Choice, interpreter.SwitchChoice, interpreter.Sequence, interpreter.Repeat,
         interpreter.Character, interpreter.Range,
         interpreter.MatchValue, interpreter.List, interpreter.Slice,
         interpreter.Call, interpreter.Get, interpreter.Set, interpreter.Append,
@@ -135,7 +130,7 @@ class SerializeInterpreter(object, metaclass=TypeDispatcher):
     def visitNode(cls, node, out):
         out.write('interpreter.%s(' % type(node).__name__)
         dirty = False
-        slots = type(node).__slots__
+        slots = type(node).__init_slots__
         if len(slots) == 1:
             cls.visit(getattr(node, slots[0]), out)
         else:
@@ -154,6 +149,423 @@ class SerializeInterpreter(object, metaclass=TypeDispatcher):
         out.write(')')
 
 
+# Names used by the generated rule functions.
+reserved_names = set(['p', 'pos', 'ok', 's', 'end', 'c', 'result', 'runtime'])
+
+
+def character_test(ranges, invert, c='c'):
+    singles = []
+    tests = []
+    for r in ranges:
+        if r.lower == r.upper:
+            singles.append(r.lower)
+        else:
+            tests.append('%r <= %s <= %r' % (r.lower, c, r.upper))
+    if len(singles) == 1:
+        tests.append('%s == %r' % (c, singles[0]))
+    elif singles:
+        tests.append('%s in %r' % (c, ''.join(singles)))
+    if not tests:
+        return 'True' if invert else 'False'
+    test = ' or '.join(tests)
+    if invert:
+        test = 'not (%s)' % test
+    return test
+
+
+class FunctionContext(object):
+    def __init__(self, name, out):
+        self.name = name
+        self.out = out
+        self.uid = 0
+
+    def temp(self, prefix):
+        name = '_%s%d' % (prefix, self.uid)
+        self.uid += 1
+        return name
+
+    def record_failure(self, name=None):
+        self.out.write('if pos > p.deepest:\n')
+        with self.out.block():
+            self.out.write('p.deepest = pos\n')
+            self.out.write('p.deepest_name = %r\n' % (self.name if name is None else name))
+
+    def fail(self):
+        self.record_failure()
+        self.out.write('ok = False\n')
+
+    def assign(self, target, value):
+        if target is not None:
+            self.out.write('%s = %s\n' % (target, value))
+
+
+def local_name(lcl):
+    return 'l_' + lcl.name
+
+
+def rule_name(name):
+    return 'r_' + name
+
+
+class CollectFunctionLocals(object, metaclass=TypeDispatcher):
+
+    @dispatch(model.SetLocal, model.AppendLocal)
+    def visitAssign(cls, node, lcls):
+        lcls.add(node.lcl.name)
+        cls.visit(node.expr, lcls)
+
+    @dispatch(model.Sequence, model.Choice, model.SwitchChoice)
+    def visitChildren(cls, node, lcls):
+        for child in node.children:
+            cls.visit(child, lcls)
+
+    @dispatch(model.Repeat, model.MatchValue, model.Lookahead, model.Slice)
+    def visitExpr(cls, node, lcls):
+        cls.visit(node.expr, lcls)
+
+    @dispatch(model.DirectCall, model.StructLiteral, model.ListLiteral)
+    def visitArgs(cls, node, lcls):
+        for arg in node.args:
+            cls.visit(arg, lcls)
+
+    @dispatch(model.Character, model.GetLocal, model.Location, model.StringLiteral,
+        model.RuneLiteral, model.IntLiteral, model.BoolLiteral)
+    def visitLeaf(cls, node, lcls):
+        pass
+
+
+# Generates straight-line Python for a rule body.
+# After the generated code runs, "ok" holds the result of the match and, if
+# the match succeeded, the value has been written to "target".
+class GenerateFunctionBody(object, metaclass=TypeDispatcher):
+
+    @dispatch(model.Sequence)
+    def visitSequence(cls, node, target, ctx):
+        if not node.children:
+            ctx.assign(target, 'None')
+            return
+        last = len(node.children) - 1
+        for i, child in enumerate(node.children):
+            child_target = target if i == last else None
+            if i == 0:
+                cls.visit(child, child_target, ctx)
+            else:
+                # Guard each element instead of nesting to keep the
+                # indentation proportional to the tree depth.
+                ctx.out.write('if ok:\n')
+                with ctx.out.block():
+                    cls.visit(child, child_target, ctx)
+
+    @dispatch(model.Choice)
+    def visitChoice(cls, node, target, ctx):
+        saved = ctx.temp('p')
+        ctx.out.write('%s = pos\n' % saved)
+        for i, child in enumerate(node.children):
+            if i == 0:
+                cls.visit(child, target, ctx)
+            else:
+                ctx.out.write('if not ok:\n')
+                with ctx.out.block():
+                    ctx.out.write('pos = %s\n' % saved)
+                    ctx.out.write('ok = True\n')
+                    cls.visit(child, target, ctx)
+        ctx.out.write('if not ok:\n')
+        with ctx.out.block():
+            ctx.out.write('pos = %s\n' % saved)
+            ctx.fail()
+
+    @dispatch(model.SwitchChoice)
+    def visitSwitchChoice(cls, node, target, ctx):
+        out = ctx.out
+        saved = ctx.temp('p')
+        c = ctx.temp('c')
+        out.write('%s = pos\n' % saved)
+        # The empty string marks the end of the stream and fails every test.
+        out.write("%s = s[pos] if pos < end else ''\n" % c)
+        out.write('ok = False\n')
+        for i, child in enumerate(node.children):
+            if i > 0:
+                out.write('if not ok:\n')
+                out.indent()
+                out.write('pos = %s\n' % saved)
+            prefix = node.prefixes[i]
+            if prefix is None:
+                out.write('ok = True\n')
+                cls.visit(child, target, ctx)
+            else:
+                out.write('if %s and (%s):\n' % (c, character_test(prefix.ranges, prefix.invert, c)))
+                with out.block():
+                    out.write('ok = True\n')
+                    cls.visit(child, target, ctx)
+                out.write('else:\n')
+                with out.block():
+                    # Record the failure of the skipped alternative.
+                    ctx.record_failure(node.names[i])
+            if i > 0:
+                out.dedent()
+        out.write('if not ok:\n')
+        with out.block():
+            out.write('pos = %s\n' % saved)
+            ctx.fail()
+
+    @classmethod
+    def scanCharacters(cls, node, ctx):
+        # Repeated character matches become a single scanning loop.
+        out = ctx.out
+        start = ctx.temp('p')
+        out.write('%s = pos\n' % start)
+        if node.max > 0:
+            limit = ctx.temp('l')
+            out.write('%s = min(end, pos + %d)\n' % (limit, node.max))
+        else:
+            limit = 'end'
+        out.write('while pos < %s:\n' % limit)
+        with out.block():
+            out.write('c = s[pos]\n')
+            out.write('if not (%s):\n' % character_test(node.expr.ranges, node.expr.invert))
+            with out.block():
+                out.write('break\n')
+            out.write('pos += 1\n')
+        if node.max > 0:
+            out.write('if pos - %s < %d:\n' % (start, node.max))
+            with out.block():
+                ctx.record_failure()
+        else:
+            ctx.record_failure()
+        if node.min > 0:
+            out.write('if pos - %s < %d:\n' % (start, node.min))
+            with out.block():
+                out.write('ok = False\n')
+
+    @dispatch(model.Repeat)
+    def visitRepeat(cls, node, target, ctx):
+        out = ctx.out
+        ctx.assign(target, 'None')
+        if isinstance(node.expr, model.Character):
+            cls.scanCharacters(node, ctx)
+            return
+
+        # Once the minimum has matched, a bounded repeat may be complete.
+        tail = node.max <= 0 or node.min < node.max
+        count = None
+        if node.min > 1 or node.max > 1:
+            count = ctx.temp('c')
+            out.write('%s = 0\n' % count)
+            if node.min > 0:
+                out.write('while %s < %d:\n' % (count, node.min))
+                with out.block():
+                    cls.visit(node.expr, None, ctx)
+                    out.write('if not ok:\n')
+                    with out.block():
+                        out.write('break\n')
+                    out.write('%s += 1\n' % count)
+        elif node.min == 1:
+            cls.visit(node.expr, None, ctx)
+        if not tail:
+            return
+        if node.min > 0:
+            out.write('if ok:\n')
+            out.indent()
+
+        saved = ctx.temp('p')
+        if count is None and node.max == 1:
+            out.write('%s = pos\n' % saved)
+            cls.visit(node.expr, None, ctx)
+            out.write('if not ok:\n')
+            with out.block():
+                out.write('pos = %s\n' % saved)
+                out.write('ok = True\n')
+        else:
+            if node.max > 0:
+                out.write('while %s < %d:\n' % (count, node.max))
+            else:
+                out.write('while True:\n')
+            with out.block():
+                out.write('%s = pos\n' % saved)
+                cls.visit(node.expr, None, ctx)
+                out.write('if not ok:\n')
+                with out.block():
+                    out.write('pos = %s\n' % saved)
+                    out.write('ok = True\n')
+                    out.write('break\n')
+                if node.max > 0:
+                    out.write('%s += 1\n' % count)
+        if node.min > 0:
+            out.dedent()
+
+    @dispatch(model.Character)
+    def visitCharacter(cls, node, target, ctx):
+        out = ctx.out
+        out.write('if pos < end:\n')
+        with out.block():
+            out.write('c = s[pos]\n')
+            out.write('ok = %s\n' % character_test(node.ranges, node.invert))
+        out.write('else:\n')
+        with out.block():
+            out.write('ok = False\n')
+        out.write('if ok:\n')
+        with out.block():
+            out.write('pos += 1\n')
+            ctx.assign(target, 'c')
+        out.write('else:\n')
+        with out.block():
+            ctx.fail()
+
+    @dispatch(model.MatchValue)
+    def visitMatchValue(cls, node, target, ctx):
+        out = ctx.out
+        if isinstance(node.expr, model.StringLiteral):
+            value = repr(node.expr.value)
+            size = str(len(node.expr.value))
+        else:
+            value = ctx.temp('v')
+            cls.visit(node.expr, value, ctx)
+            out.write('if ok:\n')
+            out.indent()
+            size = 'len(%s)' % value
+        out.write('if s.startswith(%s, pos):\n' % value)
+        with out.block():
+            out.write('pos += %s\n' % size)
+            ctx.assign(target, value)
+        out.write('else:\n')
+        with out.block():
+            out.write('pos = runtime.mismatch(s, pos, %s)\n' % value)
+            ctx.fail()
+        if not isinstance(node.expr, model.StringLiteral):
+            out.dedent()
+
+    @dispatch(model.Slice)
+    def visitSlice(cls, node, target, ctx):
+        start = ctx.temp('p')
+        ctx.out.write('%s = pos\n' % start)
+        cls.visit(node.expr, None, ctx)
+        if target is not None:
+            ctx.out.write('if ok:\n')
+            with ctx.out.block():
+                ctx.assign(target, 's[%s:pos]' % start)
+
+    @dispatch(model.Lookahead)
+    def visitLookahead(cls, node, target, ctx):
+        out = ctx.out
+        saved = ctx.temp('p')
+        deepest = ctx.temp('d')
+        deepest_name = ctx.temp('n')
+        out.write('%s = pos\n' % saved)
+        out.write('%s = p.deepest\n' % deepest)
+        out.write('%s = p.deepest_name\n' % deepest_name)
+        cls.visit(node.expr, None if node.invert else target, ctx)
+        out.write('pos = %s\n' % saved)
+        out.write('p.deepest = %s\n' % deepest)
+        out.write('p.deepest_name = %s\n' % deepest_name)
+        if node.invert:
+            out.write('if ok:\n')
+            with out.block():
+                ctx.fail()
+            out.write('else:\n')
+            with out.block():
+                out.write('ok = True\n')
+                ctx.assign(target, 'None')
+
+    @classmethod
+    def visitArgs(cls, args, ctx):
+        values = []
+        for i, arg in enumerate(args):
+            value = ctx.temp('a')
+            if i == 0:
+                cls.visit(arg, value, ctx)
+            else:
+                ctx.out.write('if ok:\n')
+                with ctx.out.block():
+                    cls.visit(arg, value, ctx)
+            values.append(value)
+        if args:
+            ctx.out.write('if ok:\n')
+            ctx.out.indent()
+        return values
+
+    @classmethod
+    def finishArgs(cls, args, ctx):
+        if args:
+            ctx.out.dedent()
+
+    @dispatch(model.DirectCall)
+    def visitDirectCall(cls, node, target, ctx):
+        values = cls.visitArgs(node.args, ctx)
+        if isinstance(node.func, model.RuleType):
+            func = rule_name(node.func.name)
+            result = target if target is not None else '_'
+            ctx.out.write('%s, pos, ok = %s(%s)\n' % (result, func, ', '.join(['p', 'pos'] + values)))
+        else:
+            ctx.assign(target, '%s(%s)' % (node.func.name, ', '.join(values)))
+            if target is None:
+                ctx.out.write('%s(%s)\n' % (node.func.name, ', '.join(values)))
+        cls.finishArgs(node.args, ctx)
+
+    @dispatch(model.StructLiteral)
+    def visitStructLiteral(cls, node, target, ctx):
+        values = cls.visitArgs(node.args, ctx)
+        ctx.assign(target, '%s(%s)' % (TreeType.visit(node.t), ', '.join(values)))
+        cls.finishArgs(node.args, ctx)
+
+    @dispatch(model.ListLiteral)
+    def visitListLiteral(cls, node, target, ctx):
+        values = cls.visitArgs(node.args, ctx)
+        ctx.assign(target, '[%s]' % ', '.join(values))
+        cls.finishArgs(node.args, ctx)
+
+    @dispatch(model.GetLocal)
+    def visitGetLocal(cls, node, target, ctx):
+        ctx.assign(target, local_name(node.lcl))
+
+    @dispatch(model.SetLocal)
+    def visitSetLocal(cls, node, target, ctx):
+        # Evaluate into a temporary so a failed match leaves the local alone.
+        value = ctx.temp('t')
+        cls.visit(node.expr, value, ctx)
+        ctx.out.write('if ok:\n')
+        with ctx.out.block():
+            ctx.assign(local_name(node.lcl), value)
+            ctx.assign(target, value)
+
+    @dispatch(model.AppendLocal)
+    def visitAppendLocal(cls, node, target, ctx):
+        value = ctx.temp('t')
+        cls.visit(node.expr, value, ctx)
+        ctx.out.write('if ok:\n')
+        with ctx.out.block():
+            ctx.out.write('%s.append(%s)\n' % (local_name(node.lcl), value))
+            ctx.assign(target, value)
+
+    @dispatch(model.StringLiteral, model.RuneLiteral, model.IntLiteral, model.BoolLiteral)
+    def visitLiteral(cls, node, target, ctx):
+        ctx.assign(target, repr(node.value))
+
+    @dispatch(model.Location)
+    def visitLocation(cls, node, target, ctx):
+        ctx.assign(target, 'pos + p.pos_offset')
+
+
+def generate_rule_function(decl, out):
+    name = decl.name.text
+    params = [p.name.text for p in decl.params]
+    lcls = set()
+    CollectFunctionLocals.visit(decl.body, lcls)
+
+    args = ['p', 'pos'] + ['l_' + p for p in params]
+    out.write('def %s(%s):\n' % (rule_name(name), ', '.join(args)))
+    with out.block():
+        out.write('s = p.stream\n')
+        out.write('end = p.end\n')
+        out.write('ok = True\n')
+        out.write('result = None\n')
+        for lcl in sorted(lcls):
+            if lcl not in params:
+                out.write('l_%s = None\n' % lcl)
+        ctx = FunctionContext(name, out)
+        GenerateFunctionBody.visit(decl.body, 'result', ctx)
+        out.write('return result, pos, ok\n')
+
+
 class GeneratePython(object, metaclass=TypeDispatcher):
 
     @dispatch(model.StructDecl)
@@ -172,8 +584,40 @@ class GeneratePython(object, metaclass=TypeDispatcher):
         types = [PythonType.visit(t) for t in node.refs]
         out.write('%s = tuple([%s])\n' % (node.name.text, ', '.join(types)))
 
+    @classmethod
+    def generateFunctionParser(cls, externs, structs, rules, out):
+        for decl in externs + structs:
+            name = decl.name.text
+            assert name not in reserved_names and not name.startswith(('_', 'l_', 'r_')), name
+
+        out.write('\n\n')
+        out.write('def buildFunctionParser(%s):\n' % ', '.join([e.name.text for e in externs]))
+        with out.block():
+            for decl in rules:
+                generate_rule_function(decl, out)
+                out.write('\n')
+            out.write('p = runtime.CompiledParser()\n')
+            out.write('\n')
+            for decl in rules:
+                name = decl.name.text
+                params = ['interpreter.Param(%r)' % p.name.text for p in decl.params]
+                out.write('p.rule(runtime.FunctionRule(%r, [%s], %s))\n' % (name, ', '.join(params), rule_name(name)))
+            out.write('\n')
+            out.write('# Register struct types\n')
+            for decl in structs:
+                name = decl.name.text
+                out.write('p.rule(interpreter.Native(%r, [interpreter.Param(slot) for slot in %s.__slots__], %s))\n' % (name, name, name))
+            out.write('\n')
+            out.write('# Register externs\n')
+            for decl in externs:
+                params = ['interpreter.Param(%r)' % p.name.text for p in decl.params]
+                name = decl.name.text
+                out.write('p.rule(interpreter.Native(%r, [%s], %s))\n' % (name, ', '.join(params), name))
+
+            out.write('\nreturn p\n')
+
     @dispatch(model.File)
-    def visitFile(cls, node, out):
+    def visitFile(cls, node, out, functions):
         externs = []
         structs = []
         unions = []
@@ -191,6 +635,9 @@ class GeneratePython(object, metaclass=TypeDispatcher):
                 assert False, decl
 
         out.write("""from ritual import base, interpreter
+""")
+        if functions:
+            out.write("""from ritual.interpreter import runtime
 """)
         for decl in structs:
             cls.visit(decl, out)
@@ -223,15 +670,18 @@ class GeneratePython(object, metaclass=TypeDispatcher):
 
             out.write('\nreturn p\n')
 
+        if functions:
+            cls.generateFunctionParser(externs, structs, rules, out)
+
         out.write('\n_isinstance = isinstance\n')
         out.write('\ndef isinstance(*args):\n')
         with out.block():
             out.write('return _isinstance(*args)\n')
 
 
-def generate_source(f):
+def generate_source(f, functions=False):
     out = ritual.base.io.TabbedWriter(io.StringIO())
-    GeneratePython.visit(f, out)
+    GeneratePython.visit(f, out, functions)
     return out.out.getvalue()
 
 
@@ -27,6 +27,12 @@ class Choice(Matcher, metaclass=base.TreeMeta):
     __schema__ = 'children:[]Matcher'
 
 
+# A choice that skips alternatives that cannot match the next character.
+# names holds the rule that would record the failure of a skipped alternative.
+class SwitchChoice(Matcher, metaclass=base.TreeMeta):
+    __schema__ = 'children:[]Matcher names:[]?string prefixes:[]?Character'
+
+
 @register
 class Repeat(Matcher, metaclass=base.TreeMeta):
     __schema__ = 'expr:Matcher min:int max:int'
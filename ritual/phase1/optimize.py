@@ -98,7 +98,9 @@ def canonical_to_model(ranges):
 class OptimizationPass(object):
     def __init__(self, status):
         self.prefix_cache = {}
+        self.failure_cache = {}
         self.rules = {}
+        self.current_rule = None
         self.status = status
 
 
@@ -191,7 +193,12 @@ class GetPossiblePrefix(object, metaclass=TypeDispatcher):
     def visitSequence(cls, node, opt):
         return merge_sequence(cls, node.children, opt)
 
-    @dispatch(model.Choice)
+    @dispatch(model.Lookahead)
+    def visitLookahead(cls, node, opt):
+        # Never consumes, but may constrain what follows.
+        return NONE, NO
+
+    @dispatch(model.Choice, model.SwitchChoice)
     def visitChoice(cls, node, opt):
         accum = NONE
         m = MUST
@@ -204,6 +211,72 @@ class GetPossiblePrefix(object, metaclass=TypeDispatcher):
         return accum, m
 
 
+UNKNOWN = object()
+
+
+# When a matcher cannot consume the next character, which rule records the
+# first failure?  None if it succeeds without failing, UNKNOWN if this cannot
+# be determined statically.
+class GetFailureName(object, metaclass=TypeDispatcher):
+
+    @classmethod
+    def visitSequence(cls, children, name, opt):
+        for child in children:
+            result = cls.visit(child, name, opt)
+            if result is not None:
+                return result
+        return None
+
+    @dispatch(model.GetLocal, model.BoolLiteral, model.IntLiteral, model.StringLiteral, model.RuneLiteral, model.Location)
+    def visitTerminal(cls, node, name, opt):
+        return None
+
+    @dispatch(model.Character)
+    def visitCharacter(cls, node, name, opt):
+        return name
+
+    @dispatch(model.MatchValue)
+    def visitMatchValue(cls, node, name, opt):
+        if not isinstance(node.expr, model.StringLiteral):
+            return UNKNOWN
+        return name if node.expr.value else None
+
+    @dispatch(model.Lookahead)
+    def visitLookahead(cls, node, name, opt):
+        # Lookaheads discard the failures recorded inside of them.
+        return UNKNOWN
+
+    @dispatch(model.Slice, model.SetLocal, model.AppendLocal, model.Repeat)
+    def visitSimpleWrapper(cls, node, name, opt):
+        return cls.visit(node.expr, name, opt)
+
+    @dispatch(model.Sequence)
+    def visitSequenceNode(cls, node, name, opt):
+        return cls.visitSequence(node.children, name, opt)
+
+    @dispatch(model.Choice, model.SwitchChoice)
+    def visitChoice(cls, node, name, opt):
+        # Later alternatives fail at the same position, so only the first
+        # one can record the failure.
+        return cls.visit(node.children[0], name, opt)
+
+    @dispatch(model.ListLiteral, model.StructLiteral)
+    def visitLiteral(cls, node, name, opt):
+        return cls.visitSequence(node.args, name, opt)
+
+    @dispatch(model.DirectCall)
+    def visitDirectCall(cls, node, name, opt):
+        result = cls.visitSequence(node.args, name, opt)
+        if result is not None or isinstance(node.func, model.ExternType):
+            return result
+        callee = node.func.name
+        if callee not in opt.failure_cache:
+            # Recursion cannot be resolved.
+            opt.failure_cache[callee] = UNKNOWN
+            opt.failure_cache[callee] = cls.visit(opt.rules[callee].body, callee, opt)
+        return opt.failure_cache[callee]
+
+
 class DoOpt(object, metaclass=TypeDispatcher):
 
     @dispatch(model.Character)
@@ -268,7 +341,7 @@ class DoOpt(object, metaclass=TypeDispatcher):
         children = []
         for child in node.children:
             child = cls.visit(child, opt)
-            if isinstance(child, model.Choice):
+            if isinstance(child, (model.Choice, model.SwitchChoice)):
                 children.extend(child.children)
             else:
                 children.append(child)
@@ -276,26 +349,31 @@ class DoOpt(object, metaclass=TypeDispatcher):
             return children[0]
         node.children = children
 
-        # Are the choices disjoint?
-        accum = NONE
-        child_prefixes = []
+        # Which alternatives can be ruled out by the next character?
+        names = []
+        prefixes = []
         for child in node.children:
             ranges, mode = GetPossiblePrefix.cachedVisit(child, opt)
-            if mode != MUST:
-                break
-            if ranges_intersect(accum, ranges):
-                break
-            accum = union_ranges(accum, ranges)
-            child_prefixes.append(ranges)
-        else:
-            # TODO optimize disjoint ranges.
-            pass
+            name = None
+            if mode == MUST:
+                name = GetFailureName.visit(child, opt.current_rule, opt)
+            if name is None or name is UNKNOWN:
+                names.append(None)
+                prefixes.append(None)
+            else:
+                char_ranges, invert = canonical_to_model(ranges)
+                names.append(name)
+                prefixes.append(model.Character(0, char_ranges, invert))
 
+        if any(prefixes):
+            return model.SwitchChoice(node.children, names, prefixes)
         return node
 
     @dispatch(model.RuleDecl)
     def visitRuleDecl(cls, node, opt):
+        opt.current_rule = node.name.text
         node.body = cls.visit(node.body, opt)
+        opt.current_rule = None
 
     @dispatch(model.StructDecl, model.UnionDecl, model.ExternDecl)
     def visitStructDecl(cls, node, opt):
@@ -168,7 +168,7 @@ rule('extern_decl', r"""$"extern"; end_of_keyword();
 rule('file', r"""decls = []; (S(); decls << (rule_decl()|extern_decl()|struct_decl()|union_decl()))*; S(); ![[^]]; File(decls)""")
 
 
-def compile_src(name, text):
+def compile_src(name, text, functions=False):
     status = ritual.interpreter.location.CompileStatus()
     loc = status.add_source(name, text)
     result = p.parse('file', [], text, loc)
@@ -176,8 +176,8 @@ def compile_src(name, text):
     f = result.value
     semantic.process(f, status)
     optimize.process(f, status)
-    return generate_python.generate_source(f)
+    return generate_python.generate_source(f, functions)
 
-def compile(name, text, out_dict):
-    src = compile_src(name, text)
+def compile(name, text, out_dict, functions=False):
+    src = compile_src(name, text, functions)
     generate_python.compile_source(name, src, out_dict)
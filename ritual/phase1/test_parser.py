@@ -1,14 +1,22 @@
+import os.path
+import sys
+import tempfile
 import unittest
 
+from ritual import interpreter
+from ritual.interpreter.closure import compileParser
 from ritual.interpreter.testutil import ParserTestCase
 
+from . import cache
 from . import model
 from . import parser
 
 
-def simpleCompile(text):
+def simpleCompile(text, functions=False):
     d = {}
-    parser.compile('test', text, d)
+    parser.compile('test', text, d, functions)
+    if functions:
+        return d['buildFunctionParser']()
     return d['buildParser']()
 
 
@@ -112,3 +120,88 @@ func main(s:string):string {
         self.p_ok('main', 'foo bar', args=['foo'], value='bar')
         self.p_fail('main', 'foobar', args=['foo'])
         self.p_ok('main', 'foo{}', args=['foo'], value='{}')
+
+    def test_switch_choice(self):
+        src = r"""
+func digit():string {
+    /<[0-9]>/
+}
+func word():string {
+    /<[a-z]+>/
+}
+[export]
+func atom():string {
+    digit() | word() | $"("; a=atom(); $")"; a
+}
+"""
+        self.parser = simpleCompile(src)
+        self.assertIsInstance(self.parser.rules['atom'].body, interpreter.SwitchChoice)
+
+        for p in [self.parser, compileParser(self.parser), simpleCompile(src, True)]:
+            self.parser = p
+            self.p_ok('atom', '7', value='7')
+            self.p_ok('atom', 'abc', value='abc')
+            self.p_ok('atom', '((x))', value='x')
+
+            # Skipped alternatives report the same errors as when they are tried.
+            result = p.parse('atom', [], '(!')
+            self.assertEqual((result.ok, result.error_scope, result.loc), (False, 'digit', 1))
+            result = p.parse('atom', [], '(x!')
+            self.assertEqual((result.ok, result.error_scope, result.loc), (False, 'word', 2))
+            result = p.parse('atom', [], '(')
+            self.assertEqual((result.ok, result.error_scope, result.loc), (False, 'digit', 1))
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.dont_write_bytecode = sys.dont_write_bytecode
+        sys.dont_write_bytecode = False
+        self.dir = tempfile.TemporaryDirectory()
+        self.name = os.path.join(self.dir.name, 'test.ritual')
+
+    def tearDown(self):
+        sys.dont_write_bytecode = self.dont_write_bytecode
+        self.dir.cleanup()
+
+    def build(self, text):
+        d = {}
+        cache.compile_cached(self.name, text, d, functions=True)
+        return d['buildFunctionParser']()
+
+    def test_reuse(self):
+        text = '[export] func word():string {</[a-z]+/>}'
+        path = cache.cache_path(self.name, True)
+        self.build(text)
+        key = cache.cache_key(self.name, text, True)
+        self.assertIsNotNone(cache.load(path, key))
+
+        # A warm start loads the cached code.
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.assertEqual(self.build(text).parse('word', [], 'abc').value, 'abc')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+        # Changing the grammar regenerates the parser.
+        text = '[export] func word():string {</[a-z0-9]+/>}'
+        self.assertEqual(self.build(text).parse('word', [], 'a1').value, 'a1')
+        self.assertIsNone(cache.load(path, key))
+        self.assertIsNotNone(cache.load(path, cache.cache_key(self.name, text, True)))
+
+    def test_compiler_sources(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(cache.__file__)))
+        sources = cache.compiler_sources(root)
+        self.assertIn(os.path.join('lang', 'base.py'), sources)
+        self.assertIn(os.path.join('phase1', 'generate_python.py'), sources)
+        self.assertNotIn(os.path.join('phase1', 'test_parser.py'), sources)
+
+    def test_corrupt(self):
+        text = '[export] func digit():string {</[0-9]/>}'
+        key = cache.cache_key(self.name, text, True)
+        path = cache.cache_path(self.name, True)
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(key + b'\ngarbage')
+        self.assertIsNone(cache.load(path, key))
+        self.assertEqual(self.build(text).parse('digit', [], '7').value, '7')
+        self.assertIsNotNone(cache.load(path, key))
@@ -7,14 +7,15 @@ externs = {
 
 def setup():
     import os.path
-    import ritual.phase1.parser
+    import ritual.phase1.cache
 
     src_file = os.path.join(os.path.dirname(__file__), 'phase2.ritual')
     with open(src_file) as f:
         src = f.read()
-    ritual.phase1.parser.compile(src_file, src, globals())
+    ritual.phase1.cache.compile_cached(src_file, src, globals(), functions=True)
     p = buildParser(**externs)
-    return p, src
+    compiled = buildFunctionParser(**externs)
+    return p, compiled, src
 
 
-p, src = setup()
+p, compiled, src = setup()
@@ -32,3 +32,20 @@ func bracket(s:string):string {
     <$"["; $s; $"]">
 }
 """)
+
+
+class TestFunctionParser(TestParser):
+
+    def setUp(self):
+        self.parser = parser.compiled
+
+    def test_matches_interpreter(self):
+        expected = parser.p.parse('file', [], parser.src, must_consume_everything=True)
+        self.assertEqual(self.parser.parse('file', [], parser.src, must_consume_everything=True), expected)
+
+    def test_error_matches_interpreter(self):
+        text = 'func bracket(s:string):string {\n    <$"["; $s; $"]"\n}\n'
+        expected = parser.p.parse('file', [], text, must_consume_everything=True)
+        result = self.parser.parse('file', [], text, must_consume_everything=True)
+        self.assertEqual(result.ok, False)
+        self.assertEqual(result.error_message(), expected.error_message())
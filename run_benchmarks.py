@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+# Times the parsers and the Scale compiler on real grammars and synthetic programs.
+# Results can be saved as a baseline and later runs compared against it:
+#   ./run_benchmarks.py --save baseline.json
+#   ./run_benchmarks.py --compare baseline.json
+
+import argparse
+import ast
+import gc
+import glob
+import io
+import json
+import os.path
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+class Benchmark(object):
+    def __init__(self, name, size, run):
+        self.name = name
+        # Bytes of input processed by each run.
+        self.size = size
+        self.run = run
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def phase0_benchmark():
+    import ritual.phase0.parser
+
+    # The rule bodies of the phase1 parser are written in the phase0 syntax.
+    tree = ast.parse(read(os.path.join(ROOT, 'ritual', 'phase1', 'parser.py')))
+    bodies = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == 'rule':
+            body = node.args[1]
+            if isinstance(body, ast.Constant) and isinstance(body.value, str):
+                bodies.append(body.value)
+
+    def run():
+        for body in bodies:
+            ritual.phase0.parser.text_match(body)
+    return Benchmark('phase0', sum([len(body) for body in bodies]), run)
+
+
+def phase1_benchmark():
+    import ritual.phase1.parser
+
+    path = os.path.join(ROOT, 'ritual', 'phase2', 'phase2.ritual')
+    text = read(path)
+
+    def run():
+        ritual.phase1.parser.compile_src(path, text)
+    return Benchmark('phase1', len(text), run)
+
+
+def scale_parse_benchmark(name, sources):
+    from ritual.lang.scale import parser
+
+    def run():
+        for path, text in sources:
+            result = parser.compiled.parse('module', [os.path.basename(path), path], text)
+            assert result.ok, result.error_message()
+    return Benchmark(name, sum([len(text) for _, text in sources]), run)
+
+
+# Synthetic programs, which are valid Scale so the whole compiler can run on them.
+
+def deep_expressions(count, depth=40):
+    out = io.StringIO()
+    for i in range(count):
+        expr = 'a'
+        for j in range(depth):
+            expr = '(%s %s %d)' % (expr, '+-*'[j % 3], j + 1)
+        out.write('fn deep%d(a:i32) -> i32 {\n    %s\n}\n\n' % (i, expr))
+    return out.getvalue()
+
+
+def many_structs(count):
+    out = io.StringIO()
+    for i in range(count):
+        out.write('struct S%d {\n    a:i32;\n    b:f32;\n    c:bool;\n' % i)
+        if i:
+            out.write('\n    fn combine(other:S%d) -> i32 {\n        self.a + other.a\n    }\n' % (i - 1))
+        out.write('}\n\n')
+    return out.getvalue()
+
+
+def long_strings(count, length=4096):
+    out = io.StringIO()
+    chunk = 'The quick brown fox\\t\\u{0482} jumps over \\"the\\" lazy dog.\\n'
+    text = chunk * (length // len(chunk))
+    for i in range(count):
+        out.write('fn text%d() -> string {\n    "%s"\n}\n\n' % (i, text))
+    return out.getvalue()
+
+
+def synthetic_sources(scale):
+    return [
+        ('deep_expressions', deep_expressions(25 * scale)),
+        ('many_structs', many_structs(200 * scale)),
+        ('long_strings', long_strings(10 * scale)),
+    ]
+
+
+def pipeline_benchmark(name, root, module, size, directory):
+    import sc
+
+    system = os.path.join(ROOT, 'scale_src', 'system')
+    out = os.path.join(directory, name + '.cc')
+
+    def run():
+        status = sc.run(['--system', system, '--root', root, '--module', module, '--out', out])
+        assert status == 0, status
+    return Benchmark(name, size, run)
+
+
+def benchmarks(scale, directory):
+    yield phase0_benchmark()
+    yield phase1_benchmark()
+
+    scale_src = sorted(glob.glob(os.path.join(ROOT, 'scale_src', '**', '*.scale'), recursive=True))
+    scale_sources = [(path, read(path)) for path in scale_src]
+    yield scale_parse_benchmark('scale.scale_src', scale_sources)
+
+    synthetic = synthetic_sources(scale)
+    for name, text in synthetic:
+        yield scale_parse_benchmark('scale.' + name, [(name + '.scale', text)])
+
+    yield pipeline_benchmark('sc.scale_src', os.path.join(ROOT, 'scale_src', 'user'), 'main', sum([len(text) for _, text in scale_sources]), directory)
+
+    # Everything synthetic in one program.
+    text = 'fn main() {}\n\n' + ''.join([text for _, text in synthetic])
+    with open(os.path.join(directory, 'synthetic.scale'), 'w') as f:
+        f.write(text)
+    yield pipeline_benchmark('sc.synthetic', directory, 'synthetic', len(text), directory)
+
+
+def measure(benchmark, repeat):
+    # Warm up, which also loads anything loaded lazily.
+    benchmark.run()
+
+    times = []
+    collections = 0
+    for _ in range(repeat):
+        before = sum([stats['collections'] for stats in gc.get_stats()])
+        start = time.perf_counter()
+        benchmark.run()
+        times.append(time.perf_counter() - start)
+        collections += sum([stats['collections'] for stats in gc.get_stats()]) - before
+
+    # Tracing allocations is slow, so it is done separately from timing.
+    tracemalloc.start()
+    benchmark.run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    best = min(times)
+    return {
+        'bytes': benchmark.size,
+        'seconds': best,
+        'bytes_per_second': benchmark.size / best if best else 0.0,
+        'peak_allocated': peak,
+        'gc_collections': collections / repeat,
+    }
+
+
+def print_result(name, result, baseline):
+    line = '%-24s %10d %10.2f %12.0f %10.0f %6.1f' % (name, result['bytes'], result['seconds'] * 1e3, result['bytes_per_second'], result['peak_allocated'] / 1024, result['gc_collections'])
+    if baseline is not None:
+        line += ' %+7.1f%%' % (change(result, baseline) * 100)
+    print(line)
+
+
+# The relative change in throughput, negative if slower.
+def change(result, baseline):
+    return result['bytes_per_second'] / baseline['bytes_per_second'] - 1
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the parsers and the Scale compiler.')
+    parser.add_argument('names', nargs='*', metavar='NAME', help='Only run benchmarks starting with one of these names.')
+    parser.add_argument('--repeat', type=int, default=5, metavar='N', help='Number of timed runs, the fastest is reported.')
+    parser.add_argument('--scale', type=int, default=1, metavar='N', help='Multiplies the size of the synthetic programs.')
+    parser.add_argument('--save', metavar='FILE', help='Save the results as a baseline.')
+    parser.add_argument('--compare', metavar='FILE', help='Compare the results against a saved baseline.')
+    parser.add_argument('--threshold', type=float, default=0.1, metavar='FRACTION', help='Slowdown against the baseline considered a regression.')
+    options = parser.parse_args(argv)
+
+    baselines = {}
+    if options.compare:
+        with open(options.compare) as f:
+            baselines = json.load(f)
+
+    print('%-24s %10s %10s %12s %10s %6s' % ('benchmark', 'bytes', 'ms', 'bytes/s', 'peak KiB', 'gcs') + (' %8s' % 'change' if options.compare else ''))
+    results = {}
+    regressions = []
+    with tempfile.TemporaryDirectory() as directory:
+        for benchmark in benchmarks(options.scale, directory):
+            if options.names and not any([benchmark.name.startswith(name) for name in options.names]):
+                continue
+            result = measure(benchmark, options.repeat)
+            results[benchmark.name] = result
+            baseline = baselines.get(benchmark.name)
+            if options.compare and baseline is not None and change(result, baseline) < -options.threshold:
+                regressions.append(benchmark.name)
+            print_result(benchmark.name, result, baseline)
+            sys.stdout.flush()
+
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+            f.write('\n')
+
+    if regressions:
+        print()
+        print('Slower than the baseline: %s' % ', '.join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, ROOT)
+    sys.exit(main(sys.argv[1:]))
@@ -1,25 +1,51 @@
 #!/usr/bin/env python3
 
 import argparse
+import contextlib
 import io
+import json
+import os
 import os.path
+import socket
 import sys
+import traceback
 
+import ritual.base.io
+import ritual.base.profile
+from ritual.base.profile import NULL_PROFILE
 import ritual.interpreter.location
 import ritual.lang.scale.compile
+import ritual.lang.scale.devirtualize
+import ritual.lang.scale.fold
 import ritual.lang.scale.generate_cpp
+import ritual.lang.scale.inline
+import ritual.lang.scale.parser
+import ritual.lang.scale.semantic
 
 
-def parse_args():
+def parse_args(argv):
     parser = argparse.ArgumentParser(description='Compile a Scale program.')
-    parser.add_argument('--system', dest='system', required=True, metavar='DIR', help='Directory holding system sources.')
-    parser.add_argument('--root', dest='root', required=True, metavar='DIR', help='Directory holding program sources.')
-    parser.add_argument('--module', dest='module', required=True, metavar='MODULE', help='Name of the module to compile.')
+    parser.add_argument('--system', dest='system', metavar='DIR', help='Directory holding system sources.')
+    parser.add_argument('--root', dest='root', metavar='DIR', help='Directory holding program sources.')
+    parser.add_argument('--module', dest='module', metavar='MODULE', help='Name of the module to compile.')
     parser.add_argument('--deps', dest='deps', metavar='FILE', help='File to output build dependency information.')
     parser.add_argument('--verbose', action='store_true', help='Print information useful for debugging the compiler.')
-    parser.add_argument('--out', dest='out', required=True, metavar='FILE', help='File to output generated C++ source.')
-
-    options = parser.parse_args()
+    parser.add_argument('--out', dest='out', metavar='FILE', help='File to output generated C++ source.')
+    parser.add_argument('--parse-cache', dest='parse_cache', metavar='DIR', help='Directory to cache parsed modules in.')
+    parser.add_argument('--jobs', dest='jobs', type=int, default=1, metavar='N', help='Number of processes to parse modules with.')
+    parser.add_argument('--memory', dest='memory', choices=ritual.lang.scale.generate_cpp.MEMORY_MODES, default='shared', help='How the generated code allocates ref structs, "arena" allocates from a region reset after each test.')
+    parser.add_argument('--inline-budget', dest='inline_budget', type=int, default=ritual.lang.scale.inline.DEFAULT_BUDGET, metavar='N', help='Inline functions whose bodies have at most N expressions, 0 disables inlining.')
+    parser.add_argument('--profile', dest='profile', metavar='FILE', help='File to output the time taken and work done by each phase of the compiler.')
+    parser.add_argument('--profile-rules', dest='profile_rules', action='store_true', help='Also count the grammar rules called and backtracks while parsing each module, by parsing it again after the compile.')
+    parser.add_argument('--profile-format', dest='profile_format', choices=['json', 'trace'], default='json', help='Format of the profile, "trace" is the Chrome trace event format.')
+    parser.add_argument('--serve', dest='serve', metavar='SOCKET', help='Stay resident and compile requests from clients connecting to a Unix socket.')
+
+    options = parser.parse_args(argv)
+    if options.serve is not None:
+        return options
+    for name in ['system', 'root', 'module', 'out']:
+        if getattr(options, name) is None:
+            parser.error('--%s is required.' % name)
     if not os.path.isdir(options.system):
         parser.error('--system should refer to a directory.')
     if not os.path.isdir(options.root):
@@ -28,13 +54,6 @@ def parse_args():
     return options
 
 
-def file_is_same(path, text):
-    if not os.path.isfile(path):
-        return False
-    with open(path) as f:
-        return f.read() == text
-
-
 # Get a list of all Python files that have been loaded.
 # This allows a build system to know when the compiler has changed.
 # Note: this isn't complete - it can miss dynamically generated code from non-python files.
@@ -51,21 +70,48 @@ def get_loaded_python_files(files):
         files.add(fn)
 
 
-def main():
-    config = parse_args()
+def compile_program(config, cache=None, incremental=None, profile=NULL_PROFILE):
     status = ritual.interpreter.location.CompileStatus(debug=config.verbose)
 
+    # Code kept from a previous compilation is already inlined, so it must have used the same budget.
+    if incremental is not None and incremental.inline_budget != config.inline_budget:
+        incremental.reset()
+
     # Compile
-    p, files = ritual.lang.scale.compile.frontend(config.system, config.root, config.module.split('.'), status)
+    sources = [] if profile.enabled and config.profile_rules else None
+    with profile.phase('frontend'):
+        p, files = ritual.lang.scale.compile.frontend(config.system, config.root, config.module.split('.'), status, cache, config.jobs, incremental, profile, sources)
     status.halt_if_errors()
-    buf = io.StringIO()
-    ritual.lang.scale.generate_cpp.generate_source(p, buf)
-    src = buf.getvalue()
 
-    # Write the generated source to disk if it has changed.
-    if not file_is_same(config.out, src):
-        with open(config.out, 'w') as f:
-            f.write(src)
+    # Whole program optimization.
+    with profile.phase('fold_constants'):
+        folded = ritual.lang.scale.fold.fold_constants(p, profile)
+    with profile.phase('devirtualize'):
+        eliminated = ritual.lang.scale.devirtualize.devirtualize(p, profile)
+    with profile.phase('inline'):
+        modules = incremental.resolved if incremental is not None else None
+        inliner = ritual.lang.scale.inline.inline_functions(p, config.inline_budget, profile, modules)
+    if incremental is not None:
+        incremental.record_copies(inliner.copied, config.inline_budget)
+    if inliner.inlined:
+        # Arguments that are constant can now be propagated.
+        with profile.phase('fold_constants'):
+            folded += ritual.lang.scale.fold.fold_constants(p, profile)
+    if config.verbose:
+        print('Folded %d expressions.' % folded)
+        print('Devirtualized %d method calls.' % eliminated)
+        print('Inlined %d calls.' % inliner.inlined)
+
+    # Stream the generated source to disk, only replacing the output if it has changed.
+    with profile.phase('generate'):
+        with ritual.base.io.AtomicFileWriter(config.out) as out:
+            ritual.lang.scale.generate_cpp.generate_source(p, out, status, profile, config.memory)
+        profile.count('bytes_emitted', out.size)
+
+    # Counting rules parses the modules again, so it is kept out of the phases above.
+    if sources:
+        with profile.phase('count_rules'):
+            ritual.lang.scale.compile.count_rules(sources, profile)
 
     # List all files used during compilation, to assist the build system.
     if config.deps:
@@ -80,10 +126,119 @@ def main():
             f.write('\n')
 
 
-if __name__ == '__main__':
+def run(argv, cache=None, incremental=None):
+    config = parse_args(argv)
+    if config.serve is not None:
+        serve(config.serve)
+        return 0
+    if cache is None and config.parse_cache:
+        cache = ritual.lang.scale.compile.ParseCache(config.parse_cache)
+    profile = NULL_PROFILE
+    if config.profile:
+        profile = ritual.base.profile.Profile()
+        # The grammar is loaded when the compiler starts, which may be before this compilation.
+        profile.record('grammar', *ritual.lang.scale.parser.setup_times)
     try:
-        main()
+        compile_program(config, cache, incremental, profile)
     except ritual.interpreter.location.HaltCompilation:
-        sys.exit(1)
-    sys.exit(0)
+        return 1
+    finally:
+        if config.profile:
+            profile.write(config.profile, config.profile_format)
+    return 0
+
+
+# Record the modification times of the compiler's files, including the grammars
+# it compiled on startup, so a server can tell when it has gone stale.
+def snapshot_compiler_files():
+    files = set()
+    get_loaded_python_files(files)
+    for dirname in set([os.path.dirname(fn) for fn in files if fn]):
+        if os.path.isdir(dirname):
+            for fn in os.listdir(dirname):
+                if fn.endswith('.ritual'):
+                    files.add(os.path.join(dirname, fn))
+    return dict([(fn, os.path.getmtime(fn)) for fn in files if fn and os.path.isfile(fn)])
+
+
+def compiler_changed(snapshot):
+    for fn, mtime in snapshot.items():
+        if not os.path.isfile(fn) or os.path.getmtime(fn) != mtime:
+            return True
+    return False
+
+
+# Handle a single compile request from a client.
+# The request carries the client's working directory and command line, and the
+# response carries what the compiler printed and its exit status.
+def handle_request(request, cache, incremental):
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    cwd = os.getcwd()
+    try:
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            try:
+                os.chdir(request['cwd'])
+                status = run(request['argv'], cache, incremental)
+            except SystemExit as e:
+                # argparse exits on bad arguments.
+                status = e.code if isinstance(e.code, int) else 1
+            except Exception:
+                # A bug in the compiler fails this request, not the server.
+                # The warm state may have been left half updated, so start over.
+                traceback.print_exc()
+                cache.clear()
+                incremental.reset()
+                status = 1
+    finally:
+        os.chdir(cwd)
+    return {'status': status, 'stdout': stdout.getvalue(), 'stderr': stderr.getvalue()}
+
+
+def serve(path):
+    if os.path.exists(path):
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o077)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(old_umask)
+    server.listen(16)
+
+    # Parsed modules, their semantic analysis, and the generated grammar stay warm between requests.
+    cache = ritual.lang.scale.compile.ParseCache()
+    incremental = ritual.lang.scale.semantic.IncrementalSemantic()
+    snapshot = snapshot_compiler_files()
+    try:
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                f = conn.makefile('rwb')
+                line = f.readline()
+                if not line:
+                    continue
+                if compiler_changed(snapshot):
+                    # Let the client compile by itself, then stop so a fresh server can be started.
+                    f.write(json.dumps({'restart': True}).encode('utf-8') + b'\n')
+                    f.flush()
+                    return
+                try:
+                    request = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    response = {'status': 1, 'stdout': '', 'stderr': 'Malformed compile request.\n'}
+                else:
+                    response = handle_request(request, cache, incremental)
+                f.write(json.dumps(response).encode('utf-8') + b'\n')
+                f.flush()
+    finally:
+        server.close()
+        os.remove(path)
 
+
+def main():
+    return run(sys.argv[1:])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+# A thin client for "sc.py --serve", with the same command line as sc.py.
+# If SC_SERVER names the socket of a running compile server, the compilation is done there.
+# Otherwise, or if the server cannot be reached, sc.py is run directly.
+# Note: this avoids importing the compiler so that it starts quickly.
+
+import json
+import os
+import os.path
+import socket
+import sys
+
+SC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sc.py')
+
+
+def request(path, argv):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        f = s.makefile('rwb')
+        f.write(json.dumps({'cwd': os.getcwd(), 'argv': argv}).encode('utf-8') + b'\n')
+        f.flush()
+        line = f.readline()
+    if not line:
+        return None
+    response = json.loads(line.decode('utf-8'))
+    if response.get('restart'):
+        return None
+    return response
+
+
+def main():
+    argv = sys.argv[1:]
+    path = os.environ.get('SC_SERVER')
+    response = None
+    if path:
+        try:
+            response = request(path, argv)
+        except OSError:
+            response = None
+    if response is None:
+        os.execv(sys.executable, [sys.executable, SC] + argv)
+
+    sys.stdout.write(response['stdout'])
+    sys.stderr.write(response['stderr'])
+    return response['status']
+
+
+if __name__ == '__main__':
+    sys.exit(main())